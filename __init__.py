@@ -113,6 +113,7 @@ commands = {
     "gstatus": ["gst"],
     "gtags": [],
     "visualise": ["visualize", "vis", "viz", 'glog'],
+    "viz_benchmark": [],
     }
 
 try:
@@ -0,0 +1,253 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Persistent cache of file annotations.
+
+A text of a file, identified by the file id and the revision that last
+changed it, always has the same annotations, so they only have to be computed
+once. A text whose only parent text has been annotated before is annotated
+from a diff against that parent: the lines they have in common keep their
+origin, the others come from the new text. Uncommitted changes in a working
+tree are annotated the same way, against the text of its basis.
+
+Entries are stored one per text under $XDG_CACHE_HOME/bzr-gtk/annotate, as
+zlib compressed marshal data. The origin revision ids are stored once, the
+lines refer to them by index in an array of the smallest type that fits.
+"""
+
+from array import array
+import errno
+import marshal
+import os
+import sys
+import zlib
+
+from bzrlib import (
+    config,
+    osutils,
+    patiencediff,
+    trace,
+    )
+from bzrlib.revision import CURRENT_REVISION
+
+
+FORMAT = 'bzr-gtk annotate cache 1\n'
+
+# Number of cached annotations to keep, the least recently used ones are
+# removed.
+MAX_ENTRIES = 500
+
+
+def get_cache_dir():
+    return os.path.join(config.xdg_cache_dir(), 'bzr-gtk', 'annotate')
+
+
+def _repository_location(repository):
+    try:
+        return repository.user_url
+    except AttributeError:
+        return repository.bzrdir.root_transport.base
+
+
+def _serialize(key, origins):
+    revids = []
+    revid_numbers = {}
+    numbers = []
+    for origin in origins:
+        number = revid_numbers.get(origin)
+        if number is None:
+            number = revid_numbers[origin] = len(revids)
+            revids.append(origin)
+        numbers.append(number)
+    if len(revids) <= 0xff:
+        typecode = 'B'
+    elif len(revids) <= 0xffff:
+        typecode = 'H'
+    else:
+        typecode = 'i'
+    data = (key, revids, sys.byteorder, typecode,
+            array(typecode, numbers).tostring())
+    return FORMAT + zlib.compress(marshal.dumps(data, 2))
+
+
+def _deserialize(bytes):
+    """Return (key, origins) for bytes.
+
+    :raises ValueError: if bytes is not a valid cache entry.
+    """
+    if not bytes.startswith(FORMAT):
+        raise ValueError('unknown annotate cache format')
+    try:
+        data = marshal.loads(zlib.decompress(bytes[len(FORMAT):]))
+        (key, revids, byteorder, typecode, numbers_bytes) = data
+        numbers = array(typecode)
+        numbers.fromstring(numbers_bytes)
+        origins = [revids[number] for number in numbers]
+    except (zlib.error, EOFError, TypeError, ValueError, IndexError), e:
+        raise ValueError(str(e))
+    if byteorder != sys.byteorder:
+        raise ValueError('annotate cache written on another platform')
+    return key, origins
+
+
+class AnnotationCache(object):
+    """Annotations stored in a directory, one file per text."""
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = get_cache_dir()
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, osutils.sha_string(repr(key)))
+
+    def get(self, key):
+        """Return the origin of each line of the text of key, or None.
+
+        :param key: A (repository location, file id, text revision) tuple.
+        """
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+            try:
+                bytes = f.read()
+            finally:
+                f.close()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                trace.mutter('unable to read annotate cache %s: %s', path, e)
+            return None
+        try:
+            (cached_key, origins) = _deserialize(bytes)
+        except ValueError, e:
+            trace.mutter('removing corrupt annotate cache %s: %s', path, e)
+            self._remove(path)
+            return None
+        if cached_key != key:
+            return None
+        try:
+            # Used to find the least recently used entries.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return origins
+
+    def put(self, key, origins):
+        """Store the origin of each line of the text of key."""
+        path = self._path(key)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            f = open(tmp_path, 'wb')
+            try:
+                f.write(_serialize(key, origins))
+            finally:
+                f.close()
+            osutils.rename(tmp_path, path)
+        except (IOError, OSError), e:
+            trace.mutter('unable to write annotate cache %s: %s', path, e)
+            return
+        self._prune()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _prune(self):
+        """Remove the least recently used entries beyond MAX_ENTRIES."""
+        try:
+            entries = []
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                entries.append((os.stat(path).st_mtime, path))
+        except OSError:
+            return
+        entries.sort(reverse=True)
+        for mtime, path in entries[MAX_ENTRIES:]:
+            self._remove(path)
+
+
+def _update_origins(parent_lines, parent_origins, lines, revision_id):
+    """Return the origins of lines, a new version of parent_lines.
+
+    The lines that are the same as in the parent keep their origin, the
+    others come from revision_id.
+    """
+    origins = [revision_id] * len(lines)
+    matcher = patiencediff.PatienceSequenceMatcher(None, parent_lines, lines)
+    for i, j, n in matcher.get_matching_blocks():
+        origins[j:j + n] = parent_origins[i:i + n]
+    return origins
+
+
+def _text_lines(repository, file_id, text_revision):
+    for identifier, chunks in repository.iter_files_bytes(
+            [(file_id, text_revision, None)]):
+        return osutils.split_lines(''.join(chunks))
+
+
+def _revision_tree_origins(repository, tree, file_id, cache):
+    """Return the origins of the lines of file_id in tree, a revision tree.
+    """
+    text_revision = tree.get_file_revision(file_id)
+    location = _repository_location(repository)
+    key = (location, file_id, text_revision)
+    origins = cache.get(key)
+    if origins is not None:
+        return origins
+    parent_keys = repository.texts.get_parent_map(
+        [(file_id, text_revision)]).get((file_id, text_revision))
+    if parent_keys is not None and len(parent_keys) == 1:
+        parent_revision = parent_keys[0][-1]
+        parent_origins = cache.get((location, file_id, parent_revision))
+        if parent_origins is not None:
+            origins = _update_origins(
+                _text_lines(repository, file_id, parent_revision),
+                parent_origins, tree.get_file_lines(file_id), text_revision)
+    if origins is None:
+        origins = [origin for origin, line in tree.annotate_iter(file_id)]
+    cache.put(key, origins)
+    return origins
+
+
+def cached_annotate(repository, tree, file_id, cache=None):
+    """Return the annotations of file_id in tree, using the annotate cache.
+
+    :param repository: The repository of tree.
+    :param tree: A locked revision tree or working tree.
+    :return: A list of (origin revision id, line) tuples, as yielded by
+        tree.annotate_iter().
+    """
+    if cache is None:
+        cache = AnnotationCache()
+    if getattr(tree, 'get_revision_id', None) is not None:
+        return zip(_revision_tree_origins(repository, tree, file_id, cache),
+                   tree.get_file_lines(file_id))
+    basis = tree.basis_tree()
+    basis.lock_read()
+    try:
+        if len(tree.get_parent_ids()) != 1 or file_id not in basis:
+            # Merges and new files are not cached.
+            return list(tree.annotate_iter(file_id))
+        basis_origins = _revision_tree_origins(repository, basis, file_id,
+                                               cache)
+        basis_lines = basis.get_file_lines(file_id)
+    finally:
+        basis.unlock()
+    lines = tree.get_file_lines(file_id)
+    return zip(_update_origins(basis_lines, basis_origins, lines,
+                               CURRENT_REVISION), lines)
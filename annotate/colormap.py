@@ -16,6 +16,7 @@
 
 __metaclass__ = type
 
+from bisect import bisect_left
 import sys
 
 
@@ -49,27 +50,38 @@ class AnnotateColorMap:
     def set_span(self, span):
         self._span = span
         self._scale = span / max(self.colors.keys())
+        days = sorted(self.colors)
+        self._day_limits = [day * self._scale for day in days]
+        self._day_colors = [self.colors[day] for day in days]
 
     def _days(self, revision, now):
         return (now - revision.timestamp) / (24 * 60 * 60)
 
     def get_color(self, revision, now):
-        color = self.really_old_color
-        days = self.colors.keys()
-        days.sort()
-        days_old = self._days(revision, now)
-        for day in days:
-            if (days_old <= day * self._scale):
-                color = self.colors[day]
-                break
+        # The first color whose age limit is not exceeded
+        index = bisect_left(self._day_limits, self._days(revision, now))
+        if index == len(self._day_colors):
+            return self.really_old_color
+        return self._day_colors[index]
 
-        return color
+    def get_colors(self, revisions, now):
+        """Return the colors of revisions, by revision id.
+
+        The color of each revision is only worked out once, however many
+        times it is in revisions.
+        """
+        colors = {}
+        for revision in revisions:
+            if revision.revision_id not in colors:
+                colors[revision.revision_id] = self.get_color(revision, now)
+        return colors
 
 
 class AnnotateColorSaturation(AnnotateColorMap):
     def __init__(self, span=340.):
         super(AnnotateColorSaturation, self).__init__(span)
         self.current_angle = 0
+        self._hues = {}
 
     def hue(self, angle):
         return tuple([self.v(angle, r) for r in (0, 120, 240)])
@@ -100,7 +112,10 @@ class AnnotateColorSaturation(AnnotateColorMap):
     def get_color(self, revision, now):
         days = self._days(revision, now)
         saturation = 255/((days/50) + 1)
-        hue = self.hue(self.committer_angle(revision.properties.get('author',
-                                            revision.committer)))
+        committer = revision.properties.get('author', revision.committer)
+        hue = self._hues.get(committer)
+        if hue is None:
+            hue = self._hues[committer] = self.hue(
+                self.committer_angle(committer))
         color = tuple([self.saturate_v(saturation, h) for h in hue])
         return "#%x%x%x" % color
@@ -14,6 +14,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import threading
 import time
 
 from gi.repository import GObject
@@ -23,11 +24,14 @@ from gi.repository import Pango
 import re
 
 from bzrlib import patiencediff
-from bzrlib.errors import NoSuchRevision
+from bzrlib.errors import NoSuchRevision, RevisionNotPresent
 from bzrlib.revision import NULL_REVISION, CURRENT_REVISION
 
+from bzrlib.plugins.gtk.annotate.annotatecache import cached_annotate
 from bzrlib.plugins.gtk.annotate.colormap import AnnotateColorSaturation
+from bzrlib.plugins.gtk.backgroundjob import BackgroundJob
 from bzrlib.plugins.gtk.i18n import _i18n
+from bzrlib.plugins.gtk.revisioncache import get_revision_cache
 from bzrlib.plugins.gtk.revisionview import RevisionView
 from bzrlib.plugins.gtk.window import Window
 
@@ -42,13 +46,33 @@ from bzrlib.plugins.gtk.window import Window
 ) = range(6)
 
 
+def _get_revisions(repository, revision_ids):
+    """Return the revisions of revision_ids that are in repository, by id.
+
+    They are fetched with a single call, unless some of them are missing.
+    """
+    revision_cache = get_revision_cache(repository)
+    revision_ids = list(revision_ids)
+    try:
+        revisions = revision_cache.get_revisions(revision_ids)
+    except NoSuchRevision:
+        revision_ids = list(repository.has_revisions(revision_ids))
+        revisions = revision_cache.get_revisions(revision_ids)
+    return dict(zip(revision_ids, revisions))
+
+
 class GAnnotateWindow(Window):
     """Annotate window."""
 
+    # Number of annotated lines the background job hands over at a time.
+    ANNOTATE_BATCH_SIZE = 1000
+
     def __init__(self, all=False, plain=False, parent=None, branch=None):
         self.all = all
         self.plain = plain
         self._branch = branch
+        self._annotate_job = None
+        self._revnos = RevnoLookup()
 
         super(GAnnotateWindow, self).__init__(parent=parent)
 
@@ -60,8 +84,15 @@ class GAnnotateWindow(Window):
         self.revisions = {}
         self.history = []
         self._no_back = set()
+        self.connect('destroy', lambda w: self._cancel_annotate())
 
     def annotate(self, tree, branch, file_id):
+        """Show the annotations of file_id in tree.
+
+        The text of the file is shown at once, its annotations are added as
+        a background job computes them.
+        """
+        self._cancel_annotate()
         self.annotations = []
         self.branch = branch
         self.tree = tree
@@ -78,45 +109,114 @@ class GAnnotateWindow(Window):
                                        GObject.TYPE_STRING,
                                        GObject.TYPE_STRING)
 
-        last_seen = None
+        branch.lock_read()
         try:
-            branch.lock_read()
-            branch.repository.lock_read()
-            self.dotted = {}
-            revno_map = self.branch.get_revision_id_to_revno_map()
-            for revision_id, revno in revno_map.iteritems():
-                self.dotted[revision_id] = '.'.join(str(num) for num in revno)
-            for line_no, (revision, revno, line)\
-                in enumerate(self._annotate(tree, file_id)):
-                if revision.revision_id == last_seen and not self.all:
-                    revno = author = ""
-                else:
-                    last_seen = revision.revision_id
-                    author = ", ".join(revision.get_apparent_authors())
-
-                if revision.revision_id not in self.revisions:
-                    self.revisions[revision.revision_id] = revision
-
-                self.annomodel.append([revision.revision_id,
-                                       line_no + 1,
-                                       author,
-                                       revno,
-                                       None,
-                                       line.rstrip("\r\n")
-                                       ])
-                self.annotations.append(revision)
-
-            if not self.plain:
-                now = time.time()
-                self.annomodel.foreach(self._highlight_annotation, now)
+            for line_no, line in enumerate(tree.get_file_lines(file_id)):
+                self.annomodel.append([None, line_no + 1, "", "", None,
+                                       line.rstrip("\r\n")])
         finally:
-            branch.repository.unlock()
             branch.unlock()
 
+        self._last_seen = None
+        self._now = time.time()
+        self._colors = {}
         self.annoview.set_model(self.annomodel)
         self.annoview.grab_focus()
+        self.set_title('%s - gannotate' % self.tree.id2path(file_id))
+
+        # The job only fetches the revisions that were not shown before.
+        known_revisions = dict(
+            (rev_id, revision) for (rev_id, revision)
+            in self.revisions.iteritems()
+            if not isinstance(revision, FakeRevision))
+        self._annotate_job = BackgroundJob(self._compute_annotations,
+            (branch, tree, self.revision_id, file_id, known_revisions),
+            callback=self._annotations_computed)
+        self._annotate_job.start()
+
+    def _cancel_annotate(self):
+        if self._annotate_job is not None:
+            self._annotate_job.cancel()
+            self._annotate_job = None
+
+    def _compute_annotations(self, job, branch, tree, revision_id, file_id,
+                             known_revisions):
+        """Annotate file_id, in a worker thread.
+
+        bzrlib objects must not be used by two threads at once, so the job
+        opens the branch and tree again. The annotations are handed to
+        _add_annotations ANNOTATE_BATCH_SIZE lines at a time.
+
+        :return: The number of annotated lines, and the dotted revision
+            number of the annotated revision in a dictionary by revision id.
+        """
+        branch = branch.bzrdir.open_branch()
+        branch.lock_read()
+        try:
+            if revision_id == CURRENT_REVISION:
+                tree = tree.bzrdir.open_workingtree()
+            else:
+                tree = branch.repository.revision_tree(revision_id)
+            tree.lock_read()
+            try:
+                start = 0
+                for batch in self._annotate(tree, branch, file_id,
+                                            known_revisions):
+                    job.check_cancelled()
+                    job.post(self._add_annotations, start, batch)
+                    start += len(batch)
+                return (start, self._revnos.lookup(branch, [revision_id]))
+            finally:
+                tree.unlock()
+        finally:
+            branch.unlock()
+
+    def _add_annotations(self, start, annotations):
+        """Fill in the annotations of the lines from start on."""
+        model = self.annomodel
+        if start < len(model):
+            tree_iter = model.get_iter(Gtk.TreePath(path=start))
+        else:
+            tree_iter = None
+        if not self.plain:
+            # Each revision is only colored once.
+            self._colors.update(self.annotate_colormap.get_colors(
+                [revision for revision, revno, line in annotations
+                 if revision.revision_id not in self._colors], self._now))
+        for line_no, (revision, revno, line) in enumerate(annotations,
+                                                          start):
+            if revision.revision_id == self._last_seen and not self.all:
+                revno = author = ""
+            else:
+                self._last_seen = revision.revision_id
+                author = ", ".join(revision.get_apparent_authors())
+
+            if revision.revision_id not in self.revisions:
+                self.revisions[revision.revision_id] = revision
+
+            color = self._colors.get(revision.revision_id)
+            if tree_iter is None:
+                # The file has changed since its text was read.
+                tree_iter = model.append([None, line_no + 1, "", "", None,
+                                          line.rstrip("\r\n")])
+            model.set(tree_iter, REVISION_ID_COL, revision.revision_id,
+                      COMMITTER_COL, author, REVNO_COL, revno,
+                      HIGHLIGHT_COLOR_COL, color)
+            self.annotations.append(revision)
+            tree_iter = model.iter_next(tree_iter)
+
+    def _annotations_computed(self, result):
+        (line_count, dotted) = result
+        self._annotate_job = None
+        if line_count < len(self.annomodel):
+            # The file has changed since its text was read, and is shorter.
+            tree_iter = self.annomodel.iter_nth_child(None, line_count)
+            while self.annomodel.remove(tree_iter):
+                pass
+        self.dotted = dotted
         my_revno = self.dotted.get(self.revision_id, 'current')
-        title = '%s (%s) - gannotate' % (self.tree.id2path(file_id), my_revno)
+        title = '%s (%s) - gannotate' % (self.tree.id2path(self.file_id),
+                                         my_revno)
         self.set_title(title)
 
     def jump_to_line(self, lineno):
@@ -134,43 +234,54 @@ class GAnnotateWindow(Window):
         self.annoview.set_cursor(tree_path, None, False)
         self.annoview.scroll_to_cell(tree_path, use_align=True)
 
-    def _annotate(self, tree, file_id):
+    def _annotate(self, tree, branch, file_id, known_revisions=None):
+        """Yield the annotations of file_id in lists of ANNOTATE_BATCH_SIZE.
+
+        The annotations are (revision, revno, line) tuples. The revisions
+        and revision numbers of a batch are looked up before it is yielded,
+        so the first lines can be shown before the others are looked up.
+
+        :param known_revisions: Revisions that need not be fetched, by id.
+        """
         current_revision = FakeRevision(CURRENT_REVISION)
-        current_revision.committer = self.branch.get_config().username()
+        current_revision.committer = branch.get_config().username()
         current_revision.timestamp = time.time()
         current_revision.message = '[Not yet committed]'
         current_revision.parent_ids = tree.get_parent_ids()
-        current_revision.properties['branch-nick'] = self.branch._get_nick(local=True)
-        current_revno = '%d?' % (self.branch.revno() + 1)
-        repository = self.branch.repository
-        if self.revision_id == CURRENT_REVISION:
-            revision_id = self.branch.last_revision()
-        else:
-            revision_id = self.revision_id
-        revision_cache = RevisionCache(repository, self.revisions)
-        for origin, text in tree.annotate_iter(file_id):
-            rev_id = origin
-            if rev_id == CURRENT_REVISION:
-                revision = current_revision
-                revno = current_revno
-            else:
-                try:
-                    revision = revision_cache.get_revision(rev_id)
-                    revno = self.dotted.get(rev_id, 'merge')
+        current_revision.properties['branch-nick'] = branch._get_nick(local=True)
+        current_revno = '%d?' % (branch.revno() + 1)
+        repository = branch.repository
+        annotations = cached_annotate(repository, tree, file_id)
+        revisions = {}
+        if known_revisions is not None:
+            revisions.update(known_revisions)
+        absent = set([CURRENT_REVISION])
+        for start in range(0, len(annotations), self.ANNOTATE_BATCH_SIZE):
+            batch = annotations[start:start + self.ANNOTATE_BATCH_SIZE]
+            origins = set(origin for origin, text in batch)
+            missing = origins.difference(revisions).difference(absent)
+            if missing:
+                fetched = _get_revisions(repository, missing)
+                revisions.update(fetched)
+                absent.update(missing.difference(fetched))
+            origins.discard(CURRENT_REVISION)
+            dotted = self._revnos.lookup(branch, origins)
+            result = []
+            for origin, text in batch:
+                rev_id = origin
+                if rev_id == CURRENT_REVISION:
+                    revision = current_revision
+                    revno = current_revno
+                elif rev_id in revisions:
+                    revision = revisions[rev_id]
+                    revno = dotted.get(rev_id, 'merge')
                     if len(revno) > 15:
                         revno = 'merge'
-                except NoSuchRevision:
+                else:
                     revision = FakeRevision(rev_id)
                     revno = "?"
-
-            yield revision, revno, text
-
-    def _highlight_annotation(self, model, path, iter, now):
-        revision_id, = model.get(iter, REVISION_ID_COL)
-        revision = self.revisions[revision_id]
-        # XXX sinzui 2011-08-12: What does get_color return?
-        color = self.annotate_colormap.get_color(revision, now)
-        model.set_value(iter, HIGHLIGHT_COLOR_COL, color)
+                result.append((revision, revno, text))
+            yield result
 
     def _selected_revision(self):
         (path, col) = self.annoview.get_cursor()
@@ -180,7 +291,11 @@ class GAnnotateWindow(Window):
 
     def _activate_selected_revision(self, w):
         rev_id = self._selected_revision()
-        if not rev_id or rev_id == NULL_REVISION:
+        if not rev_id:
+            # The line is not annotated yet.
+            self.back_button.set_sensitive(False)
+            return
+        if rev_id == NULL_REVISION:
             return
         selected = self.revisions[rev_id]
         self.revisionview.set_revision(selected)
@@ -250,6 +365,9 @@ class GAnnotateWindow(Window):
 
     def line_diff(self, tv, path, tvc):
         row = path.get_indices()[0]
+        if row >= len(self.annotations):
+            # The line has not been annotated yet.
+            return
         revision = self.annotations[row]
         repository = self.branch.repository
         if revision.revision_id == CURRENT_REVISION:
@@ -382,6 +500,9 @@ class GAnnotateWindow(Window):
     def go_back(self):
         last_tree = self.tree
         rev_id = self._selected_revision()
+        if rev_id not in self.revisions:
+            # The line is not annotated yet.
+            return
         parent_id = self.revisions[rev_id].parent_ids[0]
         target_tree = self.branch.repository.revision_tree(parent_id)
         if self._go(target_tree):
@@ -446,21 +567,116 @@ class FakeRevision(object):
         return [self.committer]
 
 
-class RevisionCache(object):
-    """A caching revision source"""
+class RevnoLookup(object):
+    """The dotted revision numbers of a branch, worked out as needed.
 
-    def __init__(self, real_source, seed_cache=None):
-        self.__real_source = real_source
-        if seed_cache is None:
-            self.__cache = {}
-        else:
-            self.__cache = dict(seed_cache)
+    Revisions are first looked for on the mainline, which is walked from the
+    tip only as far as needed, and no further than MAINLINE_WALK_LIMIT
+    revisions. The revno map of the whole branch is only loaded once a
+    revision is not found there, after which it is used for all revisions.
+    Both are kept until the tip of the branch changes, and only the revision
+    numbers that are looked up are formatted.
+    """
+
+    # Number of mainline revisions walked at most, before the revno map of
+    # the branch is loaded. Merged revisions are only found in the map, so
+    # walking further would mostly be wasted.
+    MAINLINE_WALK_LIMIT = 1000
 
-    def get_revision(self, revision_id):
-        if revision_id not in self.__cache:
-            revision = self.__real_source.get_revision(revision_id)
-            self.__cache[revision_id] = revision
-        return self.__cache[revision_id]
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, tip):
+        self._tip = tip
+        self._dotted = {}
+        # Revisions known to have no revno in the branch
+        self._absent = set()
+        self._mainline = {}
+        # The oldest mainline revision walked so far and its revno, None
+        # once the whole mainline has been walked.
+        self._walked = None
+        self._revno_map = None
+
+    def lookup(self, branch, revision_ids):
+        """Return the dotted revnos of revision_ids in branch, as strings.
+
+        :param branch: A read locked branch.
+        :return: A dictionary by revision id, without the revisions that are
+            not in branch.
+        """
+        self._lock.acquire()
+        try:
+            (revno, tip) = branch.last_revision_info()
+            if tip != self._tip:
+                self._reset(tip)
+                self._walked = (tip, revno)
+                self._walk_end = revno - self.MAINLINE_WALK_LIMIT
+            missing = set(revision_ids).difference(self._dotted)
+            # Uncommitted changes are never in the branch.
+            missing.discard(CURRENT_REVISION)
+            missing.difference_update(self._absent)
+            if self._revno_map is None:
+                missing.difference_update(
+                    self._find_mainline(branch, missing))
+            if missing and self._revno_map is None:
+                # Revisions that are not in the repository, like ghosts,
+                # have no revno, the map is only needed for the others.
+                present = branch.repository.has_revisions(missing)
+                self._absent.update(missing.difference(present))
+                missing.intersection_update(present)
+            if missing:
+                if self._revno_map is None:
+                    self._revno_map = branch.get_revision_id_to_revno_map()
+                for revision_id in missing:
+                    revno = self._revno_map.get(revision_id)
+                    if revno is None:
+                        self._absent.add(revision_id)
+                    else:
+                        self._dotted[revision_id] = '.'.join(
+                            str(num) for num in revno)
+            return dict((revision_id, self._dotted[revision_id])
+                        for revision_id in revision_ids
+                        if revision_id in self._dotted)
+        finally:
+            self._lock.release()
+
+    def _find_mainline(self, branch, revision_ids):
+        """Look for revision_ids on the mainline of branch.
+
+        :return: The revision ids that were found.
+        """
+        found = set()
+        for revision_id in revision_ids:
+            revno = self._mainline.get(revision_id)
+            if revno is not None:
+                self._dotted[revision_id] = str(revno)
+                found.add(revision_id)
+        wanted = set(revision_ids).difference(found)
+        if not wanted or self._walked is None:
+            return found
+        (revision_id, revno) = self._walked
+        ancestry = branch.repository.get_graph().iter_lefthand_ancestry(
+            revision_id, (NULL_REVISION,))
+        try:
+            for revision_id in ancestry:
+                if revno <= self._walk_end:
+                    # Far enough, the others are left to the revno map.
+                    break
+                self._mainline[revision_id] = revno
+                self._walked = (revision_id, revno)
+                if revision_id in wanted:
+                    self._dotted[revision_id] = str(revno)
+                    found.add(revision_id)
+                    wanted.remove(revision_id)
+                    if not wanted:
+                        return found
+                revno -= 1
+        except RevisionNotPresent:
+            # A ghost, the mainline stops here.
+            pass
+        self._walked = None
+        return found
 
 
 class SearchBox(Gtk.HBox):
@@ -0,0 +1,107 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Run slow bzrlib operations without blocking the GTK main loop."""
+
+import sys
+import threading
+
+from gi.repository import GObject
+
+from bzrlib import trace
+
+
+GObject.threads_init()
+
+_current = threading.local()
+
+
+class JobCancelled(Exception):
+    """Raised in a background job that has been cancelled."""
+
+
+def current_job():
+    """Return the BackgroundJob running in this thread, or None."""
+    return getattr(_current, 'job', None)
+
+
+def check_cancelled():
+    """Raise JobCancelled if the job running in this thread was cancelled.
+
+    This does nothing when called outside of a background job, so it is safe
+    to call from code, like progress reporting, that runs in both.
+    """
+    job = current_job()
+    if job is not None:
+        job.check_cancelled()
+
+
+class BackgroundJob(threading.Thread):
+    """Run a function in a worker thread.
+
+    The function is called with the job as first argument, followed by args.
+    It can hand partial results to the main loop with post() and should call
+    check_cancelled() regularly. Its return value is passed to callback, in
+    the main loop. If it raises an exception, error_callback is called with
+    the exception info instead. Neither is called once the job has been
+    cancelled.
+    """
+
+    def __init__(self, function, args=(), callback=None, error_callback=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._function = function
+        self._args = args
+        self._callback = callback
+        self._error_callback = error_callback
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """Ask the job to stop and drop any result it has not delivered."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def post(self, function, *args):
+        """Call function(*args) from the main loop, unless cancelled by then.
+        """
+        def call():
+            if not self.cancelled:
+                function(*args)
+            return False
+        GObject.idle_add(call)
+
+    def run(self):
+        _current.job = self
+        try:
+            try:
+                result = self._function(self, *self._args)
+            except JobCancelled:
+                return
+            except Exception:
+                if self._error_callback is None:
+                    trace.log_exception_quietly()
+                else:
+                    self.post(self._error_callback, sys.exc_info())
+                return
+            if self._callback is not None:
+                self.post(self._callback, result)
+        finally:
+            _current.job = None
@@ -0,0 +1,312 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Benchmarks of the branch view on synthetic histories.
+
+Each history is built in an in-memory repository, then linegraph() is timed
+stage by stage, followed by BranchTreeModel.set_line_graph_data() and the
+rendering of every row by CellRendererGraph. run_benchmarks() returns the
+timings as a dict that can be written out as JSON, see "bzr viz-benchmark".
+
+A history is a list of (revision_id, parent_ids) tuples, with parents
+before their children and the tip last. Parents that are not in the list
+are ghosts.
+"""
+
+import random
+import time
+
+from bzrlib import (
+    bzrdir,
+    controldir,
+    inventory,
+    urlutils,
+    )
+from bzrlib.revision import Revision
+
+from bzrlib.plugins.gtk.branchview.linegraph import (
+    LineGraphState,
+    linegraph,
+    )
+
+
+# The stages of linegraph(), in the order it reports them to its
+# root_progress.
+LINEGRAPH_STAGES = ['ancestry', 'ghost_removal', 'merge_sort',
+                    'node_finding', 'edge_organising', 'prettifying']
+
+
+def linear_history(size):
+    """Return a history of size revisions, each with a single parent."""
+    history = []
+    parents = []
+    for i in range(size):
+        revid = 'linear-%d' % i
+        history.append((revid, parents))
+        parents = [revid]
+    return history
+
+
+def wide_merge_history(size, branches=32):
+    """Return a history where many branches are worked on at once.
+
+    They are merged into trunk now and then, and carry on from the merge.
+    """
+    rnd = random.Random(size)
+    tip = 'wide-0'
+    history = [(tip, [])]
+    active = [tip] * branches
+    while len(history) < size - 1:
+        revid = 'wide-%d' % len(history)
+        k = rnd.randrange(branches)
+        x = rnd.random()
+        if x < 0.2 and active[k] != tip:
+            history.append((revid, [tip, active[k]]))
+            tip = active[k] = revid
+        elif x < 0.5:
+            history.append((revid, [tip]))
+            tip = revid
+        else:
+            history.append((revid, [active[k]]))
+            active[k] = revid
+    history.append(('wide-%d' % len(history), [tip]))
+    return history
+
+
+def octopus_history(size, arms=8):
+    """Return a history of merges of arms short branches at once."""
+    rnd = random.Random(size)
+    tip = 'octopus-0'
+    history = [(tip, [])]
+    while len(history) < size:
+        parents = [tip]
+        for arm in range(arms):
+            parent = tip
+            for i in range(rnd.randint(1, 4)):
+                revid = 'octopus-%d' % len(history)
+                history.append((revid, [parent]))
+                parent = revid
+            parents.append(parent)
+        tip = 'octopus-%d' % len(history)
+        history.append((tip, parents))
+    return history
+
+
+def ghost_heavy_history(size):
+    """Return a history where one revision in three merges a ghost.
+
+    Every tenth revision merges a short branch that starts from a ghost.
+    """
+    tip = 'ghosts-0'
+    history = [(tip, [])]
+    while len(history) < size:
+        i = len(history)
+        revid = 'ghosts-%d' % i
+        if i % 10 == 0:
+            base = 'ghosts-%d-branch-0' % i
+            history.append((base, ['ghosts-%d-base' % i]))
+            merged = 'ghosts-%d-branch-1' % i
+            history.append((merged, [base]))
+            history.append((revid, [tip, merged]))
+        elif i % 3 == 0:
+            history.append((revid, [tip, 'ghosts-%d-ghost' % i]))
+        else:
+            history.append((revid, [tip]))
+        tip = revid
+    return history
+
+
+def deep_history(size, depth=10):
+    """Return a history of branches that merged branches, depth levels deep.
+    """
+    tip = 'deep-0'
+    history = [(tip, [])]
+    def nested_branch(base, depth):
+        revid = 'deep-%d' % len(history)
+        history.append((revid, [base]))
+        if depth > 1:
+            merged = nested_branch(base, depth - 1)
+            parents = [revid, merged]
+            revid = 'deep-%d' % len(history)
+            history.append((revid, parents))
+        return revid
+    while len(history) < size:
+        merged = nested_branch(tip, depth)
+        revid = 'deep-%d' % len(history)
+        history.append((revid, [tip, merged]))
+        tip = revid
+    return history
+
+
+HISTORIES = [
+    ('linear', linear_history),
+    ('wide_merge', wide_merge_history),
+    ('octopus', octopus_history),
+    ('ghost_heavy', ghost_heavy_history),
+    ('deep', deep_history),
+    ]
+
+
+def build_branch(history, location):
+    """Create a branch with history at location, and return it.
+
+    The revisions have empty inventories, only their graph matters.
+    """
+    branch = controldir.ControlDir.create_branch_convenience(
+        location, force_new_tree=False,
+        format=bzrdir.format_registry.make_bzrdir('pack-0.92'))
+    repository = branch.repository
+    present = set()
+    repository.lock_write()
+    try:
+        repository.start_write_group()
+        try:
+            for revid, parent_ids in history:
+                inv = inventory.Inventory(revision_id=revid)
+                inv.root.revision = history[0][0]
+                rev = Revision(revid, committer='benchmark', message=revid,
+                               timestamp=0, timezone=0, inventory_sha1='',
+                               parent_ids=parent_ids, properties={})
+                repository.add_revision(revid, rev, inv)
+                present.add(revid)
+        except:
+            repository.abort_write_group()
+            raise
+        else:
+            repository.commit_write_group()
+    finally:
+        repository.unlock()
+    tip = history[-1][0]
+    parents = dict(history)
+    revno = 0
+    revid = tip
+    while revid in present:
+        revno += 1
+        revid = (parents[revid] or [None])[0]
+    branch.lock_write()
+    try:
+        branch.set_last_revision_info(revno, tip)
+    finally:
+        branch.unlock()
+    return branch
+
+
+class _StageTimer(object):
+    """A root progress bar for linegraph() that notes when stages start."""
+
+    def __init__(self):
+        self.starts = []
+
+    def update(self, msg=None, current=None, total=None):
+        self.starts.append(time.time())
+
+
+def time_linegraph(branch, broken_line_length=32, processes=None):
+    """Time linegraph() on the history of branch.
+
+    :param processes: The number of processes for linegraph() to use.
+
+    :return: A tuple of the timings of each stage, as a dict, and the
+        LineGraphState of the graph.
+    """
+    state = LineGraphState()
+    timer = _StageTimer()
+    branch.lock_read()
+    try:
+        start = time.time()
+        linegraph(branch.repository.get_graph(), [branch.last_revision()],
+                  broken_line_length=broken_line_length, root_progress=timer,
+                  state=state, processes=processes)
+        end = time.time()
+    finally:
+        branch.unlock()
+    starts = timer.starts + [end]
+    timings = dict(zip(LINEGRAPH_STAGES,
+                       [b - a for a, b in zip(starts, starts[1:])]))
+    timings['total'] = end - start
+    return timings, state
+
+
+def time_set_line_graph_data(branch, state):
+    """Time filling a BranchTreeModel with all the rows of state."""
+    from bzrlib.plugins.gtk.branchview.treemodel import BranchTreeModel
+    model = BranchTreeModel(branch, [])
+    start = time.time()
+    model.set_line_graph_data(state.line_graph, graph=state.graph)
+    return time.time() - start
+
+
+def time_render(state):
+    """Time CellRendererGraph drawing every row of state, offscreen.
+
+    The rows are drawn twice, the second time from the renderer's cache as
+    far as it holds them.
+    """
+    import cairo
+    from gi.repository import Gdk, Gtk
+    from bzrlib.plugins.gtk.branchview.graphcell import CellRendererGraph
+    widget = Gtk.TreeView()
+    cell = CellRendererGraph()
+    cell.columns_len = state.columns_len
+    cell.graph = state.graph
+    cell.tags = []
+    (x, y, width, height) = cell.do_get_size(widget, None)
+    area = Gdk.Rectangle()
+    area.x = area.y = 0
+    area.width = width
+    area.height = height
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    ctx = cairo.Context(surface)
+    timings = {}
+    for name in ('first_pass', 'second_pass'):
+        start = time.time()
+        for row in xrange(len(state.graph)):
+            cell.row = row
+            ctx.save()
+            cell.do_render(ctx, widget, area, area, 0)
+            ctx.restore()
+        timings[name] = time.time() - start
+    return timings
+
+
+def run_benchmarks(size, names=None, gui=True, url='memory:///',
+                   processes=None):
+    """Run the benchmarks on histories of about size revisions.
+
+    :param names: The names of the histories to use, from HISTORIES, or None
+        for all of them.
+    :param gui: Whether to time the model and the renderer, which need GTK+.
+    :param url: Where to create the branches, in memory by default.
+    :param processes: The number of processes for linegraph() to use.
+    :return: A dict of results, with the timings in seconds.
+    """
+    results = {}
+    for name, make_history in HISTORIES:
+        if names is not None and name not in names:
+            continue
+        history = make_history(size)
+        start = time.time()
+        branch = build_branch(history, urlutils.join(url, name))
+        result = {'build': time.time() - start}
+        result['linegraph'], state = time_linegraph(branch,
+                                                    processes=processes)
+        result['revisions'] = len(state.line_graph)
+        result['ghosts'] = len(state.ghosts)
+        result['columns'] = state.columns_len
+        if gui:
+            result['set_line_graph_data'] = time_set_line_graph_data(branch,
+                                                                     state)
+            result['render'] = time_render(state)
+        results[name] = result
+    return {'size': size, 'processes': processes, 'histories': results}
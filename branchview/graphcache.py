@@ -0,0 +1,279 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Persistent cache of computed line graphs.
+
+The ancestry of a revision never changes, so the line graph of a set of start
+revisions only has to be computed once. The one exception are ghosts: a
+revision that was missing when the graph was computed may have been fetched
+since, so every cache entry records the ghosts it was computed with and is
+dropped as soon as one of them shows up in the repository.
+
+Entries are stored one per file under $XDG_CACHE_HOME/bzr-gtk/linegraph, as
+zlib compressed marshal data. Revision ids are stored once, parents and
+children refer to them by index. The nodes and lines are stored as the arrays
+of a CompactLineGraph, in the byte order of the machine.
+"""
+
+from array import array
+import errno
+import marshal
+import os
+import sys
+import zlib
+
+from bzrlib import (
+    config,
+    osutils,
+    trace,
+    )
+from bzrlib.plugins.gtk.branchview.linegraph import (
+    CompactLineGraph,
+    linegraph,
+    LineGraphState,
+    )
+
+
+FORMAT = 'bzr-gtk linegraph cache 3\n'
+
+# Number of cached graphs to keep, the least recently used ones are removed.
+MAX_ENTRIES = 20
+
+
+def get_cache_dir():
+    return os.path.join(config.xdg_cache_dir(), 'bzr-gtk', 'linegraph')
+
+
+def _repository_location(repository):
+    try:
+        return repository.user_url
+    except AttributeError:
+        return repository.bzrdir.root_transport.base
+
+
+def _cache_key(repository, start_revs, maxnum, broken_line_length, graph_data,
+               mainline_only):
+    return (_repository_location(repository), tuple(start_revs), maxnum,
+            broken_line_length, graph_data, mainline_only)
+
+
+def _serialize(key, state):
+    revids = [row[0] for row in state.line_graph]
+    revid_numbers = dict((revid, i) for i, revid in enumerate(revids))
+    def number(revid):
+        try:
+            return revid_numbers[revid]
+        except KeyError:
+            # A parent or child that is not shown, because of maxnum or
+            # mainline_only.
+            revid_numbers[revid] = len(revids)
+            revids.append(revid)
+            return revid_numbers[revid]
+    parents = []
+    children = []
+    revnos = []
+    for (revid, node, row_lines, row_parents, row_children,
+         revno_sequence) in state.line_graph:
+        parents.append([number(parent) for parent in row_parents])
+        if row_children is None:
+            children.append(None)
+        else:
+            children.append([number(child) for child in row_children])
+        revnos.append(revno_sequence)
+    graph = state.graph
+    data = (key, sorted(state.ghosts), len(state.line_graph), revids, parents,
+            children, revnos, state.columns_len, sys.byteorder, graph._offset,
+            [getattr(graph, name).tostring()
+             for name in CompactLineGraph.ARRAYS])
+    return FORMAT + zlib.compress(marshal.dumps(data, 2))
+
+
+def _deserialize(bytes):
+    """Return (key, state) for bytes.
+
+    :raises ValueError: if bytes is not a valid cache entry.
+    """
+    if not bytes.startswith(FORMAT):
+        raise ValueError('unknown linegraph cache format')
+    try:
+        data = marshal.loads(zlib.decompress(bytes[len(FORMAT):]))
+        (key, ghosts, row_count, revids, parents, children, revnos,
+         columns_len, byteorder, offset, arrays) = data
+    except (zlib.error, EOFError, TypeError), e:
+        raise ValueError(str(e))
+    if byteorder != sys.byteorder:
+        raise ValueError('linegraph cache written on another platform')
+    if len(arrays) != len(CompactLineGraph.ARRAYS):
+        raise ValueError('linegraph cache entry is incomplete')
+    graph = CompactLineGraph()
+    for name, array_bytes in zip(CompactLineGraph.ARRAYS, arrays):
+        graph_array = array('i')
+        graph_array.fromstring(array_bytes)
+        setattr(graph, name, graph_array)
+    graph._offset = offset
+    graph._index_lines()
+    line_graph = []
+    revid_index = {}
+    nodes = {}
+    for i in xrange(row_count):
+        revid = revids[i]
+        revid_index[revid] = i
+        row_children = children[i]
+        if row_children is not None:
+            row_children = [revids[child] for child in row_children]
+        node = graph.node(i)
+        # Rows of the same branch share their node.
+        node = nodes.setdefault(node, node)
+        line_graph.append([
+            revid,
+            node,
+            None,
+            tuple([revids[parent] for parent in parents[i]]),
+            row_children,
+            revnos[i]])
+    (location, start_revs, maxnum, broken_line_length, graph_data,
+     mainline_only) = key
+    state = LineGraphState()
+    state.set(start_revs, maxnum, broken_line_length, graph_data,
+              mainline_only, ghosts, line_graph, revid_index, columns_len,
+              graph=graph)
+    return key, state
+
+
+class LineGraphCache(object):
+    """Line graphs stored in a directory, one file per graph."""
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = get_cache_dir()
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, osutils.sha_string(repr(key)))
+
+    def get(self, key, graph):
+        """Return a LineGraphState with the cached line graph for key, or None.
+
+        Entries that are no longer valid for graph, or that can not be read,
+        are removed.
+        """
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+            try:
+                bytes = f.read()
+            finally:
+                f.close()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                trace.mutter('unable to read linegraph cache %s: %s',
+                             path, e)
+            return None
+        try:
+            (cached_key, state) = _deserialize(bytes)
+        except ValueError, e:
+            trace.mutter('removing corrupt linegraph cache %s: %s', path, e)
+            self._remove(path)
+            return None
+        if cached_key != key or graph.get_parent_map(state.ghosts):
+            trace.mutter('removing stale linegraph cache %s', path)
+            self._remove(path)
+            return None
+        try:
+            # Used to find the least recently used entries.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return state
+
+    def put(self, key, state):
+        """Store the line graph in state, a LineGraphState."""
+        path = self._path(key)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            f = open(tmp_path, 'wb')
+            try:
+                f.write(_serialize(key, state))
+            finally:
+                f.close()
+            osutils.rename(tmp_path, path)
+        except (IOError, OSError), e:
+            trace.mutter('unable to write linegraph cache %s: %s', path, e)
+            return
+        self._prune()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _prune(self):
+        """Remove the least recently used entries beyond MAX_ENTRIES."""
+        try:
+            entries = []
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                entries.append((os.stat(path).st_mtime, path))
+        except OSError:
+            return
+        entries.sort(reverse=True)
+        for mtime, path in entries[MAX_ENTRIES:]:
+            self._remove(path)
+
+
+def cached_linegraph(repository, start_revs, maxnum=None,
+                     broken_line_length=None, graph_data=True,
+                     mainline_only=False, root_progress=None, cache=None):
+    """Return a LineGraphState for repository, using the line graph cache.
+
+    The arguments are the same as for linegraph(), except that it takes the
+    repository rather than its graph.
+    """
+    if cache is None:
+        cache = LineGraphCache()
+    state = load_linegraph(repository, start_revs, maxnum,
+                           broken_line_length, graph_data, mainline_only,
+                           cache)
+    if state is not None:
+        return state
+    state = LineGraphState()
+    linegraph(repository.get_graph(), start_revs, maxnum, broken_line_length,
+              graph_data, mainline_only, root_progress, state)
+    store_linegraph(repository, state, cache)
+    return state
+
+
+def load_linegraph(repository, start_revs, maxnum=None,
+                   broken_line_length=None, graph_data=True,
+                   mainline_only=False, cache=None):
+    """Return the cached LineGraphState for these arguments, or None."""
+    if cache is None:
+        cache = LineGraphCache()
+    key = _cache_key(repository, start_revs, maxnum, broken_line_length,
+                     graph_data, mainline_only)
+    return cache.get(key, repository.get_graph())
+
+
+def store_linegraph(repository, state, cache=None):
+    """Add the line graph in state, as from update_linegraph(), to the cache.
+    """
+    if cache is None:
+        cache = LineGraphCache()
+    key = _cache_key(repository, state.start_revs, state.maxnum,
+                     state.broken_line_length, state.graph_data,
+                     state.mainline_only)
+    cache.put(key, state)
@@ -16,11 +16,15 @@ __author__    = "Scott James Remnant <scott@ubuntu.com>"
 
 import math
 
+import cairo
+
 from gi.repository import Gtk
 from gi.repository import GObject
 from gi.repository import Pango
 from gi.repository import PangoCairo
 
+from bzrlib.lru_cache import LRUCache
+
 
 # Cairo constants are not exported yet. These are taken from documentation.
 CAIRO_LINE_CAP_BUTT = 0
@@ -32,6 +36,14 @@ CAIRO_FILL_RULE_WINDING = 0
 CAIRO_FILL_RULE_EVEN_ODD = 1
 
 
+CAIRO_CONTENT_COLOR_ALPHA = 0x3000
+
+
+# Number of rendered cells kept, each one takes the width of the graph
+# column times the row height, times four bytes.
+SURFACE_CACHE_SIZE = 256
+
+
 # Macro from  Pango header.
 def PANGO_PIXELS(d):
     return (d + 512) / 1000
@@ -40,13 +52,20 @@ def PANGO_PIXELS(d):
 class CellRendererGraph(Gtk.CellRendererPixbuf):
     """Cell renderer for directed graph.
 
-    Properties:
+    If graph is set to a CompactLineGraph, the node and lines of the cell
+    are read from it, for the row in the row attribute. Otherwise they are
+    taken from these properties:
       node              (column, colour) tuple to draw revision node,
       in_lines          (start, end, colour) tuple list to draw inward lines,
       out_lines         (start, end, colour) tuple list to draw outward lines.
+
+    Rendered cells are kept in a bounded cache, and painted again for cells
+    that look the same. Call clear_cache() when the theme changes.
     """
 
     columns_len = 0
+    graph = None
+    row = 0
 
     __gproperties__ = {
         "node":         ( GObject.TYPE_PYOBJECT, "node",
@@ -67,6 +86,15 @@ class CellRendererGraph(Gtk.CellRendererPixbuf):
                         ),
         }
 
+    def __init__(self):
+        super(CellRendererGraph, self).__init__()
+        self._surfaces = LRUCache(SURFACE_CACHE_SIZE)
+
+    def clear_cache(self):
+        """Forget the box size and the rendered cells."""
+        self.__dict__.pop('_box_size', None)
+        self._surfaces.clear()
+
     def do_set_property(self, property, value):
         """Set properties from GObject properties."""
         if property.name == "node":
@@ -163,28 +191,63 @@ class CellRendererGraph(Gtk.CellRendererPixbuf):
         to cross other columns we actually draw it as in the .---' style
         instead of a pure diagonal ... this reduces confusion by an
         incredible amount.
+
+        The cell is drawn into a surface of the size of bg_area, which is
+        cached and painted again for the cells with the same contents.
         """
         ctx.rectangle(bg_area.x, bg_area.y, bg_area.width, bg_area.height)
         ctx.clip()
 
         box_size = self.box_size(widget)
 
+        graph = self.graph
+        if graph is None:
+            node = self.node
+            in_lines = self.in_lines
+            out_lines = self.out_lines
+        else:
+            node = graph.node(self.row)
+            if self.row > 0:
+                in_lines = graph.lines(self.row - 1)
+            else:
+                in_lines = []
+            out_lines = graph.lines(self.row)
+
+        selected = bool(flags & Gtk.CellRendererState.SELECTED)
+        key = (tuple(in_lines), tuple(out_lines), node, tuple(self.tags),
+               selected, box_size, cell_area.x - bg_area.x,
+               cell_area.y - bg_area.y, cell_area.height, bg_area.width,
+               bg_area.height)
+        surface = self._surfaces.get(key)
+        if surface is None:
+            surface = ctx.get_target().create_similar(
+                CAIRO_CONTENT_COLOR_ALPHA, bg_area.width, bg_area.height)
+            surface_ctx = cairo.Context(surface)
+            surface_ctx.translate(-bg_area.x, -bg_area.y)
+            self.render_cell(surface_ctx, widget, bg_area, cell_area,
+                             box_size, node, in_lines, out_lines, flags)
+            self._surfaces[key] = surface
+        ctx.set_source_surface(surface, bg_area.x, bg_area.y)
+        ctx.paint()
+
+    def render_cell(self, ctx, widget, bg_area, cell_area, box_size, node,
+                    in_lines, out_lines, flags):
         ctx.set_line_width(box_size / 8)
 
         # Draw lines into the cell
-        for start, end, colour in self.in_lines:
+        for start, end, colour in in_lines:
             self.render_line (ctx, cell_area, box_size,
                          bg_area.y, bg_area.height,
                          start, end, colour, flags)
 
         # Draw lines out of the cell
-        for start, end, colour in self.out_lines:
+        for start, end, colour in out_lines:
             self.render_line (ctx, cell_area, box_size,
                          bg_area.y + bg_area.height, bg_area.height,
                          start, end, colour, flags)
 
         # Draw the revision node in the right column
-        (column, colour) = self.node
+        (column, colour) = node
         ctx.arc(cell_area.x + box_size * column + box_size / 2,
                 cell_area.y + cell_area.height / 2,
                 box_size / 4, 0, 2 * math.pi)
@@ -201,7 +264,8 @@ class CellRendererGraph(Gtk.CellRendererPixbuf):
         self.set_colour(ctx, colour, 0.5, 1.0)
         ctx.fill()
 
-        self.render_tags(ctx, widget.create_pango_context(), cell_area, box_size)
+        self.render_tags(ctx, widget.create_pango_context(), cell_area, box_size,
+                         column)
 
     def render_line(self, ctx, cell_area, box_size,
                     mid, height, start, end, colour, flags):
@@ -249,12 +313,10 @@ class CellRendererGraph(Gtk.CellRendererPixbuf):
 
         ctx.stroke()
 
-    def render_tags(self, ctx, pango_ctx, cell_area, box_size):
+    def render_tags(self, ctx, pango_ctx, cell_area, box_size, column):
         # colour ID used in self.set_colour on the tags
         TAG_COLOUR_ID = 1
 
-        (column, colour) = self.node
-
         font_desc = Pango.FontDescription()
         font_desc.set_size(Pango.SCALE * 7)
 
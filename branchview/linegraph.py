@@ -8,13 +8,24 @@ window.
 __copyright__ = "Copyright 2005 Canonical Ltd."
 __author__    = "Scott James Remnant <scott@ubuntu.com>"
 
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import chain, count, imap, izip
+from operator import itemgetter
+
 from bzrlib.revision import NULL_REVISION
-from bzrlib.tsort import merge_sort
+from bzrlib.tsort import merge_sort, MergeSorter
 from bzrlib import ui
 
 
+# The smallest graph linegraph() splits between processes, smaller ones take
+# longer to send to the processes than to lay out.
+PARALLEL_MIN_ROWS = 10000
+
+
 def linegraph(graph, start_revs, maxnum=None, broken_line_length=None,
-              graph_data=True, mainline_only=False, root_progress=None):
+              graph_data=True, mainline_only=False, root_progress=None,
+              state=None, processes=None):
     """Produce a directed graph of a bzr repository.
 
     Returns a tuple of (line_graph, revid_index, columns_len) where
@@ -42,6 +53,15 @@ def linegraph(graph, start_revs, maxnum=None, broken_line_length=None,
 
     It's up to you how to actually draw the nodes and lines (straight,
     curved, kinked, etc.) and to pick the actual colours for each index.
+
+    If state is a LineGraphState, it is filled in so that the graph can later
+    be extended with update_linegraph(). It keeps the nodes and lines in a
+    CompactLineGraph, which takes a lot less memory than the lists, so the
+    rows returned then have None for their lines.
+
+    If processes is more than one, the segments of the lines of large graphs
+    are worked out in a pool of that many processes. The result is the same,
+    except that the lines are then split into rows in state too.
     """
     assert isinstance(start_revs, list)
     def update_root_progress(step_number):
@@ -49,57 +69,10 @@ def linegraph(graph, start_revs, maxnum=None, broken_line_length=None,
         if root_progress is not None:
             root_progress.update(None, step_number)
 
-    graph_parents = {}
-    ghosts = set()
-    graph_children = {}
-    update_root_progress(1)
-    progress_bar = ui.ui_factory.nested_progress_bar()
-    try:
-        progress_bar.update("Arranging tree fragments")
-        for i, (revid, parent_revids) in enumerate(graph.iter_ancestry(start_revs)):
-            if i % 25 == 0:
-                progress_bar.tick()
-            if parent_revids is None:
-                ghosts.add(revid)
-                continue
-            if parent_revids == (NULL_REVISION,):
-                graph_parents[revid] = ()
-            else:
-                graph_parents[revid] = parent_revids
-            for parent in parent_revids:
-                graph_children.setdefault(parent, []).append(revid)
-            graph_children.setdefault(revid, [])
-    finally:
-        progress_bar.finished()
-
-    update_root_progress(2)
-    progress_bar = ui.ui_factory.nested_progress_bar()
-    try:
-        progress_bar.update("Removing ghosts", 0, len(ghosts))
-        for i, ghost in enumerate(ghosts):
-            if i % 25 == 0:
-                progress_bar.update(None, i)
-            for ghost_child in graph_children[ghost]:
-                graph_parents[ghost_child] = [p for p in graph_parents[ghost_child]
-                                              if p not in ghosts]
-    finally:
-        progress_bar.finished()
-    graph_parents["top:"] = start_revs
-
-    if len(graph_parents)>0:
-        merge_sorted_revisions = merge_sort(
-            graph_parents,
-            "top:",
-            generate_revno=True)
-    else:
-        merge_sorted_revisions = ()
-
-    if mainline_only:
-        merge_sorted_revisions = [elem for elem in merge_sorted_revisions \
-                                  if len(elem[3])==1 ]
-
-    assert merge_sorted_revisions[0][1] == "top:"
-    merge_sorted_revisions = merge_sorted_revisions[1:]
+    (graph_parents, graph_children, ghosts,
+     merge_sorted_revisions) = _merge_sorted_ancestry(graph, start_revs,
+                                                      mainline_only,
+                                                      update_root_progress)
 
     revid_index = {}
     revno_index = {}
@@ -115,7 +88,7 @@ def linegraph(graph, start_revs, maxnum=None, broken_line_length=None,
 
     linegraph = []
 
-    update_root_progress(3)
+    update_root_progress(4)
     progress_bar = ui.ui_factory.nested_progress_bar()
     try:
         progress_bar.update("Finding nodes", 0, len(merge_sorted_revisions))
@@ -157,31 +130,20 @@ def linegraph(graph, start_revs, maxnum=None, broken_line_length=None,
 
     if graph_data:
         branch_ids = branch_lines.keys()
-
-        def branch_id_cmp(x, y):
-            """Compaire branch_id's first by the number of digits, then reversed
-            by their value"""
-            len_x = len(x)
-            len_y = len(y)
-            if len_x == len_y:
-                return -cmp(x, y)
-            return cmp(len_x, len_y)
-
-        branch_ids.sort(branch_id_cmp)
+        branch_ids.sort(_branch_id_cmp)
         # This will hold a tuple of (child_index, parent_index, col_index) for each
         # line that needs to be drawn. If col_index is not none, then the line is
         # drawn along that column, else the the line can be drawn directly between
         # the child and parent because either the child and parent are in the same
         # branch line, or the child and parent are 1 row apart.
         lines = []
-        empty_column = [False for i in range(len(graph_parents))]
-        # This will hold a bit map for each cell. If the cell is true, then the
-        # cell allready contains a node or line. This use when deciding what column
-        # to place a branch line or line in, without it overlaping something else.
-        columns = [list(empty_column)]
+        # This will hold the rows of each column that allready contain a node
+        # or line. This use when deciding what column to place a branch line
+        # or line in, without it overlaping something else.
+        columns = [_Column()]
 
 
-        update_root_progress(4)
+        update_root_progress(5)
         progress_bar = ui.ui_factory.nested_progress_bar()
         try:
             progress_bar.update("Organizing edges", 0, len(branch_ids))
@@ -189,54 +151,8 @@ def linegraph(graph, start_revs, maxnum=None, broken_line_length=None,
                 if i % 25 == 0:
                     progress_bar.update(None, i)
                 branch_line = branch_lines[branch_id]
-
-                # Find the col_index for the direct parent branch. This will be the
-                # starting point when looking for a free column.
-                parent_col_index = 0
-                parent_index = None
-                if len(branch_id) > 1:
-                    parent_revno = branch_id[0:-1]
-                    if parent_revno in revno_index:
-                        parent_index = revno_index[parent_revno]
-                        parent_node = linegraph[parent_index][1]
-                        if parent_node:
-                            parent_col_index = parent_node[0]
-
-
-                col_search_order = _branch_line_col_search_order(columns,
-                                                                 parent_col_index)
-                color = reduce(lambda x, y: x+y, branch_id, 0)
-                cur_cont_line = []
-
-                line_range = []
-                last_rev_index = None
-                for rev_index in branch_line:
-                    if last_rev_index:
-                        if broken_line_length and \
-                           rev_index - last_rev_index > broken_line_length:
-                            line_range.append(last_rev_index+1)
-                            line_range.append(rev_index-1)
-                        else:
-                            line_range.extend(range(last_rev_index+1, rev_index))
-
-                    line_range.append(rev_index)
-                    last_rev_index = rev_index
-
-                if parent_index:
-                    if broken_line_length and \
-                       parent_index - last_rev_index > broken_line_length:
-                        line_range.append(last_rev_index+1)
-                    else:
-                        line_range.extend(range(last_rev_index+1, parent_index))
-
-                col_index = _find_free_column(columns,
-                                              empty_column,
-                                              col_search_order,
-                                              line_range)
-                node = (col_index, color)
-                for rev_index in branch_line:
-                    linegraph[rev_index][1] = node
-                    columns[col_index][rev_index] = True
+                _place_branch_line(linegraph, columns, revno_index, branch_id,
+                                   branch_line, broken_line_length)
 
                 for rev_index in branch_line:
                     (sequence_number,
@@ -246,132 +162,1162 @@ def linegraph(graph, start_revs, maxnum=None, broken_line_length=None,
                          end_of_merge) = merge_sorted_revisions[rev_index]
 
                     linegraph[rev_index][4] = graph_children[revid]
-                    col_index = linegraph[rev_index][1][0]
-
-                    for parent_revid in graph_parents[revid]:
-                        if parent_revid in revid_index:
-
-                            parent_index = revid_index[parent_revid]
-                            parent_node = linegraph[parent_index][1]
-                            if parent_node:
-                                parent_col_index = parent_node[0]
-                            else:
-                                parent_col_index = None
-                            col_search_order = \
-                                    _line_col_search_order(columns,
-                                                           parent_col_index,
-                                                           col_index)
-
-                            # If this line is really long, break it.
-                            if len(branch_id) > 0 and \
-                               broken_line_length and \
-                               parent_index - rev_index > broken_line_length:
-                                child_line_col_index = \
-                                    _find_free_column(columns,
-                                                      empty_column,
-                                                      col_search_order,
-                                                      (rev_index + 1,))
-                                _mark_column_as_used(columns,
-                                                     child_line_col_index,
-                                                     (rev_index + 1,))
-
-                                # Recall _line_col_search_order to reset it back to
-                                # the beging.
-                                col_search_order = \
-                                        _line_col_search_order(columns,
-                                                               parent_col_index,
-                                                               col_index)
-                                parent_col_line_index = \
-                                    _find_free_column(columns,
-                                                      empty_column,
-                                                      col_search_order,
-                                                      (parent_index - 1,))
-                                _mark_column_as_used(columns,
-                                                     parent_col_line_index,
-                                                     (parent_index - 1,))
-                                lines.append((rev_index,
-                                              parent_index,
-                                              (child_line_col_index,
-                                               parent_col_line_index)))
-                            else :
-                                line_col_index = col_index
-                                if parent_index - rev_index >1:
-                                    line_range = range(rev_index + 1, parent_index)
-                                    line_col_index = \
-                                        _find_free_column(columns,
-                                                          empty_column,
-                                                          col_search_order,
-                                                          line_range)
-                                    _mark_column_as_used(columns,
-                                                         line_col_index,
-                                                         line_range)
-                                lines.append((rev_index,
-                                              parent_index,
-                                              (line_col_index,)))
+                    _add_parent_lines(linegraph, lines, columns, revid_index,
+                                      graph_parents[revid],
+                                      rev_index, branch_id,
+                                      broken_line_length)
         finally:
             progress_bar.finished()
 
-        update_root_progress(5)
+        update_root_progress(6)
         progress_bar = ui.ui_factory.nested_progress_bar()
         try:
-            progress_bar.update("Prettifying graph", 0, len(lines))
-            for i, (child_index, parent_index, line_col_indexes) in enumerate(lines):
-                if i % 25 == 0:
-                    progress_bar.update(None, i)
-                (child_col_index, child_color) = linegraph[child_index][1]
-                (parent_col_index, parent_color) = linegraph[parent_index][1]
-
-                if len(line_col_indexes) == 1:
-                    if parent_index - child_index == 1:
-                        linegraph[child_index][2].append(
-                            (child_col_index,
-                             parent_col_index,
-                             parent_color))
-                    else:
-                        # line from the child's column to the lines column
-                        linegraph[child_index][2].append(
-                            (child_col_index,
-                             line_col_indexes[0],
-                             parent_color))
-                        # lines down the line's column
-                        for line_part_index in range(child_index+1, parent_index-1):
-                            linegraph[line_part_index][2].append(
-                                (line_col_indexes[0], 
-                                 line_col_indexes[0],
-                                 parent_color))
-                        # line from the line's column to the parent's column
-                        linegraph[parent_index-1][2].append(
-                            (line_col_indexes[0],
-                             parent_col_index,
-                             parent_color))
-                else:
-                    # Broken line
-                    # line from the child's column to the lines column
-                    linegraph[child_index][2].append(
-                        (child_col_index,
-                         line_col_indexes[0],
-                         parent_color))
-                    # Broken line end
-                    linegraph[child_index+1][2].append(
-                        (line_col_indexes[0],
-                         None,
-                         parent_color))
-
-                    # Broken line end 
-                    linegraph[parent_index-2][2].append(
-                        (None,
-                         line_col_indexes[1],
-                         parent_color))
-                    # line from the line's column to the parent's column
-                    linegraph[parent_index-1][2].append(
-                        (line_col_indexes[1],
-                         parent_col_index,
-                         parent_color))
+            in_bands = processes > 1 and len(linegraph) >= PARALLEL_MIN_ROWS
+            if state is not None and not in_bands:
+                # The lines are kept whole, and never split into the
+                # segments of each row.
+                progress_bar.update("Prettifying graph")
+                compact_graph = CompactLineGraph(linegraph)
+                compact_graph.add_lines(linegraph, lines)
+            elif in_bands:
+                _add_line_segments_in_bands(linegraph, lines, processes,
+                                            progress_bar)
+            else:
+                progress_bar.update("Prettifying graph", 0, len(lines))
+                for i, (child_index, parent_index, line_col_indexes) in enumerate(lines):
+                    if i % 25 == 0:
+                        progress_bar.update(None, i)
+                    _add_line_segments(linegraph, child_index, parent_index,
+                                       line_col_indexes)
         finally:
             progress_bar.finished()
-        return (linegraph, revid_index, len(columns))
     else:
-        return (linegraph, revid_index, 0)
+        columns = []
+    if state is not None:
+        if not graph_data or in_bands:
+            compact_graph = CompactLineGraph(linegraph)
+        for row in linegraph:
+            row[2] = None
+        state.set(start_revs, maxnum, broken_line_length, graph_data,
+                  mainline_only, ghosts, linegraph, revid_index, len(columns),
+                  columns, graph=compact_graph)
+    return (linegraph, revid_index, len(columns))
+
+
+class LineGraphState(object):
+    """A line graph, with what update_linegraph() needs to extend it.
+
+    The rows in line_graph are like the ones returned by linegraph(), except
+    that their lines are None: the nodes and lines are kept in graph, a
+    CompactLineGraph.
+    """
+
+    def __init__(self):
+        self.start_revs = None
+        self.line_graph = None
+        self.graph = None
+        self.revid_index = None
+        self.columns = None
+        self._revno_depths = None
+        self._branch_counts = None
+
+    def set(self, start_revs, maxnum, broken_line_length, graph_data,
+            mainline_only, ghosts, line_graph, revid_index, columns_len,
+            columns=None, graph=None):
+        """Set the graph computed by linegraph() for these arguments.
+
+        :param ghosts: The ghosts in the ancestry of start_revs.
+        :param columns: The column occupancy used to lay out the graph, or
+            None if it is to be derived from the graph when needed.
+        :param graph: The CompactLineGraph for line_graph, whose rows then
+            have no lines. If None, it is built from the lines of line_graph,
+            which is left alone.
+        """
+        if graph is None:
+            graph = CompactLineGraph(line_graph)
+            line_graph = [[revid, node, None, parents, children,
+                           revno_sequence]
+                          for (revid, node, lines, parents, children,
+                               revno_sequence) in line_graph]
+        self.start_revs = list(start_revs)
+        self.maxnum = maxnum
+        self.broken_line_length = broken_line_length
+        self.graph_data = graph_data
+        self.mainline_only = mainline_only
+        self.ghosts = set(ghosts)
+        self.line_graph = line_graph
+        self.graph = graph
+        self.revid_index = revid_index
+        self.columns_len = columns_len
+        self.columns = columns
+        self._revno_depths = None
+        self._branch_counts = None
+
+    def get_result(self):
+        """Return the graph in the format returned by linegraph().
+
+        This builds all the lines again, so it should only be used for small
+        graphs.
+        """
+        graph = self.graph
+        line_graph = [[revid, node, graph.lines(rev_index), parents,
+                       children, revno_sequence]
+                      for rev_index, (revid, node, lines, parents, children,
+                                      revno_sequence)
+                      in enumerate(self.line_graph)]
+        return (line_graph, self.revid_index, self.columns_len)
+
+    def build_index(self):
+        """Compute the lookup tables update_linegraph() needs.
+
+        This is done on demand, but can take a while for a large graph, so
+        callers may want to do it in advance.
+        """
+        if self.columns is None:
+            self.columns = _columns_from_graph(self.graph)
+        if self._revno_depths is None:
+            # Rows are counted from the bottom, so the rows added on top by
+            # update_linegraph() do not change them.
+            row_count = len(self.line_graph)
+            self._revno_depths = dict(
+                (row[5], row_count - 1 - index)
+                for index, row in enumerate(self.line_graph))
+        if self._branch_counts is None:
+            self._branch_counts = _branch_counts(self.line_graph)
+
+    def revno_index(self, revno):
+        """Return the row index of revno, or None."""
+        depth = self._revno_depths.get(revno)
+        if depth is None:
+            return None
+        return len(self.line_graph) - 1 - depth
+
+
+def update_linegraph(graph, state, start_revs, broken_line_length=None,
+                     graph_data=True, mainline_only=False):
+    """Extend the line graph in state with the revisions added on top of it.
+
+    This works when start_revs is a single revision which has the previous
+    start revision in its left hand ancestry, as after a commit or a pull,
+    and the graph was computed in full with the same arguments. Only the new
+    revisions are laid out, the other rows keep their columns, so the result
+    may differ from what linegraph() would return for start_revs.
+
+    :return: None if the graph can not be extended and linegraph() has to be
+        used instead, in which case state is unchanged. Otherwise a tuple of
+        the number of rows that were inserted at the top of the graph and
+        the indexes of the old rows whose lines or children changed. The
+        rows of state are replaced rather than changed, so that a copy of
+        the previous state stays intact.
+    """
+    if (state.line_graph is None or state.maxnum or state.mainline_only
+        or not state.graph_data
+        or (broken_line_length, graph_data, mainline_only) !=
+           (state.broken_line_length, state.graph_data, state.mainline_only)
+        or len(start_revs) != 1 or len(state.start_revs) != 1):
+        return None
+    old_tip = state.start_revs[0]
+    new_tip = start_revs[0]
+    if new_tip == old_tip:
+        return (0, [])
+    old_revid_index = state.revid_index
+    if old_tip not in old_revid_index:
+        return None
+    ghosts = set(state.ghosts)
+    if ghosts and graph.get_parent_map(ghosts):
+        # A ghost has been filled in, so the old rows are out of date too.
+        return None
+
+    # Walk the ancestry of the new tip until we reach the old graph.
+    graph_parents = {}
+    pending = set([new_tip])
+    while pending:
+        parent_map = graph.get_parent_map(pending)
+        next_pending = set()
+        for revid in pending:
+            parent_revids = parent_map.get(revid)
+            if parent_revids is None:
+                ghosts.add(revid)
+                continue
+            if parent_revids == (NULL_REVISION,):
+                parent_revids = ()
+            graph_parents[revid] = parent_revids
+            for parent in parent_revids:
+                if (parent not in graph_parents and parent not in ghosts
+                    and parent not in old_revid_index):
+                    next_pending.add(parent)
+        pending = next_pending
+    graph_children = {}
+    for revid, parent_revids in graph_parents.items():
+        if [parent for parent in parent_revids if parent in ghosts]:
+            parent_revids = [parent for parent in parent_revids
+                             if parent not in ghosts]
+            graph_parents[revid] = parent_revids
+        for parent in parent_revids:
+            graph_children.setdefault(parent, []).append(revid)
+
+    # The old tip has to be on the mainline of the new one, or the old rows
+    # would move around.
+    revid = new_tip
+    while revid in graph_parents:
+        if not graph_parents[revid]:
+            return None
+        revid = graph_parents[revid][0]
+    if revid != old_tip:
+        return None
+
+    state.build_index()
+    old_rows = state.line_graph
+
+    # merge_sort puts the new revisions above the old ones, and numbers the
+    # old ones as before. Number the new ones by carrying on from where the
+    # previous merge_sort stopped.
+    graph_parents["top:"] = [new_tip]
+    sorter = MergeSorter(graph_parents, "top:", generate_revno=True)
+    for parent_revids in graph_parents.itervalues():
+        if not parent_revids or parent_revids[0] not in old_revid_index:
+            continue
+        parent = parent_revids[0]
+        old_row = old_rows[old_revid_index[parent]]
+        has_first_child = (parent != old_tip and
+            [child for child in old_row[4]
+             if old_rows[old_revid_index[child]][3][0] == parent])
+        sorter._revnos[parent] = [old_row[5], not has_first_child]
+    sorter._revno_to_branch_count.update(state._branch_counts)
+    merge_sorted_revisions = sorter.sorted()
+    assert merge_sorted_revisions[0][1] == "top:"
+    merge_sorted_revisions = merge_sorted_revisions[1:]
+    added = len(merge_sorted_revisions)
+
+    linegraph = []
+    branch_lines = {}
+    for (rev_index, (sequence_number, revid, merge_depth, revno_sequence,
+         end_of_merge)) in enumerate(merge_sorted_revisions):
+        linegraph.append([revid,
+                          None,
+                          [],
+                          graph_parents[revid],
+                          graph_children.get(revid, []),
+                          revno_sequence])
+        branch_lines.setdefault(revno_sequence[0:-1], []).append(rev_index)
+    linegraph.extend(old_rows)
+    revid_index = dict(izip(imap(itemgetter(0), linegraph), count()))
+    new_revno_index = dict((linegraph[rev_index][5], rev_index)
+                           for rev_index in range(added))
+    def revno_index(revno):
+        try:
+            return new_revno_index[revno]
+        except KeyError:
+            old_index = state.revno_index(revno)
+            if old_index is not None:
+                old_index += added
+            return old_index
+
+    # Make room for the new rows in the columns of the old ones.
+    columns = [column.shifted(added) for column in state.columns]
+    if not columns:
+        columns.append(_Column())
+
+    lines = []
+    branch_ids = branch_lines.keys()
+    branch_ids.sort(_branch_id_cmp)
+    for branch_id in branch_ids:
+        branch_line = branch_lines[branch_id]
+        revno_sequence = linegraph[branch_line[-1]][5]
+        previous_revno = revno_sequence[:-1] + (revno_sequence[-1] - 1,)
+        continued_index = revno_index(previous_revno)
+        if continued_index is not None:
+            # The branch carries on from an old row, try to keep using its
+            # column.
+            parent_col_index = linegraph[continued_index][1][0]
+            line_range = _branch_line_range(branch_line, continued_index,
+                                            broken_line_length)
+        else:
+            parent_col_index = 0
+            parent_index = None
+            if len(branch_id) > 1:
+                parent_index = revno_index(branch_id[0:-1])
+                if parent_index is not None:
+                    parent_node = linegraph[parent_index][1]
+                    if parent_node:
+                        parent_col_index = parent_node[0]
+            line_range = _branch_line_range(branch_line, parent_index,
+                                            broken_line_length)
+        col_search_order = _branch_line_col_search_order(columns,
+                                                         parent_col_index)
+        color = reduce(lambda x, y: x+y, branch_id, 0)
+        col_index = _find_free_column(columns, col_search_order, line_range)
+        node = (col_index, color)
+        for rev_index in branch_line:
+            linegraph[rev_index][1] = node
+        _mark_column_as_used(columns, col_index, _row_runs(branch_line))
+        for rev_index in branch_line:
+            _add_parent_lines(linegraph, lines, columns, revid_index,
+                              linegraph[rev_index][3], rev_index, branch_id,
+                              broken_line_length)
+
+    # The old rows are shared with state.line_graph, copy the ones that
+    # change so that state is untouched until we are done.
+    changed = set()
+    for revid in graph_children:
+        rev_index = revid_index.get(revid)
+        if rev_index is not None and rev_index >= added:
+            changed.add(rev_index)
+    for child_index, parent_index, line_col_indexes in lines:
+        if len(line_col_indexes) == 1:
+            changed.update(range(max(child_index, added), parent_index))
+        else:
+            changed.update([child_index, child_index + 1, parent_index - 2,
+                            parent_index - 1])
+    changed = sorted(rev_index for rev_index in changed
+                     if rev_index >= added)
+    for rev_index in changed:
+        (revid, node, row_lines, parents, children,
+         revno_sequence) = linegraph[rev_index]
+        children = children + graph_children.get(revid, [])
+        linegraph[rev_index] = [revid, node, None, parents, children,
+                                revno_sequence]
+    # The new lines go after the old ones in the rows they share.
+    compact_graph = state.graph.extended(linegraph, added, [], lines)
+    for rev_index in range(added):
+        linegraph[rev_index][2] = None
+
+    row_count = len(linegraph)
+    for rev_index in range(added):
+        state._revno_depths[linegraph[rev_index][5]] = (
+            row_count - 1 - rev_index)
+    state._branch_counts = sorter._revno_to_branch_count
+    state.start_revs = list(start_revs)
+    state.ghosts = ghosts
+    state.line_graph = linegraph
+    state.graph = compact_graph
+    state.revid_index = revid_index
+    state.columns_len = len(columns)
+    state.columns = columns
+    return (added, changed)
+
+
+class PagedLineGraph(object):
+    """A line graph that is laid out a page of rows at a time.
+
+    The whole ancestry is merge sorted up front, as linegraph() does, but the
+    nodes and lines are only placed when extend() is asked for more rows, so
+    that the top of a large graph can be shown before the rest is laid out.
+    A branch line gets its column when its first row is laid out, and the
+    column occupancy covers every row, so laying out more rows never moves
+    the ones that are done. With a single page, the result is the same as
+    the one of linegraph().
+
+    :ivar line_graph: The rows of the whole graph, without lines as in a
+        LineGraphState. Only the first laid_out rows are in graph.
+    :ivar graph: The CompactLineGraph of the rows laid out so far.
+    """
+
+    def __init__(self, graph, start_revs, broken_line_length=None,
+                 mainline_only=False, root_progress=None):
+        assert isinstance(start_revs, list)
+        def update_root_progress(step_number):
+            """IFF our container received a root progress bar, then update it."""
+            if root_progress is not None:
+                root_progress.update(None, step_number)
+
+        (graph_parents, self._graph_children, self._ghosts,
+         merge_sorted_revisions) = _merge_sorted_ancestry(graph, start_revs,
+                                                          mainline_only,
+                                                          update_root_progress)
+        self._start_revs = start_revs
+        self._broken_line_length = broken_line_length
+        self._mainline_only = mainline_only
+        self.line_graph = []
+        self.revid_index = {}
+        self._revno_index = {}
+        self._branch_lines = {}
+        for (rev_index, (sequence_number, revid, merge_depth, revno_sequence,
+             end_of_merge)) in enumerate(merge_sorted_revisions):
+            self.revid_index[revid] = rev_index
+            self._revno_index[revno_sequence] = rev_index
+            self._branch_lines.setdefault(revno_sequence[0:-1],
+                                          []).append(rev_index)
+            self.line_graph.append([revid,
+                                    None,
+                                    [],
+                                    graph_parents[revid],
+                                    None,
+                                    revno_sequence])
+        self.graph = CompactLineGraph()
+        self._columns = [_Column()]
+        self.laid_out = 0
+
+    @property
+    def columns_len(self):
+        return len(self._columns)
+
+    def is_complete(self):
+        return self.laid_out == len(self.line_graph)
+
+    def extend(self, rows):
+        """Lay out the next rows rows of the graph, and add them to graph."""
+        linegraph = self.line_graph
+        start = self.laid_out
+        end = min(start + rows, len(linegraph))
+        if start == end:
+            return
+        broken_line_length = self._broken_line_length
+        columns = self._columns
+        lines = []
+        branch_ids = list(set(linegraph[rev_index][5][0:-1]
+                              for rev_index in xrange(start, end)))
+        branch_ids.sort(_branch_id_cmp)
+        for branch_id in branch_ids:
+            branch_line = self._branch_lines[branch_id]
+            if linegraph[branch_line[0]][1] is None:
+                _place_branch_line(linegraph, columns, self._revno_index,
+                                   branch_id, branch_line,
+                                   broken_line_length)
+            for rev_index in branch_line[bisect_left(branch_line, start):
+                                         bisect_left(branch_line, end)]:
+                row = linegraph[rev_index]
+                row[4] = self._graph_children[row[0]]
+                _add_parent_lines(linegraph, lines, columns,
+                                  self.revid_index, row[3], rev_index,
+                                  branch_id, broken_line_length)
+
+        # The lines can go down to branch lines that have no rows in this
+        # page, which need their columns before the lines can be drawn.
+        branch_ids = list(set(linegraph[parent_index][5][0:-1]
+                              for (child_index, parent_index,
+                                   line_col_indexes) in lines
+                              if linegraph[parent_index][1] is None))
+        branch_ids.sort(_branch_id_cmp)
+        for branch_id in branch_ids:
+            _place_branch_line(linegraph, columns, self._revno_index,
+                               branch_id, self._branch_lines[branch_id],
+                               broken_line_length)
+        self.graph.add_lines(linegraph, lines)
+
+        # The lines of the rows further down are not complete until their
+        # page is laid out, but no line from a later page goes through the
+        # rows of this one.
+        self.graph._append_rows(linegraph[start:end])
+        for rev_index in xrange(start, end):
+            linegraph[rev_index][2] = None
+        self.laid_out = end
+
+    def get_state(self):
+        """Return a LineGraphState for the graph, once it is complete."""
+        assert self.is_complete()
+        state = LineGraphState()
+        state.set(self._start_revs, None, self._broken_line_length, True,
+                  self._mainline_only, self._ghosts, self.line_graph,
+                  self.revid_index, self.columns_len, self._columns,
+                  graph=self.graph)
+        return state
+
+
+def _merge_sorted_ancestry(graph, start_revs, mainline_only,
+                           update_root_progress):
+    """Return the ancestry of start_revs, in merge_sort order.
+
+    With mainline_only, only the mainline of start_revs[0] is read, see
+    _mainline_ancestry().
+
+    :return: A tuple of (graph_parents, graph_children, ghosts,
+        merge_sorted_revisions). Ghosts are left out of graph_parents.
+    """
+    if mainline_only:
+        return _mainline_ancestry(graph, start_revs, update_root_progress)
+    graph_parents = {}
+    ghosts = set()
+    # The revisions that have ghosts as parents. A ghost can show up before
+    # or after its children, so their parents are filtered once the walk is
+    # done, each child only once.
+    ghost_children = set()
+    graph_children = {}
+    update_root_progress(1)
+    progress_bar = ui.ui_factory.nested_progress_bar()
+    try:
+        progress_bar.update("Arranging tree fragments")
+        for i, (revid, parent_revids) in enumerate(graph.iter_ancestry(start_revs)):
+            if i % 25 == 0:
+                if ghosts:
+                    progress_bar.update("Arranging tree fragments, %d ghosts"
+                                        % len(ghosts))
+                else:
+                    progress_bar.tick()
+            if parent_revids is None:
+                ghosts.add(revid)
+                ghost_children.update(graph_children.get(revid, ()))
+                continue
+            if parent_revids == (NULL_REVISION,):
+                graph_parents[revid] = ()
+            else:
+                graph_parents[revid] = parent_revids
+            for parent in parent_revids:
+                graph_children.setdefault(parent, []).append(revid)
+                if parent in ghosts:
+                    ghost_children.add(revid)
+            graph_children.setdefault(revid, [])
+    finally:
+        progress_bar.finished()
+
+    update_root_progress(2)
+    progress_bar = ui.ui_factory.nested_progress_bar()
+    try:
+        progress_bar.update("Removing %d ghosts" % len(ghosts), 0,
+                            len(ghost_children))
+        for i, ghost_child in enumerate(ghost_children):
+            if i % 25 == 0:
+                progress_bar.update(None, i)
+            graph_parents[ghost_child] = [p for p in graph_parents[ghost_child]
+                                          if p not in ghosts]
+    finally:
+        progress_bar.finished()
+    graph_parents["top:"] = start_revs
+
+    update_root_progress(3)
+    if len(graph_parents)>0:
+        merge_sorted_revisions = merge_sort(
+            graph_parents,
+            "top:",
+            generate_revno=True)
+    else:
+        merge_sorted_revisions = ()
+
+    assert merge_sorted_revisions[0][1] == "top:"
+    return (graph_parents, graph_children, ghosts,
+            merge_sorted_revisions[1:])
+
+
+def _mainline_ancestry(graph, start_revs, update_root_progress):
+    """Return the mainline of start_revs[0], as _merge_sorted_ancestry() does.
+
+    Only the left hand ancestry is walked, and the other parents of each
+    revision are checked for ghosts, so this takes time and memory in
+    proportion to the length of the mainline rather than to the whole
+    ancestry. The children of each revision are only the ones on the
+    mainline.
+    """
+    graph_parents = {}
+    ghosts = set()
+    mainline = []
+    update_root_progress(1)
+    progress_bar = ui.ui_factory.nested_progress_bar()
+    try:
+        progress_bar.update("Walking the mainline")
+        candidates = start_revs[:1]
+        while candidates:
+            if len(mainline) % 25 == 0:
+                progress_bar.tick()
+            revid = candidates.pop(0)
+            parent_revids = graph.get_parent_map([revid]).get(revid)
+            if parent_revids is None:
+                # As ghosts are removed, the mainline carries on through the
+                # next parent of the child.
+                ghosts.add(revid)
+                continue
+            if parent_revids == (NULL_REVISION,):
+                parent_revids = ()
+            graph_parents[revid] = parent_revids
+            mainline.append(revid)
+            candidates = list(parent_revids)
+    finally:
+        progress_bar.finished()
+
+    update_root_progress(2)
+    merged = set()
+    for parent_revids in graph_parents.itervalues():
+        merged.update(parent_revids[1:])
+    merged.difference_update(graph_parents)
+    ghosts.update(merged.difference(graph.get_parent_map(merged)))
+    graph_children = dict((revid, []) for revid in mainline)
+    for revid in mainline:
+        parent_revids = graph_parents[revid]
+        if ghosts.intersection(parent_revids):
+            parent_revids = [p for p in parent_revids if p not in ghosts]
+            graph_parents[revid] = parent_revids
+        for parent in parent_revids:
+            if parent in graph_children:
+                graph_children[parent].append(revid)
+
+    update_root_progress(3)
+    revno = len(mainline)
+    merge_sorted_revisions = [(sequence_number, revid, 0,
+                               (revno - sequence_number,), True)
+                              for sequence_number, revid
+                              in enumerate(mainline)]
+    return (graph_parents, graph_children, ghosts, merge_sorted_revisions)
+
+
+def _branch_id_cmp(x, y):
+    """Compaire branch_id's first by the number of digits, then reversed
+    by their value"""
+    len_x = len(x)
+    len_y = len(y)
+    if len_x == len_y:
+        return -cmp(x, y)
+    return cmp(len_x, len_y)
+
+
+def _branch_counts(line_graph):
+    """Return the number of branches merge_sort numbered off each revno."""
+    branch_counts = {}
+    for row in line_graph:
+        revno_sequence = row[5]
+        if len(revno_sequence) == 1:
+            branch_counts.setdefault(0, 0)
+        else:
+            base_revno, branch_count = revno_sequence[0], revno_sequence[1]
+            if branch_count > branch_counts.get(base_revno, 0):
+                branch_counts[base_revno] = branch_count
+    return branch_counts
+
+
+def _columns_from_graph(graph):
+    """Work out the column occupancy linegraph() used for a CompactLineGraph.
+
+    Every cell that has a node, or that a line runs into, is in use.
+    """
+    row_count = len(graph)
+    node_columns = graph.node_columns
+    offsets = graph.offsets
+    segments = graph.segments
+    columns = []
+    def use(col_index, rev_index):
+        while col_index >= len(columns):
+            columns.append(_Column())
+        columns[col_index].use(rev_index, rev_index)
+    for rev_index in xrange(row_count):
+        if node_columns[rev_index] >= 0:
+            use(node_columns[rev_index], rev_index)
+        if rev_index + 1 < row_count:
+            for i in xrange(offsets[rev_index] + 1, offsets[rev_index + 1],
+                            3):
+                if segments[i] >= 0:
+                    use(segments[i], rev_index + 1)
+    offset = graph._offset
+    for line_id in xrange(len(graph.line_children)):
+        child_index = graph.line_children[line_id] + offset
+        parent_index = graph.line_parents[line_id] + offset
+        if graph.line_broken_columns[line_id] < 0:
+            if parent_index - child_index > 1:
+                # The line runs down its column from the row after the child
+                # to the one before the parent.
+                runs = [(graph.line_columns[line_id], child_index + 1,
+                         parent_index - 1)]
+            else:
+                runs = []
+        else:
+            runs = [(graph.line_columns[line_id], child_index + 1,
+                     child_index + 1),
+                    (graph.line_broken_columns[line_id], parent_index - 1,
+                     parent_index - 1)]
+        for col_index, start, end in runs:
+            while col_index >= len(columns):
+                columns.append(_Column())
+            columns[col_index].use(start, end)
+    return columns
+
+
+# The rows covered by each bucket of the index of the lines of a
+# CompactLineGraph.
+LINE_BUCKET_ROWS = 16
+
+
+class CompactLineGraph(object):
+    """The nodes and lines of a line graph, packed into arrays of integers.
+
+    node_columns and node_colours hold the node of each row, with a column of
+    -1 for rows without a node. The lines of all rows are kept in segments,
+    as consecutive (start, end, colour) integers, where a column of -1 stands
+    for None. The lines of row i are in segments[offsets[i]:offsets[i + 1]].
+
+    Lines added with add_lines() are kept whole instead, one entry per line
+    in each of the line_* arrays, and are only split into the segments of a
+    row when lines() is asked for it. A line that runs down many rows then
+    takes as little room as a short one. Their rows are stored less _offset,
+    so that rows can be inserted at the top without renumbering them.
+    """
+
+    ARRAYS = ('node_columns', 'node_colours', 'offsets', 'segments',
+              'line_children', 'line_parents', 'line_starts', 'line_ends',
+              'line_columns', 'line_broken_columns', 'line_colours')
+
+    def __init__(self, line_graph=()):
+        for name in self.ARRAYS:
+            setattr(self, name, array('i'))
+        self.offsets.append(0)
+        self._offset = 0
+        # The ids of the lines that cross each bucket of LINE_BUCKET_ROWS
+        # rows, in the order they were added.
+        self._buckets = {}
+        self._append_rows(line_graph)
+
+    def __len__(self):
+        return len(self.node_columns)
+
+    def _append_rows(self, rows):
+        """Append the nodes and lines of rows, as returned by linegraph()."""
+        nodes = [row[1] or (-1, 0) for row in rows]
+        self.node_columns.fromlist([node[0] for node in nodes])
+        self.node_colours.fromlist([node[1] for node in nodes])
+        self._append_lines([row[2] for row in rows])
+
+    def _append_lines(self, row_lines):
+        """Append the lines of a list of rows."""
+        offsets = self.offsets
+        offset = offsets[-1]
+        for lines in row_lines:
+            offset += 3 * len(lines)
+            offsets.append(offset)
+        segments = list(chain.from_iterable(chain.from_iterable(row_lines)))
+        # The ends of broken lines are None.
+        i = -1
+        try:
+            while True:
+                i = segments.index(None, i + 1)
+                segments[i] = -1
+        except ValueError:
+            pass
+        self.segments.fromlist(segments)
+
+    def _copy_lines(self, graph, start, end):
+        """Append the lines of rows start to end - 1 of graph."""
+        begin = graph.offsets[start]
+        shift = len(self.segments) - begin
+        self.segments.extend(graph.segments[begin:graph.offsets[end]])
+        self.offsets.extend([offset + shift
+                             for offset in graph.offsets[start + 1:end + 1]])
+
+    def add_lines(self, line_graph, lines):
+        """Add lines found by _add_parent_lines() to the rows they cross.
+
+        The rows of the lines need not have been appended yet, the nodes
+        they start and end at are taken from line_graph.
+        """
+        offset = self._offset
+        line_id = len(self.line_children)
+        children = []
+        parents = []
+        starts = []
+        ends = []
+        line_columns = []
+        broken_columns = []
+        colours = []
+        buckets = self._buckets
+        for child_index, parent_index, line_col_indexes in lines:
+            child_row = child_index - offset
+            parent_row = parent_index - offset
+            children.append(child_row)
+            parents.append(parent_row)
+            starts.append(line_graph[child_index][1][0])
+            (end, colour) = line_graph[parent_index][1]
+            ends.append(end)
+            colours.append(colour)
+            line_columns.append(line_col_indexes[0])
+            if len(line_col_indexes) == 1:
+                broken_columns.append(-1)
+                bucket_indexes = xrange(child_row // LINE_BUCKET_ROWS,
+                    (parent_row - 1) // LINE_BUCKET_ROWS + 1)
+            else:
+                broken_columns.append(line_col_indexes[1])
+                # A broken line only has segments next to its ends.
+                bucket_indexes = set([child_row // LINE_BUCKET_ROWS,
+                                      (child_row + 1) // LINE_BUCKET_ROWS,
+                                      (parent_row - 2) // LINE_BUCKET_ROWS,
+                                      (parent_row - 1) // LINE_BUCKET_ROWS])
+            for bucket_index in bucket_indexes:
+                bucket = buckets.get(bucket_index)
+                if bucket is None:
+                    bucket = buckets[bucket_index] = array('i')
+                bucket.append(line_id)
+            line_id += 1
+        self.line_children.fromlist(children)
+        self.line_parents.fromlist(parents)
+        self.line_starts.fromlist(starts)
+        self.line_ends.fromlist(ends)
+        self.line_columns.fromlist(line_columns)
+        self.line_broken_columns.fromlist(broken_columns)
+        self.line_colours.fromlist(colours)
+
+    def _index_lines(self):
+        """Rebuild the buckets of the lines, after loading the arrays."""
+        self._buckets = {}
+        line_children = self.line_children
+        line_parents = self.line_parents
+        line_broken_columns = self.line_broken_columns
+        for line_id in xrange(len(line_children)):
+            child_row = line_children[line_id]
+            parent_row = line_parents[line_id]
+            if line_broken_columns[line_id] < 0:
+                bucket_indexes = xrange(child_row // LINE_BUCKET_ROWS,
+                    (parent_row - 1) // LINE_BUCKET_ROWS + 1)
+            else:
+                bucket_indexes = set([child_row // LINE_BUCKET_ROWS,
+                                      (child_row + 1) // LINE_BUCKET_ROWS,
+                                      (parent_row - 2) // LINE_BUCKET_ROWS,
+                                      (parent_row - 1) // LINE_BUCKET_ROWS])
+            for bucket_index in bucket_indexes:
+                self._buckets.setdefault(bucket_index,
+                                         array('i')).append(line_id)
+
+    def _copy_line_records(self, graph, rows):
+        """Take over the lines of graph, with rows inserted at the top."""
+        for name in self.ARRAYS[4:]:
+            setattr(self, name, array('i', getattr(graph, name)))
+        self._offset = graph._offset + rows
+        self._buckets = dict((bucket_index, array('i', bucket))
+                             for bucket_index, bucket
+                             in graph._buckets.iteritems())
+
+    def node(self, index):
+        """Return the (column, colour) node of row index, or None."""
+        column = self.node_columns[index]
+        if column < 0:
+            return None
+        return (column, self.node_colours[index])
+
+    def lines(self, index):
+        """Return the lines of row index, as linegraph() does."""
+        segments = self.segments
+        lines = []
+        for i in xrange(self.offsets[index], self.offsets[index + 1], 3):
+            start = segments[i]
+            end = segments[i + 1]
+            if start < 0:
+                start = None
+            if end < 0:
+                end = None
+            lines.append((start, end, segments[i + 2]))
+        row = index - self._offset
+        bucket = self._buckets.get(row // LINE_BUCKET_ROWS)
+        if bucket:
+            line_children = self.line_children
+            line_parents = self.line_parents
+            line_broken_columns = self.line_broken_columns
+            for line_id in bucket:
+                child_row = line_children[line_id]
+                parent_row = line_parents[line_id]
+                if row < child_row or row >= parent_row:
+                    continue
+                # The segments _add_line_segments() adds to the row.
+                line_column = self.line_columns[line_id]
+                colour = self.line_colours[line_id]
+                broken_column = line_broken_columns[line_id]
+                if broken_column < 0:
+                    if row == child_row:
+                        if parent_row - child_row == 1:
+                            line_column = self.line_ends[line_id]
+                        lines.append((self.line_starts[line_id], line_column,
+                                      colour))
+                    elif row < parent_row - 1:
+                        lines.append((line_column, line_column, colour))
+                    else:
+                        lines.append((line_column, self.line_ends[line_id],
+                                      colour))
+                else:
+                    if row == child_row:
+                        lines.append((self.line_starts[line_id], line_column,
+                                      colour))
+                    if row == child_row + 1:
+                        lines.append((line_column, None, colour))
+                    if row == parent_row - 2:
+                        lines.append((None, broken_column, colour))
+                    if row == parent_row - 1:
+                        lines.append((broken_column, self.line_ends[line_id],
+                                      colour))
+        return lines
+
+    def extended(self, line_graph, added, changed, lines=()):
+        """Return the graph for line_graph, as extended by update_linegraph().
+
+        :param added: The number of rows at the top of line_graph that are
+            new. Their lines are taken from line_graph, as are the ones of
+            the changed rows. The other rows are copied from this graph.
+        :param changed: The sorted indexes of the changed rows.
+        :param lines: The new lines, as for add_lines(). They are added after
+            the ones of this graph.
+        """
+        graph = CompactLineGraph(line_graph[:added])
+        graph._copy_line_records(self, added)
+        graph.add_lines(line_graph, lines)
+        graph.node_columns.extend(self.node_columns)
+        graph.node_colours.extend(self.node_colours)
+        old_index = 0
+        for rev_index in changed:
+            graph._copy_lines(self, old_index, rev_index - added)
+            graph._append_lines([line_graph[rev_index][2]])
+            old_index = rev_index - added + 1
+        graph._copy_lines(self, old_index, len(self))
+        return graph
+
+
+def _place_branch_line(linegraph, columns, revno_index, branch_id,
+                       branch_line, broken_line_length):
+    """Find a column for the nodes of a branch line, and set them."""
+    # Find the col_index for the direct parent branch. This will be the
+    # starting point when looking for a free column.
+    parent_col_index = 0
+    parent_index = None
+    if len(branch_id) > 1:
+        parent_revno = branch_id[0:-1]
+        if parent_revno in revno_index:
+            parent_index = revno_index[parent_revno]
+            parent_node = linegraph[parent_index][1]
+            if parent_node:
+                parent_col_index = parent_node[0]
+
+    col_search_order = _branch_line_col_search_order(columns,
+                                                     parent_col_index)
+    color = reduce(lambda x, y: x+y, branch_id, 0)
+
+    line_range = _branch_line_range(branch_line, parent_index,
+                                    broken_line_length)
+
+    col_index = _find_free_column(columns,
+                                  col_search_order,
+                                  line_range)
+    node = (col_index, color)
+    for rev_index in branch_line:
+        linegraph[rev_index][1] = node
+    _mark_column_as_used(columns, col_index, _row_runs(branch_line))
+
+
+def _branch_line_range(branch_line, parent_index, broken_line_length):
+    """Return the rows a branch line needs to be free to be drawn in a column.
+
+    :param branch_line: The row indexes of the revisions of the branch.
+    :param parent_index: The row index where the branch starts from.
+    :return: A list of (start, end) row ranges, see _Column.
+    """
+    line_range = []
+    def add(start, end):
+        if line_range and line_range[-1][1] + 1 >= start:
+            if end > line_range[-1][1]:
+                line_range[-1] = (line_range[-1][0], end)
+        elif start <= end:
+            line_range.append((start, end))
+    last_rev_index = None
+    for rev_index in branch_line:
+        if last_rev_index:
+            if broken_line_length and \
+               rev_index - last_rev_index > broken_line_length:
+                add(last_rev_index+1, last_rev_index+1)
+                add(rev_index-1, rev_index-1)
+            else:
+                add(last_rev_index+1, rev_index-1)
+
+        add(rev_index, rev_index)
+        last_rev_index = rev_index
+
+    if parent_index:
+        if broken_line_length and \
+           parent_index - last_rev_index > broken_line_length:
+            add(last_rev_index+1, last_rev_index+1)
+        else:
+            add(last_rev_index+1, parent_index-1)
+    return line_range
+
+
+def _row_runs(rows):
+    """Return the sorted row indexes rows as (start, end) row ranges."""
+    runs = []
+    for row in rows:
+        if runs and runs[-1][1] + 1 == row:
+            runs[-1] = (runs[-1][0], row)
+        else:
+            runs.append((row, row))
+    return runs
+
+
+def _add_parent_lines(linegraph, lines, columns, revid_index, parents,
+                      rev_index, branch_id, broken_line_length):
+    """Find columns for the lines from rev_index to its parents.
+
+    The lines are added to lines as (child_index, parent_index,
+    line_col_indexes) tuples, for _add_line_segments().
+    """
+    col_index = linegraph[rev_index][1][0]
+    for parent_revid in parents:
+        if parent_revid in revid_index:
+
+            parent_index = revid_index[parent_revid]
+            parent_node = linegraph[parent_index][1]
+            if parent_node:
+                parent_col_index = parent_node[0]
+            else:
+                parent_col_index = None
+            col_search_order = \
+                    _line_col_search_order(columns,
+                                           parent_col_index,
+                                           col_index)
+
+            # If this line is really long, break it.
+            if len(branch_id) > 0 and \
+               broken_line_length and \
+               parent_index - rev_index > broken_line_length:
+                child_line_range = ((rev_index + 1, rev_index + 1),)
+                child_line_col_index = \
+                    _find_free_column(columns,
+                                      col_search_order,
+                                      child_line_range)
+                _mark_column_as_used(columns,
+                                     child_line_col_index,
+                                     child_line_range)
+
+                # Recall _line_col_search_order to reset it back to
+                # the beging.
+                col_search_order = \
+                        _line_col_search_order(columns,
+                                               parent_col_index,
+                                               col_index)
+                parent_line_range = ((parent_index - 1, parent_index - 1),)
+                parent_col_line_index = \
+                    _find_free_column(columns,
+                                      col_search_order,
+                                      parent_line_range)
+                _mark_column_as_used(columns,
+                                     parent_col_line_index,
+                                     parent_line_range)
+                lines.append((rev_index,
+                              parent_index,
+                              (child_line_col_index,
+                               parent_col_line_index)))
+            else :
+                line_col_index = col_index
+                if parent_index - rev_index >1:
+                    line_range = ((rev_index + 1, parent_index - 1),)
+                    line_col_index = \
+                        _find_free_column(columns,
+                                          col_search_order,
+                                          line_range)
+                    _mark_column_as_used(columns,
+                                         line_col_index,
+                                         line_range)
+                lines.append((rev_index,
+                              parent_index,
+                              (line_col_index,)))
+
+
+def _add_line_segments(linegraph, child_index, parent_index,
+                       line_col_indexes):
+    """Add the segments of a line found by _add_parent_lines to the rows."""
+    (child_col_index, child_color) = linegraph[child_index][1]
+    (parent_col_index, parent_color) = linegraph[parent_index][1]
+
+    if len(line_col_indexes) == 1:
+        if parent_index - child_index == 1:
+            linegraph[child_index][2].append(
+                (child_col_index,
+                 parent_col_index,
+                 parent_color))
+        else:
+            # line from the child's column to the lines column
+            linegraph[child_index][2].append(
+                (child_col_index,
+                 line_col_indexes[0],
+                 parent_color))
+            # lines down the line's column, which can all share a segment
+            segment = (line_col_indexes[0], line_col_indexes[0], parent_color)
+            for line_part_index in xrange(child_index+1, parent_index-1):
+                linegraph[line_part_index][2].append(segment)
+            # line from the line's column to the parent's column
+            linegraph[parent_index-1][2].append(
+                (line_col_indexes[0],
+                 parent_col_index,
+                 parent_color))
+    else:
+        # Broken line
+        # line from the child's column to the lines column
+        linegraph[child_index][2].append(
+            (child_col_index,
+             line_col_indexes[0],
+             parent_color))
+        # Broken line end
+        linegraph[child_index+1][2].append(
+            (line_col_indexes[0],
+             None,
+             parent_color))
+
+        # Broken line end 
+        linegraph[parent_index-2][2].append(
+            (None,
+             line_col_indexes[1],
+             parent_color))
+        # line from the line's column to the parent's column
+        linegraph[parent_index-1][2].append(
+            (line_col_indexes[1],
+             parent_col_index,
+             parent_color))
+
+
+class _BandRows(object):
+    """The rows of a band of a line graph, for _add_line_segments().
+
+    Only the nodes that the lines of the band start and end at are known.
+    Segments that fall outside of the band are dropped, the bands that hold
+    their rows add them.
+    """
+
+    def __init__(self, start, end, nodes):
+        self.start = start
+        self.nodes = nodes
+        self.segments = [[] for rev_index in xrange(start, end)]
+
+    def __getitem__(self, rev_index):
+        if self.start <= rev_index < self.start + len(self.segments):
+            row_segments = self.segments[rev_index - self.start]
+        else:
+            row_segments = []
+        return (None, self.nodes.get(rev_index), row_segments)
+
+
+def _band_line_segments(band):
+    """Return the segments the lines of band add to each of its rows."""
+    (start, end, lines, nodes) = band
+    rows = _BandRows(start, end, nodes)
+    for child_index, parent_index, line_col_indexes in lines:
+        _add_line_segments(rows, child_index, parent_index, line_col_indexes)
+    return rows.segments
+
+
+def _add_line_segments_in_bands(linegraph, lines, processes, progress_bar):
+    """Add the segments of lines to the rows, in a pool of processes.
+
+    The rows are split into bands of consecutive rows. Each band gets the
+    lines that cross it, in order, so the segments of each row come back in
+    the order _add_line_segments() would have added them.
+    """
+    import multiprocessing
+    band_size = -(-len(linegraph) // (processes * 4))
+    bands = [(start, min(start + band_size, len(linegraph)), [], {})
+             for start in xrange(0, len(linegraph), band_size)]
+    for line in lines:
+        (child_index, parent_index, line_col_indexes) = line
+        if len(line_col_indexes) == 1:
+            band_indexes = xrange(child_index // band_size,
+                                  (parent_index - 1) // band_size + 1)
+        else:
+            # A broken line only adds segments next to its ends.
+            band_indexes = set([child_index // band_size,
+                                (child_index + 1) // band_size,
+                                (parent_index - 2) // band_size,
+                                (parent_index - 1) // band_size])
+        for band_index in band_indexes:
+            (start, end, band_lines, nodes) = bands[band_index]
+            band_lines.append(line)
+            nodes[child_index] = linegraph[child_index][1]
+            nodes[parent_index] = linegraph[parent_index][1]
+
+    progress_bar.update("Prettifying graph", 0, len(bands))
+    pool = multiprocessing.Pool(processes)
+    try:
+        for i, segments in enumerate(pool.imap(_band_line_segments, bands)):
+            progress_bar.update(None, i)
+            for rev_index, row_segments in enumerate(segments, bands[i][0]):
+                linegraph[rev_index][2].extend(row_segments)
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 def _branch_line_col_search_order(columns, parent_col_index):
@@ -399,26 +1345,83 @@ def _line_col_search_order(columns, parent_col_index, child_col_index):
             yield min_index - i
         i += 1
 
-def _find_free_column(columns, empty_column, col_search_order, line_range):
+def _find_free_column(columns, col_search_order, line_range):
     for col_index in col_search_order:
-        column = columns[col_index]
-        has_overlaping_line = False
-        for row_index in line_range:
-            if column[row_index]:
-                has_overlaping_line = True
-                break
-        if not has_overlaping_line:
+        if columns[col_index].is_free(line_range):
             break
     else:
         col_index = len(columns)
-        column = list(empty_column)
-        columns.append(column)
+        columns.append(_Column())
     return col_index
 
 def _mark_column_as_used(columns, col_index, line_range):
     column = columns[col_index]
-    for row_index in line_range:
-        column[row_index] = True
+    for start, end in line_range:
+        column.use(start, end)
+
+
+class _Column(object):
+    """The rows of a graph column that contain a node or line.
+
+    They are kept as sorted lists of the first and last row of each run of
+    used rows, so that checking or marking a range of rows takes O(log n), and
+    the memory used depends on the number of runs rather than the number of
+    rows in the graph.
+    """
+
+    __slots__ = ('_starts', '_ends', '_offset')
+
+    def __init__(self, starts=None, ends=None, offset=0):
+        if starts is None:
+            starts = []
+            ends = []
+        self._starts = starts
+        self._ends = ends
+        # Added to the stored rows, so that rows can be inserted at the top
+        # without renumbering the runs.
+        self._offset = offset
+
+    def is_free(self, line_range):
+        """Return whether none of the rows in line_range are in use.
+
+        :param line_range: A list of (start, end) row ranges.
+        """
+        starts = self._starts
+        ends = self._ends
+        offset = self._offset
+        for start, end in line_range:
+            i = bisect_right(starts, end - offset) - 1
+            if i >= 0 and ends[i] >= start - offset:
+                return False
+        return True
+
+    def use(self, start, end):
+        """Mark the rows from start to end as in use."""
+        start -= self._offset
+        end -= self._offset
+        starts = self._starts
+        ends = self._ends
+        # Merge with the runs that overlap or touch start..end.
+        i = bisect_left(ends, start - 1)
+        j = bisect_right(starts, end + 1)
+        if i < j:
+            if starts[i] < start:
+                start = starts[i]
+            if ends[j - 1] > end:
+                end = ends[j - 1]
+        starts[i:j] = [start]
+        ends[i:j] = [end]
+
+    def shifted(self, rows):
+        """Return a copy with every row moved down by rows."""
+        return _Column(list(self._starts), list(self._ends),
+                       self._offset + rows)
+
+    def runs(self):
+        """Return the runs of used rows, as a list of (start, end) tuples."""
+        offset = self._offset
+        return [(start + offset, end + offset)
+                for start, end in izip(self._starts, self._ends)]
 
 def same_branch(a, b):
     """Return whether we think revisions a and b are on the same branch."""
@@ -0,0 +1,151 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""An index for the quick search of the branch view.
+
+Revision numbers are kept sorted, so that the ones starting with a key are
+found by bisection. Messages and authors are split into words, and each word
+maps to the revisions that use it. The words are kept sorted too. Entries
+added since the last search are merged into the sorted lists by the next
+one.
+"""
+
+from bisect import bisect_left
+import re
+
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _lower(text):
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return text.lower()
+
+
+def split_words(text):
+    """Return the set of lower case words in text."""
+    return set(_WORD_RE.findall(_lower(text)))
+
+
+def _prefixed(sorted_list, prefix):
+    """Yield the items of sorted_list that start with prefix."""
+    for i in xrange(bisect_left(sorted_list, prefix), len(sorted_list)):
+        item = sorted_list[i]
+        if not item.startswith(prefix):
+            break
+        yield item
+
+
+def _merge(sorted_list, items):
+    """Merge items into sorted_list, in place.
+
+    list.sort() finds the two sorted runs and merges them in linear time.
+    """
+    items.sort()
+    sorted_list.extend(items)
+    sorted_list.sort()
+
+
+class SearchIndex(object):
+    """The revision numbers, messages and authors of a branch view.
+
+    A revision matches a key if its dotted revision number starts with the
+    key, if every word of the key starts a word of its message or of one of
+    its authors, or if its message contains the key. The last is tested for
+    one revision at a time, by message_contains().
+
+    :ivar version: Changes whenever revisions are added, so that callers can
+        tell when matches they kept are out of date.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._revnos = []
+        self._new_revnos = []
+        self._revno_revids = {}
+        self._postings = {}
+        self._words = []
+        self._new_words = []
+        self._messages = {}
+
+    def add_revnos(self, revnos):
+        """Add the revision numbers of revisions.
+
+        :param revnos: A list of (revid, revno_sequence) tuples.
+        """
+        for revid, revno_sequence in revnos:
+            revno = ".".join(["%d" % (revno) for revno in revno_sequence])
+            if revno not in self._revno_revids:
+                self._new_revnos.append(revno)
+            self._revno_revids[revno] = revid
+        self.version += 1
+
+    def add_revisions(self, revisions):
+        """Add the messages and authors of revisions."""
+        postings = self._postings
+        for revision in revisions:
+            message = revision.message or ''
+            words = split_words(message)
+            for author in revision.get_apparent_authors():
+                words.update(split_words(author))
+            for word in words:
+                revids = postings.get(word)
+                if revids is None:
+                    postings[word] = [revision.revision_id]
+                    self._new_words.append(word)
+                else:
+                    revids.append(revision.revision_id)
+            self._messages[revision.revision_id] = _lower(message)
+        self.version += 1
+
+    def is_indexed(self, revid):
+        """Return whether the message and authors of revid are indexed."""
+        return revid in self._messages
+
+    def message_contains(self, revid, key):
+        """Return whether the message of revid contains key, ignoring case.
+
+        :param revid: An indexed revision.
+        """
+        return _lower(key) in self._messages[revid]
+
+    def search(self, key):
+        """Return the set of revids of the revisions whose revision number
+        or words match key.
+        """
+        key = _lower(key)
+        if self._new_revnos:
+            _merge(self._revnos, self._new_revnos)
+            self._new_revnos = []
+        if self._new_words:
+            _merge(self._words, self._new_words)
+            self._new_words = []
+        matches = set(self._revno_revids[revno]
+                      for revno in _prefixed(self._revnos, key))
+        words = split_words(key)
+        if words:
+            word_matches = None
+            for word in words:
+                revids = set()
+                for indexed_word in _prefixed(self._words, word):
+                    revids.update(self._postings[indexed_word])
+                if word_matches is None:
+                    word_matches = revids
+                else:
+                    word_matches &= revids
+                if not word_matches:
+                    break
+            matches.update(word_matches)
+        return matches
@@ -10,8 +10,12 @@ from gi.repository import GObject
 from xml.sax.saxutils import escape
 
 from bzrlib.config import parse_username
+from bzrlib.lru_cache import LRUCache
 from bzrlib.revision import NULL_REVISION
 
+from bzrlib.plugins.gtk.branchview.linegraph import CompactLineGraph
+from bzrlib.plugins.gtk.revisioncache import get_revision_cache
+
 from time import (
     strftime,
     localtime,
@@ -19,43 +23,61 @@ from time import (
 
 
 REVID = 0
-NODE = 1
-LINES = 2
-LAST_LINES = 3
-REVNO = 4
-SUMMARY = 5
-MESSAGE = 6
-COMMITTER = 7
-TIMESTAMP = 8
-REVISION = 9
-PARENTS = 10
-CHILDREN = 11
-TAGS = 12
-AUTHORS = 13
-
-
-class BranchTreeModel(Gtk.ListStore):
-    """A model of branch's merge history."""
+REVNO = 1
+SUMMARY = 2
+MESSAGE = 3
+COMMITTER = 4
+TIMESTAMP = 5
+REVISION = 6
+PARENTS = 7
+CHILDREN = 8
+TAGS = 9
+AUTHORS = 10
+
+COLUMN_TYPES = (
+    GObject.TYPE_STRING,
+    GObject.TYPE_STRING,
+    GObject.TYPE_STRING,
+    GObject.TYPE_STRING,
+    GObject.TYPE_STRING,
+    GObject.TYPE_STRING,
+    GObject.TYPE_PYOBJECT,
+    GObject.TYPE_PYOBJECT,
+    GObject.TYPE_PYOBJECT,
+    GObject.TYPE_PYOBJECT,
+    GObject.TYPE_STRING)
+
+# The columns derived from the revision, in the order of
+# _revision_to_model_values().
+REVISION_VALUE_COLUMNS = (SUMMARY, MESSAGE, COMMITTER, TIMESTAMP, AUTHORS)
+
+# The number of revisions whose display values are kept.
+VALUES_CACHE_SIZE = 1000
+
+
+class BranchTreeModel(GObject.Object, Gtk.TreeModel):
+    """A model of branch's merge history.
+
+    The model is a virtual list over line_graph_data: nothing is stored per
+    row, the values of a row are worked out when the view asks for them. The
+    revision metadata shown in the summary, author and date columns is only
+    fetched from the repository once a row gets close to the visible part of
+    the view, see load_rows(), and is empty until then. Revisions are kept in
+    the repository's shared RevisionCache, and the display values made from
+    them in a cache of the last VALUES_CACHE_SIZE revisions.
+
+    The nodes and lines of the graph are kept in graph, a CompactLineGraph,
+    which CellRendererGraph reads.
+    """
 
     def __init__(self, branch, line_graph_data):
-        super(BranchTreeModel, self).__init__(
-            GObject.TYPE_STRING,
-            GObject.TYPE_PYOBJECT,
-            GObject.TYPE_PYOBJECT,
-            GObject.TYPE_PYOBJECT,
-            GObject.TYPE_STRING,
-            GObject.TYPE_STRING,
-            GObject.TYPE_STRING,
-            GObject.TYPE_STRING,
-            GObject.TYPE_STRING,
-            GObject.TYPE_PYOBJECT,
-            GObject.TYPE_PYOBJECT,
-            GObject.TYPE_PYOBJECT,
-            GObject.TYPE_PYOBJECT,
-            GObject.TYPE_STRING)
-        self.revisions = {}
+        super(BranchTreeModel, self).__init__()
         self.branch = branch
         self.repository = branch.repository
+        self.revision_cache = get_revision_cache(self.repository)
+        self._values = LRUCache(VALUES_CACHE_SIZE)
+        self._filled_rows = 0
+        self.line_graph_data = []
         if self.branch.supports_tags():
             self.tags = self.branch.tags.get_reverse_tag_dict()
         else:
@@ -69,39 +91,219 @@ class BranchTreeModel(Gtk.ListStore):
         except KeyError:
             self.tags[revid] = [tag]
 
-    def _line_graph_item_to_model_row(self, rowref, data):
-        revid, node, lines, parents, children, revno_sequence = data
-        if rowref > 0:
-            last_lines = self.line_graph_data[rowref - 1][2]
-        else:
-            last_lines = []
-        revno = ".".join(["%d" % (revno) for revno in revno_sequence])
-        tags = self.tags.get(revid, [])
-        if not revid or revid == NULL_REVISION:
-            revision = None
-        elif revid not in self.revisions:
-            revision = self.repository.get_revisions([revid])[0]
-            self.revisions[revid] = revision
-        else:
-            revision = self.revisions[revid]
+    def _revision_to_model_values(self, revision):
+        """Return the display values that are derived from revision."""
         if revision is None:
-            summary = message = committer = timestamp = authors = None
-        else:
-            summary = escape(revision.get_summary())
-            message = escape(revision.message)
-            committer = parse_username(revision.committer)[0]
-            timestamp = strftime(
-                "%Y-%m-%d %H:%M", localtime(revision.timestamp))
-            authors = ", ".join([
-                parse_username(author)[0]
-                for author in revision.get_apparent_authors()])
-        return (revid, node, lines, last_lines, revno, summary, message,
-                committer, timestamp, revision, parents, children, tags,
-                authors)
-
-    def set_line_graph_data(self, line_graph_data):
-        self.clear()
+            return (None, None, None, None, None)
+        summary = escape(revision.get_summary())
+        message = escape(revision.message)
+        committer = parse_username(revision.committer)[0]
+        timestamp = strftime("%Y-%m-%d %H:%M", localtime(revision.timestamp))
+        authors = ", ".join([
+            parse_username(author)[0]
+            for author in revision.get_apparent_authors()])
+        return (summary, message, committer, timestamp, authors)
+
+    def _get_revision_values(self, revid):
+        """Return the display values of revid, if its revision is loaded.
+
+        :return: A tuple as returned by _revision_to_model_values(), or None.
+        """
+        values = self._values.get(revid)
+        if values is None and revid in self.revision_cache:
+            values = self._revision_to_model_values(
+                self.revision_cache.get_revision(revid))
+            self._values[revid] = values
+        return values
+
+    def _get_row_value(self, rowref, column):
+        """Return the value of column in row rowref."""
+        (revid, node, lines, parents, children,
+         revno_sequence) = self.line_graph_data[rowref]
+        if column == REVID:
+            return revid
+        elif column == REVNO:
+            return ".".join(["%d" % (revno) for revno in revno_sequence])
+        elif column == PARENTS:
+            return parents
+        elif column == CHILDREN:
+            return children
+        elif column == TAGS:
+            return self.tags.get(revid, [])
+        elif column == REVISION:
+            if revid in self.revision_cache:
+                return self.revision_cache.get_revision(revid)
+            return None
+        values = self._get_revision_values(revid)
+        if values is None:
+            return ""
+        return values[REVISION_VALUE_COLUMNS.index(column)]
+
+    def load_rows(self, start, end):
+        """Make sure the revision metadata of rows start to end is present.
+
+        The missing revisions are fetched through the revision cache in one
+        batch, rows that are not in the model (yet) are ignored.
+
+        :param start: Index of the first row to load.
+        :param end: Index of the last row to load.
+        """
+        start = max(start, 0)
+        end = min(end, self._filled_rows - 1)
+        rowrefs = []
+        revids = []
+        for rowref in range(start, end + 1):
+            revid = self.line_graph_data[rowref][0]
+            if (revid and revid != NULL_REVISION
+                and revid not in self._values):
+                rowrefs.append(rowref)
+                revids.append(revid)
+        if not revids:
+            return
+        self.revision_cache.prefetch(revids)
+        for rowref, revid in zip(rowrefs, revids):
+            self._get_revision_values(revid)
+            self.row_changed(Gtk.TreePath(path=rowref),
+                             self._get_iter(rowref))
+
+    def get_revision(self, rowref):
+        """Return the revision shown in row rowref."""
+        revid = self.line_graph_data[rowref][0]
+        if not revid or revid == NULL_REVISION:
+            return None
+        return self.revision_cache.get_revision(revid)
+
+    def set_line_graph_data(self, line_graph_data, initial_rows=None,
+                            graph=None):
+        """Replace the graph shown by the model.
+
+        :param initial_rows: If given, only add this many rows for now, the
+            others are added by add_more_rows().
+        :param graph: The CompactLineGraph with the nodes and lines of
+            line_graph_data, as kept by LineGraphState. If None, it is built
+            from the rows. It may only have the first rows, as for a
+            PagedLineGraph, the other rows are added once they are in it.
+        """
+        while self._filled_rows:
+            self._filled_rows -= 1
+            self.row_deleted(Gtk.TreePath(path=self._filled_rows))
+        self._values.clear()
+        if graph is None:
+            graph = CompactLineGraph(line_graph_data)
         self.line_graph_data = line_graph_data
-        for rowref, data in enumerate(self.line_graph_data):
-            row = self._line_graph_item_to_model_row(rowref, data)
-            self.append(row)
+        self.graph = graph
+        if initial_rows is None:
+            initial_rows = len(line_graph_data)
+        self.add_more_rows(initial_rows)
+
+    def add_more_rows(self, count):
+        """Add up to count of the rows that are not in the model yet.
+
+        :return: True if there are rows left to add.
+        """
+        # Rows that are not laid out yet have no place in graph.
+        available = len(self.graph)
+        end = min(self._filled_rows + count, available)
+        for rowref in range(self._filled_rows, end):
+            self._filled_rows = rowref + 1
+            self.row_inserted(Gtk.TreePath(path=rowref),
+                              self._get_iter(rowref))
+        return end < available
+
+    def insert_line_graph_rows(self, line_graph_data, graph, added, changed):
+        """Switch to line_graph_data, which has rows added on top of ours.
+
+        This is for graphs extended with update_linegraph(), the rows that
+        are already in the model are kept. As the lines are not part of the
+        rows, the view has to be redrawn to show the ones that changed.
+
+        :param graph: The CompactLineGraph for line_graph_data.
+        :param added: The number of rows added at the top.
+        :param changed: Indexes of the old rows, in line_graph_data, whose
+            lines or children changed.
+        """
+        self.line_graph_data = line_graph_data
+        self.graph = graph
+        for rowref in range(added):
+            self._filled_rows += 1
+            self.row_inserted(Gtk.TreePath(path=rowref),
+                              self._get_iter(rowref))
+        for rowref in changed:
+            if rowref >= self._filled_rows:
+                break
+            self.row_changed(Gtk.TreePath(path=rowref),
+                             self._get_iter(rowref))
+
+    def fill_to(self, rowref):
+        """Make sure the model contains rows up to and including rowref."""
+        if rowref >= self._filled_rows:
+            self.add_more_rows(rowref + 1 - self._filled_rows)
+
+    def _get_iter(self, rowref):
+        tree_iter = Gtk.TreeIter()
+        # user_data is a pointer, which must not be NULL for the first row.
+        tree_iter.user_data = rowref + 1
+        return tree_iter
+
+    def _get_rowref(self, tree_iter):
+        return tree_iter.user_data - 1
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY
+
+    def do_get_n_columns(self):
+        return len(COLUMN_TYPES)
+
+    def do_get_column_type(self, column):
+        return COLUMN_TYPES[column]
+
+    def do_get_iter(self, path):
+        indices = path.get_indices()
+        if len(indices) != 1 or not 0 <= indices[0] < self._filled_rows:
+            return (False, None)
+        return (True, self._get_iter(indices[0]))
+
+    def do_get_path(self, tree_iter):
+        return Gtk.TreePath(path=self._get_rowref(tree_iter))
+
+    def do_get_value(self, tree_iter, column):
+        return self._get_row_value(self._get_rowref(tree_iter), column)
+
+    def _invalidate_iter(self, tree_iter):
+        # As GTK expects of an iter that could not be moved.
+        tree_iter.user_data = None
+
+    def do_iter_next(self, tree_iter):
+        rowref = self._get_rowref(tree_iter) + 1
+        if rowref >= self._filled_rows:
+            self._invalidate_iter(tree_iter)
+            return False
+        tree_iter.user_data = rowref + 1
+        return True
+
+    def do_iter_previous(self, tree_iter):
+        rowref = self._get_rowref(tree_iter) - 1
+        if rowref < 0:
+            self._invalidate_iter(tree_iter)
+            return False
+        tree_iter.user_data = rowref + 1
+        return True
+
+    def do_iter_children(self, parent):
+        return self.do_iter_nth_child(parent, 0)
+
+    def do_iter_has_child(self, tree_iter):
+        return False
+
+    def do_iter_n_children(self, tree_iter):
+        if tree_iter is None:
+            return self._filled_rows
+        return 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is not None or not 0 <= n < self._filled_rows:
+            return (False, None)
+        return (True, self._get_iter(n))
+
+    def do_iter_parent(self, child):
+        return (False, None)
@@ -6,6 +6,8 @@
 __copyright__ = "Copyright © 2005 Canonical Ltd."
 __author__    = "Daniel Schierbeck <daniel.schierbeck@gmail.com>"
 
+import copy
+
 from gi.repository import Gtk
 from gi.repository import GObject
 from gi.repository import Pango
@@ -14,14 +16,36 @@ from bzrlib import ui
 from bzrlib.revision import NULL_REVISION
 
 from bzrlib.plugins.gtk import lock
+from bzrlib.plugins.gtk.backgroundjob import BackgroundJob
+from bzrlib.plugins.gtk.revisioncache import get_revision_cache
 from bzrlib.plugins.gtk.ui import ProgressPanel
 from bzrlib.plugins.gtk.branchview import treemodel
-from bzrlib.plugins.gtk.branchview.linegraph import linegraph, same_branch
+from bzrlib.plugins.gtk.branchview.graphcache import (
+    cached_linegraph,
+    load_linegraph,
+    store_linegraph,
+    )
+from bzrlib.plugins.gtk.branchview.linegraph import (
+    PagedLineGraph,
+    same_branch,
+    update_linegraph,
+    )
 from bzrlib.plugins.gtk.branchview.graphcell import CellRendererGraph
+from bzrlib.plugins.gtk.branchview.searchindex import SearchIndex
 
 
 class TreeView(Gtk.VBox):
 
+    # Number of rows shown as soon as the graph has been computed, the
+    # others are added FILL_ROWS at a time while the main loop is idle, or
+    # as soon as the view is scrolled near the last ones. A graph that is
+    # not in the cache is laid out in pages of the same sizes.
+    FIRST_ROWS = 200
+    FILL_ROWS = 2000
+
+    # Number of revisions read at a time while the search index is built.
+    SEARCH_INDEX_BATCH = 500
+
     __gproperties__ = {
         'branch': (GObject.TYPE_PYOBJECT,
                    'Branch',
@@ -122,6 +146,20 @@ class TreeView(Gtk.VBox):
 
         self.scrolled_window.add(self.construct_treeview())
 
+        self._populate_job = None
+        self._linegraph_state = None
+        self._paged_linegraph = None
+        self.progress_bar = None
+        self._fill_model_id = None
+        self._load_rows_id = None
+        self._search_index = None
+        self._search_job = None
+        self._search_pending = []
+        self._search_matches = (None, None, None)
+        vadjustment = self.scrolled_window.get_vadjustment()
+        vadjustment.connect('value-changed', self._on_scrolled)
+        vadjustment.connect('changed', self._on_scrolled)
+
         self.path = None
         self.branch = branch
         self.revision = None
@@ -132,11 +170,20 @@ class TreeView(Gtk.VBox):
         self.compact = compact
 
         self.model = treemodel.BranchTreeModel(self.branch, [])
+        # The lock is held as long as the view is shown, refresh() takes it
+        # again to see new revisions.
+        self.branch.lock_read()
         GObject.idle_add(self.populate)
 
         self.connect("destroy", self._on_destroy)
 
     def _on_destroy(self, *ignored):
+        self._cancel_populate()
+        self._stop_filling_model()
+        self._drop_search_index()
+        if self._load_rows_id is not None:
+            GObject.source_remove(self._load_rows_id)
+            self._load_rows_id = None
         self.branch.unlock()
         if getattr(ui.ui_factory, "set_progress_bar_widget", None) is not None:
             # We'are using our own ui, let's tell it to stop using our widget.
@@ -158,8 +205,7 @@ class TreeView(Gtk.VBox):
         elif property.name == 'revision':
             if self.path is None:
                 return None
-            return self.model.get_value(self.model.get_iter(self.path),
-                                        treemodel.REVISION)
+            return self.model.get_revision(self.path.get_indices()[0])
         elif property.name == 'revision-number':
             if self.path is None:
                 return None
@@ -211,8 +257,9 @@ class TreeView(Gtk.VBox):
 
         :param revid: Revision id of revision to display.
         """
-        self.treeview.set_cursor(
-            Gtk.TreePath(path=self.index[revid]), None, False)
+        index = self.index[revid]
+        self._fill_to(index)
+        self.treeview.set_cursor(Gtk.TreePath(path=index), None, False)
         self.treeview.grab_focus()
 
     def get_children(self):
@@ -244,7 +291,60 @@ class TreeView(Gtk.VBox):
             self.emit('tag-added', tag, revid)
 
     def refresh(self):
-        GObject.idle_add(self.populate, self.get_revision())
+        """Show the revisions added since the view was populated.
+
+        If the view started at the tip of the branch, it follows the tip.
+        """
+        GObject.idle_add(self._refresh, self.get_revision())
+
+    def _refresh(self, revision):
+        if self._populate_job is None:
+            old_tip = self.branch.last_revision()
+            self.branch.unlock()
+            self.branch.lock_read()
+            if self.start == [old_tip]:
+                self.start = [self.branch.last_revision()]
+            if self._update_linegraph():
+                return False
+        self.populate(revision)
+        return False
+
+    def _update_linegraph(self):
+        """Add the new revisions to the graph shown, in place.
+
+        :return: False if the graph has to be computed from scratch instead.
+        """
+        state = self._linegraph_state
+        if state is None:
+            return False
+        update = update_linegraph(self.branch.repository.get_graph(), state,
+                                  self.start, self._broken_line_length(),
+                                  self.graph_column.get_visible(),
+                                  self.mainline_only)
+        if update is None:
+            return False
+        (added, changed) = update
+        if added:
+            self.model.insert_line_graph_rows(state.line_graph, state.graph,
+                                              added, changed)
+            if self._search_index is not None:
+                self._index_rows(state.line_graph[:added])
+            self.index = state.revid_index
+            self._set_columns_len(state.columns_len)
+            # The lines of the rows that changed are not in the model.
+            self.treeview.queue_draw()
+            # The cursor stays on the same row, which has moved down.
+            self.path = self.treeview.get_cursor()[0]
+            self._prev_cursor_path = self.path
+            self._schedule_load_visible_rows()
+            # update_linegraph() replaces what it changes, so the job can
+            # safely write out a copy of the state.
+            BackgroundJob(self._store_linegraph, (copy.copy(state),)).start()
+        self.emit('refreshed')
+        return True
+
+    def _store_linegraph(self, job, state):
+        store_linegraph(self.branch.repository, state)
 
     def update(self):
         try:
@@ -265,7 +365,7 @@ class TreeView(Gtk.VBox):
 
         for parent_id in parents:
             parent_index = self.index[parent_id]
-            parent = self.model[parent_index][treemodel.REVISION]
+            parent = self.model.get_revision(parent_index)
             if same_branch(self.get_revision(), parent):
                 self.set_revision(parent)
                 break
@@ -280,7 +380,7 @@ class TreeView(Gtk.VBox):
 
         for child_id in children:
             child_index = self.index[child_id]
-            child = self.model[child_index][treemodel.REVISION]
+            child = self.model.get_revision(child_index)
             if same_branch(child, self.get_revision()):
                 self.set_revision(child)
                 break
@@ -290,75 +390,303 @@ class TreeView(Gtk.VBox):
     def populate(self, revision=None):
         """Fill the treeview with contents.
 
-        :param start: Revision id of revision to start with.
-        :param maxnum: Maximum number of revisions to display, or None 
-                       for no limit.
-        :param broken_line_length: After how much lines branches \
-                       should be broken.
-        """
+        The line graph is computed by a background job so the window stays
+        responsive, the model is filled once it is done, see
+        _linegraph_computed.
 
+        :param revision: Revision to select once the graph has been loaded.
+        """
         if getattr(ui.ui_factory, "set_progress_bar_widget", None) is not None:
             # We'are using our own ui, let's tell it to use our widget.
             ui.ui_factory.set_progress_bar_widget(self.progress_widget)
-        self.progress_bar = ui.ui_factory.nested_progress_bar()
-        self.progress_bar.update("Loading ancestry graph", 0, 5)
-
-        try:
-            if self.compact:
-                broken_line_length = 32
-            else:
-                broken_line_length = None
+        previous_job = self._cancel_populate()
+
+        # bzrlib objects must not be used by two threads at once, so
+        # nothing in the main loop may access the repository through the old
+        # rows while the job runs.
+        self._stop_filling_model()
+        self._drop_search_index()
+        self.model.set_line_graph_data([])
+        self.index = {}
+        self.path = None
+        self._prev_cursor_path = None
 
-            show_graph = self.graph_column.get_visible()
+        self._linegraph_state = None
+        self._paged_linegraph = None
 
-            self.branch.lock_read()
-            (linegraphdata, index, columns_len) = linegraph(
-                self.branch.repository.get_graph(),
+        self.progress_bar = ui.ui_factory.nested_progress_bar()
+        self.progress_bar.update("Loading ancestry graph", 0, 6)
+
+        self._populate_job = BackgroundJob(self._compute_linegraph,
+            (previous_job, self._broken_line_length(),
+             self.graph_column.get_visible(), self.progress_bar, revision),
+            callback=self._linegraph_state_computed,
+            error_callback=self._linegraph_failed)
+        self._populate_job.start()
+        return False
+
+    def _broken_line_length(self):
+        if self.compact:
+            return 32
+        else:
+            return None
+
+    def _compute_linegraph(self, job, previous_job, broken_line_length,
+                           show_graph, progress_bar, revision):
+        """Compute the line graph, in a worker thread."""
+        if previous_job is not None:
+            # A cancelled job stops at its next progress update.
+            previous_job.join()
+        job.check_cancelled()
+        repository = self.branch.repository
+        if show_graph and not self.maxnum:
+            state = load_linegraph(repository, self.start, None,
+                                   broken_line_length, True,
+                                   self.mainline_only)
+            if state is None:
+                # Only lay out the first rows, the others are done from the
+                # main loop as they are needed.
+                paged = PagedLineGraph(repository.get_graph(), self.start,
+                                       broken_line_length, self.mainline_only,
+                                       progress_bar)
+                paged.extend(self.FIRST_ROWS)
+                job.post(self._paged_linegraph_computed, paged, revision)
+                return None
+        else:
+            state = cached_linegraph(
+                repository,
                 self.start,
-                self.maxnum, 
+                self.maxnum,
                 broken_line_length,
                 show_graph,
                 self.mainline_only,
-                self.progress_bar)
-
-            self.model.set_line_graph_data(linegraphdata)
-            self.graph_cell.columns_len = columns_len
-            width = self.graph_cell.get_preferred_width(self.treeview)[1]
-            if width > 500:
-                width = 500
-            elif width == 0:
-                # The get_preferred_width() call got an insane value.
-                width = 200
-            self.graph_column.set_fixed_width(width)
-            self.graph_column.set_max_width(width)
+                progress_bar)
+        result = (state.line_graph, state.revid_index, state.columns_len,
+                  state.graph)
+        job.post(self._linegraph_computed, result, revision)
+        # Get ready for refresh() while the rows are being shown.
+        state.build_index()
+        return state
+
+    def _finish_progress(self):
+        if self.progress_bar is not None:
+            self.progress_bar.finished()
+            self.progress_bar = None
+
+    def _cancel_populate(self):
+        """Cancel a running populate job, and return it."""
+        job = self._populate_job
+        if job is None:
+            return None
+        self._populate_job = None
+        job.cancel()
+        self._finish_progress()
+        return job
+
+    def _linegraph_failed(self, exc_info):
+        self._populate_job = None
+        self._finish_progress()
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _linegraph_state_computed(self, state):
+        self._populate_job = None
+        if state is not None:
+            self._linegraph_state = state
+
+    def _paged_linegraph_computed(self, paged, revision):
+        self._paged_linegraph = paged
+        self._linegraph_computed(
+            (paged.line_graph, paged.revid_index, paged.columns_len,
+             paged.graph),
+            revision)
+        # The first page may have been the whole graph.
+        self._extend_linegraph(0)
+
+    def _extend_linegraph(self, rows):
+        """Lay out the next rows of a paged line graph."""
+        paged = self._paged_linegraph
+        paged.extend(rows)
+        self._set_columns_len(paged.columns_len)
+        if paged.is_complete():
+            self._paged_linegraph = None
+            self._linegraph_state = paged.get_state()
+            BackgroundJob(self._store_linegraph,
+                          (copy.copy(self._linegraph_state),)).start()
+
+    def _fill_to(self, index):
+        """Make sure the model has the row index, laying it out if needed."""
+        paged = self._paged_linegraph
+        if paged is not None and index >= paged.laid_out:
+            self._extend_linegraph(index + 1 - paged.laid_out)
+        self.model.fill_to(index)
+
+    def _set_columns_len(self, columns_len):
+        self.graph_cell.columns_len = columns_len
+        width = self.graph_cell.get_preferred_width(self.treeview)[1]
+        if width > 500:
+            width = 500
+        elif width == 0:
+            # The get_preferred_width() call got an insane value.
+            width = 200
+        self.graph_column.set_fixed_width(width)
+        self.graph_column.set_max_width(width)
+
+    def _linegraph_computed(self, result, revision):
+        try:
+            (linegraphdata, index, columns_len, graph) = result
+
+            self.model.set_line_graph_data(linegraphdata, self.FIRST_ROWS,
+                                           graph)
+            self._set_columns_len(columns_len)
             self.index = index
             self.treeview.set_model(self.model)
+            self._schedule_load_visible_rows()
 
             if not revision or revision == NULL_REVISION:
-                self.treeview.set_cursor(Gtk.TreePath(path=0), None, False)
+                if linegraphdata:
+                    self.treeview.set_cursor(
+                        Gtk.TreePath(path=0), None, False)
             else:
                 self.set_revision(revision)
 
+            self._fill_model_id = GObject.idle_add(self._fill_model)
             self.emit('refreshed')
-            return False
         finally:
-            self.progress_bar.finished()
+            self._finish_progress()
+
+    def _fill_model(self):
+        """Add the next rows to the model, while the main loop is idle."""
+        if self.model.add_more_rows(self.FILL_ROWS):
+            return True
+        if self._paged_linegraph is not None:
+            self._extend_linegraph(self.FILL_ROWS)
+            return True
+        self._fill_model_id = None
+        return False
+
+    def _stop_filling_model(self):
+        if self._fill_model_id is not None:
+            GObject.source_remove(self._fill_model_id)
+            self._fill_model_id = None
+
+    def _index_rows(self, rows):
+        """Add rows to the search index, in a background job."""
+        self._search_pending.extend(rows)
+        if self._search_job is None:
+            self._start_search_job()
+
+    def _start_search_job(self):
+        rows = self._search_pending
+        self._search_pending = []
+        self._search_job = BackgroundJob(self._fetch_search_revisions,
+            (rows,), callback=self._search_revisions_fetched,
+            error_callback=self._search_revisions_failed)
+        self._search_job.start()
+
+    def _fetch_search_revisions(self, job, rows):
+        """Fetch the revisions of rows for the search index, in a worker
+        thread.
+
+        They are handed to _add_to_search_index SEARCH_INDEX_BATCH rows at a
+        time.
+        """
+        revision_cache = get_revision_cache(self.branch.repository)
+        for start in xrange(0, len(rows), self.SEARCH_INDEX_BATCH):
+            job.check_cancelled()
+            batch = rows[start:start + self.SEARCH_INDEX_BATCH]
+            # The revisions are not added to the cache, as they would push
+            # out the ones of the rows that are shown.
+            revisions = revision_cache.get_revisions_uncached(
+                [row[0] for row in batch
+                 if row[0] and row[0] != NULL_REVISION])
+            job.post(self._add_to_search_index, batch, revisions)
+
+    def _add_to_search_index(self, rows, revisions):
+        self._search_index.add_revnos([(row[0], row[5]) for row in rows])
+        self._search_index.add_revisions(revisions)
+
+    def _search_revisions_fetched(self, result):
+        self._search_job = None
+        if self._search_pending:
+            self._start_search_job()
+
+    def _search_revisions_failed(self, exc_info):
+        self._search_job = None
+        self._search_pending = []
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _drop_search_index(self):
+        if self._search_job is not None:
+            self._search_job.cancel()
+            self._search_job = None
+        self._search_index = None
+        self._search_pending = []
+        self._search_matches = (None, None, None)
+
+    def _search_equal_func(self, model, column, key, tree_iter, ignored):
+        """Return False if the row of tree_iter matches key.
+
+        A row matches if its revision number starts with key, if its
+        message contains key, or if the words of key start words of its
+        message or authors. The search index is built the first time it is
+        needed. Until a row is indexed, its revision number has to start
+        with key or its message has to contain key, if it is loaded at all.
+        """
+        if self._search_index is None:
+            self._search_index = SearchIndex()
+            # Indexing starts from the top of the view.
+            self._index_rows(self.model.line_graph_data)
+        index = self._search_index
+        (matches_key, matches_version, matches) = self._search_matches
+        if matches_key != key or matches_version != index.version:
+            matches = index.search(key)
+            self._search_matches = (key, index.version, matches)
+        revid = model.get_value(tree_iter, treemodel.REVID)
+        if revid in matches:
+            return False
+        if index.is_indexed(revid):
+            return not index.message_contains(revid, key)
+        if model.get_value(tree_iter, treemodel.REVNO).startswith(key):
+            return False
+        return (model.get_value(tree_iter, treemodel.MESSAGE).lower().find(
+                key.lower()) == -1)
+
+    def _on_scrolled(self, adjustment):
+        if (len(self.model) and adjustment.get_value()
+            + 2 * adjustment.get_page_size() >= adjustment.get_upper()):
+            # Less than a screenful of rows left, add the next ones now
+            # rather than when the main loop is idle.
+            self._fill_to(len(self.model) - 1 + self.FILL_ROWS)
+        self._schedule_load_visible_rows()
+
+    def _schedule_load_visible_rows(self):
+        if self._load_rows_id is None:
+            self._load_rows_id = GObject.idle_add(self._load_visible_rows)
+
+    def _load_visible_rows(self):
+        """Load the revisions of the visible rows.
+
+        One extra screenful above and below the visible rows is read ahead so
+        that scrolling a page does not have to wait for the repository.
+        """
+        self._load_rows_id = None
+        visible_range = self.treeview.get_visible_range()
+        if visible_range is None:
+            return False
+        start_path, end_path = visible_range
+        first = start_path.get_indices()[0]
+        last = end_path.get_indices()[0]
+        page_size = last - first + 1
+        self.model.load_rows(first - page_size, last + page_size)
+        return False
 
     def construct_treeview(self):
         self.treeview = Gtk.TreeView()
 
         self.treeview.set_rules_hint(True)
-        # combined revno/summary interactive search
-        #
-        # the row in a treemodel is considered "matched" if a REVNO *starts*
-        # from the key (that is the key is found in a REVNO at the offset 0)
-        # or if a MESSAGE *contains* the key anywhere (that is, the key is
-        # found case insensitively in a MESSAGE at any offset)
-        def search_equal_func(model, column, key, iter, ignored):
-            return (model.get_value(iter, treemodel.REVNO).find(key) != 0
-                and model.get_value(iter, treemodel.MESSAGE).lower().find(key.lower()) == -1)
-
-        self.treeview.set_search_equal_func(search_equal_func, None)
+        # combined revno/message/author interactive search, see
+        # _search_equal_func
+        self.treeview.set_search_equal_func(self._search_equal_func, None)
         self.treeview.set_enable_search(True)
 
         self.treeview.set_tooltip_column(treemodel.MESSAGE)
@@ -395,15 +723,12 @@ class TreeView(Gtk.VBox):
         self.graph_column.set_resizable(True)
         self.graph_column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
         self.graph_column.pack_start(self.graph_cell, True)
-        self.graph_column.add_attribute(
-            self.graph_cell, "node", treemodel.NODE)
         self.graph_column.add_attribute(
             self.graph_cell, "tags", treemodel.TAGS)
-        self.graph_column.add_attribute(
-            self.graph_cell, "in-lines", treemodel.LAST_LINES)
-        self.graph_column.add_attribute(
-            self.graph_cell, "out-lines", treemodel.LINES)
+        self.graph_column.set_cell_data_func(
+            self.graph_cell, self._graph_cell_data_func)
         self.treeview.append_column(self.graph_column)
+        self.treeview.connect('style-updated', self._on_style_updated)
 
         cell = Gtk.CellRendererText()
         cell.set_property("width-chars", 65)
@@ -443,6 +768,17 @@ class TreeView(Gtk.VBox):
 
         return self.treeview
 
+    def _graph_cell_data_func(self, column, cell, model, tree_iter, data):
+        """Point the graph renderer at the row it is about to draw."""
+        cell.graph = model.graph
+        cell.row = model.get_path(tree_iter).get_indices()[0]
+
+    def _on_style_updated(self, treeview):
+        """The font or theme changed, the graph has to be drawn again."""
+        self.graph_cell.clear_cache()
+        if self.graph_cell.columns_len:
+            self._set_columns_len(self.graph_cell.columns_len)
+
     def _on_selection_changed(self, treeview):
         """callback for when the treeview changes."""
         (path, focus) = treeview.get_cursor()
@@ -214,6 +214,43 @@ class cmd_visualise(Command):
         Gtk.main()
 
 
+class cmd_viz_benchmark(Command):
+    """Time "bzr viz" on synthetic histories.
+
+    Histories of about COUNT revisions of each kind are built in memory,
+    and the time taken by each stage of the line graph, by the tree model
+    and by the graph renderer is written out as JSON.
+    """
+    hidden = True
+    takes_options = [
+        Option('revisions', "Number of revisions in each history.",
+               int, 'count'),
+        Option('history', "Only time this kind of history.", str, 'name'),
+        Option('graph-only', "Do not time the model and the renderer."),
+        Option('processes', "Lay out the line graph in this many processes.",
+               int, 'count'),
+        ]
+    encoding_type = 'exact'
+
+    def run(self, revisions=2000, history=None, graph_only=False,
+            processes=None):
+        import json
+        from bzrlib.plugins.gtk.branchview import benchmark
+        names = None
+        if history is not None:
+            if history not in dict(benchmark.HISTORIES):
+                raise BzrCommandError('Unknown history "%s", use one of: %s.'
+                    % (history, ', '.join(
+                        [name for name, make_history in benchmark.HISTORIES])))
+            names = [history]
+        if not graph_only:
+            open_display()
+        results = benchmark.run_benchmarks(revisions, names, not graph_only,
+                                           processes=processes)
+        json.dump(results, self.outf, indent=2, sort_keys=True)
+        self.outf.write('\n')
+
+
 class cmd_gannotate(GTKCommand):
     """GTK+ annotate.
     
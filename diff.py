@@ -13,6 +13,7 @@ from cStringIO import StringIO
 import sys
 import inspect
 
+from gi.repository import GObject
 from gi.repository import Gtk
 from gi.repository import Pango
 try:
@@ -29,7 +30,12 @@ from bzrlib import (
     workingtree,
     )
 from bzrlib.diff import show_diff_trees
+from bzrlib.lru_cache import LRUSizeCache
 from bzrlib.patches import parse_patches
+from bzrlib.plugins.gtk.backgroundjob import (
+    BackgroundJob,
+    check_cancelled,
+    )
 from bzrlib.plugins.gtk.dialog import (
     error_dialog,
     info_dialog,
@@ -52,6 +58,105 @@ class SelectCancelled(Exception):
     pass
 
 
+# Above this number of changed files, diffs are only generated for the files
+# that are selected, see DiffWidget.set_diff.
+LAZY_FILE_COUNT = 100
+
+
+def _changed_file_count(delta):
+    """Return the number of files listed for delta by DiffWidget."""
+    return (len(delta.added) + len(delta.removed) + len(delta.renamed)
+            + len(delta.modified))
+
+
+class _JobOutput(object):
+    """A file for output written by a background job.
+
+    Writing to it stops the job once it has been cancelled.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        check_cancelled()
+        self._chunks.append(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def getvalue(self):
+        return ''.join(self._chunks)
+
+
+def _iter_chunks(patch, size):
+    """Split patch into chunks of about size bytes that end with a newline.
+    """
+    start = 0
+    while start < len(patch):
+        end = start + size
+        if end < len(patch):
+            end = patch.rfind('\n', start, end) + 1
+            if end <= start:
+                # A line longer than size
+                end = patch.find('\n', start + size) + 1 or len(patch)
+        yield patch[start:end]
+        start = end
+
+
+def _decode_patch(patch):
+    """Return patch as UTF-8, whatever its encoding."""
+    # str.decode(encoding, 'replace') doesn't do anything. Because if a
+    # character is not valid in 'encoding' there is nothing to replace, the
+    # 'replace' is for 'str.encode()'
+    try:
+        decoded = patch.decode(sys.getdefaultencoding())
+    except UnicodeDecodeError:
+        try:
+            decoded = patch.decode('UTF-8')
+        except UnicodeDecodeError:
+            decoded = patch.decode('iso-8859-1')
+            # This always works, because every byte has a valid
+            # mapping from iso-8859-1 to Unicode
+    # TextBuffer must contain pure UTF-8 data
+    return decoded.encode('UTF-8')
+
+
+def _compute_diff(job, repository, revid, parent_id, post_changes, lazy):
+    """Compare two revisions, in a worker thread.
+
+    bzrlib objects must not be used by two threads at once, so the job
+    opens the repository again. The trees it returns may be used from the
+    main loop once it is done.
+
+    :param post_changes: Called from the main loop with the TreeDelta of the
+        revisions, as soon as it is known.
+    :param lazy: Whether to leave out the complete diff, None to leave it
+        out if more than LAZY_FILE_COUNT files changed.
+    :return: A (rev_tree, parent_tree, patch) tuple, patch is None if the
+        complete diff was left out.
+    """
+    repository = repository.bzrdir.open_repository()
+    repository.lock_read()
+    try:
+        rev_tree = repository.revision_tree(revid)
+        parent_tree = repository.revision_tree(parent_id)
+        delta = rev_tree.changes_from(parent_tree)
+        job.check_cancelled()
+        job.post(post_changes, delta)
+        if lazy is None:
+            lazy = _changed_file_count(delta) > LAZY_FILE_COUNT
+        if lazy:
+            return (rev_tree, parent_tree, None)
+        output = _JobOutput()
+        show_diff_trees(parent_tree, rev_tree, output, None,
+                        old_label='', new_label='')
+        return (rev_tree, parent_tree, output.getvalue())
+    finally:
+        repository.unlock()
+
+
 class DiffFileView(Gtk.ScrolledWindow):
     """Window for displaying diffs from a diff file"""
 
@@ -127,35 +232,80 @@ class DiffFileView(Gtk.ScrolledWindow):
 class DiffView(DiffFileView):
     """This is the soft and chewy filling for a DiffWindow."""
 
+    # Approximate number of bytes of generated diffs to keep, so that going
+    # back to a file does not generate its diff again.
+    PATCH_CACHE_SIZE = 8 * 1024 * 1024
+
+    # Bytes of a diff inserted into the buffer at a time. Larger diffs are
+    # inserted a chunk at a time while the main loop is idle, so the window
+    # can be used, and the diff scrolled, while they load.
+    LOAD_CHUNK_SIZE = 256 * 1024
+
     def __init__(self):
         super(DiffView, self).__init__()
         self.rev_tree = None
         self.parent_tree = None
+        self._patches = LRUSizeCache(max_size=self.PATCH_CACHE_SIZE,
+                                     compute_size=len)
+        self._load_id = None
+        self.connect('destroy', lambda widget: self._stop_loading())
+
+    def set_trees(self, rev_tree, parent_tree):
+        super(DiffView, self).set_trees(rev_tree, parent_tree)
+        self._stop_loading()
+        self._patches.clear()
+
+    def add_patch(self, specific_files, patch):
+        """Remember the diff generated for specific_files."""
+        if specific_files is not None:
+            specific_files = tuple(specific_files)
+        self._patches.add(specific_files, patch)
 
     def show_diff(self, specific_files):
         """Show the diff for the specified files"""
-        s = StringIO()
-        show_diff_trees(self.parent_tree, self.rev_tree, s, specific_files,
-                        old_label='', new_label='',
-                        # path_encoding=sys.getdefaultencoding()
-                        # The default is utf-8, but we interpret the file
-                        # contents as getdefaultencoding(), so we should
-                        # probably try to make the paths in the same encoding.
-                        )
-        # str.decode(encoding, 'replace') doesn't do anything. Because if a
-        # character is not valid in 'encoding' there is nothing to replace, the
-        # 'replace' is for 'str.encode()'
-        try:
-            decoded = s.getvalue().decode(sys.getdefaultencoding())
-        except UnicodeDecodeError:
-            try:
-                decoded = s.getvalue().decode('UTF-8')
-            except UnicodeDecodeError:
-                decoded = s.getvalue().decode('iso-8859-1')
-                # This always works, because every byte has a valid
-                # mapping from iso-8859-1 to Unicode
-        # TextBuffer must contain pure UTF-8 data
-        self.buffer.set_text(decoded.encode('UTF-8'))
+        if specific_files is not None:
+            specific_files = tuple(specific_files)
+        patch = self._patches.get(specific_files)
+        if patch is None:
+            s = StringIO()
+            show_diff_trees(self.parent_tree, self.rev_tree, s,
+                            specific_files, old_label='', new_label='',
+                            # path_encoding=sys.getdefaultencoding()
+                            # The default is utf-8, but we interpret the file
+                            # contents as getdefaultencoding(), so we should
+                            # probably try to make the paths in the same
+                            # encoding.
+                            )
+            patch = s.getvalue()
+            self._patches.add(specific_files, patch)
+        self.show_patch(patch)
+
+    def show_patch(self, patch):
+        """Show patch, a diff that has already been generated.
+
+        Each chunk is decoded on its own, just before it is inserted, so a
+        file with another encoding only affects its own chunk.
+        """
+        self._stop_loading()
+        chunks = _iter_chunks(patch, self.LOAD_CHUNK_SIZE)
+        self.buffer.set_text(_decode_patch(next(chunks, '')))
+        if len(patch) > self.LOAD_CHUNK_SIZE:
+            # GtkSourceView only highlights the text that is shown, the
+            # chunks inserted later are highlighted once scrolled to.
+            self._load_id = GObject.idle_add(self._load_next_chunk, chunks)
+
+    def _load_next_chunk(self, chunks):
+        for chunk in chunks:
+            self.buffer.insert(self.buffer.get_end_iter(),
+                               _decode_patch(chunk))
+            return True
+        self._load_id = None
+        return False
+
+    def _stop_loading(self):
+        if self._load_id is not None:
+            GObject.source_remove(self._load_id)
+            self._load_id = None
 
 
 class DiffWidget(Gtk.HPaned):
@@ -167,6 +317,8 @@ class DiffWidget(Gtk.HPaned):
 
     def __init__(self):
         super(DiffWidget, self).__init__()
+        self._diff_job = None
+        self.connect('destroy', lambda widget: self._cancel_diff_job())
 
         # The file hierarchy: a scrollable treeview
         scrollwin = Gtk.ScrolledWindow()
@@ -213,12 +365,80 @@ class DiffWidget(Gtk.HPaned):
             self.model.append(None, [oldname, newname])
         self.diff_view.show_diff(None)
 
-    def set_diff(self, rev_tree, parent_tree):
+    def set_diff(self, rev_tree, parent_tree, lazy=None):
         """Set the differences showed by this window.
 
         Compares the two trees and populates the window with the
         differences.
+
+        :param lazy: If True, the complete diff is not generated. The first
+            file is selected instead, and the diff of each file is only
+            generated once it is selected. None to be lazy if more than
+            LAZY_FILE_COUNT files changed.
         """
+        self._cancel_diff_job()
+        self._set_trees(rev_tree, parent_tree)
+        delta = rev_tree.changes_from(parent_tree)
+        self._set_changes(delta)
+        if lazy is None:
+            lazy = _changed_file_count(delta) > LAZY_FILE_COUNT
+        if lazy:
+            self._select_first_file()
+        else:
+            self.diff_view.show_diff(None)
+
+    def set_diff_in_background(self, repository, revid, parent_id,
+                               lazy=None):
+        """Set the differences between two revisions of repository.
+
+        The diff is computed by a background job. The changed files are
+        listed as soon as they are known, the diff is shown once it has been
+        generated. A diff that is still being computed when this is called
+        again is dropped.
+
+        :param lazy: As for set_diff.
+        """
+        self._cancel_diff_job()
+        self._set_trees(None, None)
+        self.model.clear()
+        self.diff_view.buffer.set_text('')
+        self._diff_job = BackgroundJob(_compute_diff,
+            (repository, revid, parent_id, self._set_changes, lazy),
+            callback=self._diff_computed)
+        self._diff_job.start()
+
+    def _cancel_diff_job(self):
+        if self._diff_job is not None:
+            self._diff_job.cancel()
+            self._diff_job = None
+
+    def _diff_computed(self, result):
+        (rev_tree, parent_tree, patch) = result
+        self._diff_job = None
+        self._set_trees(rev_tree, parent_tree)
+        (path, col) = self.treeview.get_cursor()
+        if path is not None and self.model[path][1] not in ("", None):
+            # A file was selected while the diff was computed.
+            self._treeview_cursor_cb()
+        elif patch is None:
+            self._select_first_file()
+        else:
+            # The patch is shown as it is, the cache may not keep it.
+            self.diff_view.add_patch(None, patch)
+            self.diff_view.show_patch(patch)
+
+    def _select_first_file(self):
+        """Select the first changed file, which shows its diff."""
+        # The first row is the complete diff, the next one the first group
+        # of files.
+        group = self.model.iter_next(self.model.get_iter_first())
+        if group is None:
+            self.diff_view.buffer.set_text('')
+        else:
+            path = self.model.get_path(self.model.iter_children(group))
+            self.treeview.set_cursor(path, None, False)
+
+    def _set_trees(self, rev_tree, parent_tree):
         if getattr(self, 'diff_view', None) is None:
             self.diff_view = DiffView()
             self.pack2(self.diff_view)
@@ -228,9 +448,9 @@ class DiffWidget(Gtk.HPaned):
         self.rev_tree = rev_tree
         self.parent_tree = parent_tree
 
+    def _set_changes(self, delta):
+        """List the files changed by delta."""
         self.model.clear()
-        delta = self.rev_tree.changes_from(self.parent_tree)
-
         self.model.append(None, ["Complete Diff", ""])
 
         if len(delta.added):
@@ -255,7 +475,6 @@ class DiffWidget(Gtk.HPaned):
                 self.model.append(titer, [path, path])
 
         self.treeview.expand_all()
-        self.diff_view.show_diff(None)
 
     def set_file(self, file_path):
         """Select the current file to display"""
@@ -272,6 +491,9 @@ class DiffWidget(Gtk.HPaned):
 
     def _treeview_cursor_cb(self, *args):
         """Callback for when the treeview cursor changes."""
+        if self._diff_job is not None:
+            # The file is shown once the diff has been computed.
+            return
         (path, col) = self.treeview.get_cursor()
         if path is None:
             return
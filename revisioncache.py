@@ -0,0 +1,187 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Shared cache of revision metadata.
+
+The branch view, the revision view and gannotate all need revision objects
+for the same revisions over and over again. Fetching them one by one is
+slow, in particular over the network, and keeping every revision that was
+ever shown makes long sessions grow without limit. RevisionCache batches the
+repository calls and keeps the most recently used revisions within a memory
+budget.
+"""
+
+import threading
+import weakref
+
+from bzrlib.config import GlobalConfig
+from bzrlib.lru_cache import LRUSizeCache
+
+
+# Number of revision ids passed to a single Repository.get_revisions call.
+DEFAULT_BATCH_SIZE = 500
+
+# Approximate amount of memory, in bytes, the cached revisions may use.
+DEFAULT_MAX_SIZE = 32 * 1024 * 1024
+
+# Rough size of a Revision object without its variable length strings.
+_REVISION_OVERHEAD = 512
+
+
+def _revision_size(revision):
+    """Estimate the memory used by revision, in bytes."""
+    size = _REVISION_OVERHEAD
+    size += len(revision.revision_id)
+    size += len(revision.message or '')
+    size += len(revision.committer or '')
+    for parent_id in revision.parent_ids:
+        size += len(parent_id)
+    for name, value in revision.properties.iteritems():
+        size += len(name) + len(value)
+    return size
+
+
+def _configured_max_size():
+    """Return the cache budget set by the gtk-revision-cache-size option.
+
+    The option is the number of megabytes to use.
+    """
+    value = GlobalConfig().get_user_option('gtk-revision-cache-size')
+    if value is not None:
+        try:
+            return int(value) * 1024 * 1024
+        except ValueError:
+            pass
+    return DEFAULT_MAX_SIZE
+
+
+class RevisionCache(object):
+    """A bounded LRU cache of the revisions of a repository.
+
+    Misses are fetched from the repository in batches of batch_size
+    revisions. The hits and misses attributes count the lookups made through
+    the cache. The cache may be used from several threads.
+    """
+
+    def __init__(self, repository, max_size=None,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        if max_size is None:
+            max_size = _configured_max_size()
+        self.repository = repository
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._cache = LRUSizeCache(max_size=max_size,
+                                   compute_size=_revision_size)
+
+    def __contains__(self, revision_id):
+        return revision_id in self._cache
+
+    def get_revision(self, revision_id):
+        """Return the revision revision_id.
+
+        :raises NoSuchRevision: if the revision is not in the repository.
+        """
+        return self.get_revisions([revision_id])[0]
+
+    def get_revisions(self, revision_ids):
+        """Return the revisions for revision_ids, in the same order.
+
+        :raises NoSuchRevision: if one of the revisions is not in the
+            repository.
+        """
+        return self._get_revisions(revision_ids, True)
+
+    def get_revisions_uncached(self, revision_ids):
+        """Return the revisions for revision_ids, in the same order.
+
+        Unlike get_revisions(), the revisions that are fetched are not
+        cached, so that reading many revisions once does not push out the
+        ones that are in use. The lookups are not counted either.
+        """
+        return self._get_revisions(revision_ids, False)
+
+    def _get_revisions(self, revision_ids, add):
+        self._lock.acquire()
+        try:
+            found = {}
+            missing = []
+            for revision_id in revision_ids:
+                revision = self._cache.get(revision_id)
+                if revision is not None:
+                    found[revision_id] = revision
+                elif revision_id not in found:
+                    found[revision_id] = None
+                    missing.append(revision_id)
+            if add:
+                self.hits += len(revision_ids) - len(missing)
+                self.misses += len(missing)
+            for revision in self._fetch(missing, add):
+                found[revision.revision_id] = revision
+            return [found[revision_id] for revision_id in revision_ids]
+        finally:
+            self._lock.release()
+
+    def prefetch(self, revision_ids):
+        """Make sure revision_ids are cached, without counting lookups."""
+        self._lock.acquire()
+        try:
+            missing = [revision_id for revision_id in set(revision_ids)
+                       if revision_id not in self._cache]
+            self._fetch(missing)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Drop all the cached revisions."""
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+    def _fetch(self, revision_ids, add=True):
+        """Fetch revision_ids from the repository and cache them, if add.
+
+        Must be called with the lock held.
+        """
+        revisions = []
+        for start in range(0, len(revision_ids), self.batch_size):
+            batch = revision_ids[start:start + self.batch_size]
+            for revision in self.repository.get_revisions(batch):
+                if add:
+                    self._cache.add(revision.revision_id, revision)
+                revisions.append(revision)
+        return revisions
+
+
+_caches = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+
+def get_revision_cache(repository):
+    """Return the RevisionCache shared by all users of repository."""
+    _caches_lock.acquire()
+    try:
+        try:
+            return _caches[repository]
+        except KeyError:
+            # The cache must not keep the repository alive, or it would
+            # never be removed from _caches.
+            cache = RevisionCache(weakref.proxy(repository))
+            _caches[repository] = cache
+            return cache
+    finally:
+        _caches_lock.release()
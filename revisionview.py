@@ -28,6 +28,7 @@ from bzrlib.testament import Testament
 from bzrlib.plugins.gtk import icon_path
 
 from bzrlib.plugins.gtk.avatarsbox import AvatarsBox
+from bzrlib.plugins.gtk.revisioncache import get_revision_cache
 
 try:
     from bzrlib.plugins.gtk import seahorse
@@ -557,7 +558,8 @@ class RevisionView(Gtk.Notebook):
             button.add(revid_label)
             button.connect("clicked",
                     lambda w, r: self.set_revision(
-                        self._repository.get_revision(r)), revid)
+                        get_revision_cache(self._repository).get_revision(r)),
+                    revid)
             button.set_use_underline(False)
             hbox.pack_start(button, True, True, 0)
             button.show_all()
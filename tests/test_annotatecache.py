@@ -0,0 +1,94 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Test the annotation cache."""
+
+import os
+
+from bzrlib import tests
+
+from bzrlib.plugins.gtk.annotate.annotatecache import (
+    AnnotationCache,
+    cached_annotate,
+    )
+
+
+class TestAnnotationCache(tests.TestCaseInTempDir):
+
+    def setUp(self):
+        super(TestAnnotationCache, self).setUp()
+        self.cache = AnnotationCache('cache')
+        self.key = ('file:///repo/', 'file-id', 'rev-1')
+
+    def test_missing(self):
+        self.assertIs(None, self.cache.get(self.key))
+
+    def test_put_get(self):
+        origins = ['rev-1', 'rev-2', 'rev-1'] + ['rev-%d' % i
+                                                 for i in range(300)]
+        self.cache.put(self.key, origins)
+        self.assertEqual(origins, self.cache.get(self.key))
+        self.assertIs(None,
+                      self.cache.get(('file:///repo/', 'file-id', 'rev-2')))
+
+    def test_corrupt_entry_is_removed(self):
+        self.cache.put(self.key, ['rev-1'])
+        path = self.cache._path(self.key)
+        f = open(path, 'wb')
+        try:
+            f.write('garbage')
+        finally:
+            f.close()
+        self.assertIs(None, self.cache.get(self.key))
+        self.assertFalse(os.path.exists(path))
+
+
+class TestCachedAnnotate(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        super(TestCachedAnnotate, self).setUp()
+        self.cache = AnnotationCache('cache')
+        self.tree = self.make_branch_and_tree('tree')
+        self.build_tree_contents([('tree/a', 'one\ntwo\nthree\n')])
+        self.tree.add(['a'], ['a-id'])
+        self.tree.commit('one', rev_id='rev-1')
+        self.build_tree_contents([('tree/a', 'one\n2\nthree\nfour\n')])
+        self.tree.commit('two', rev_id='rev-2')
+        self.tree.lock_read()
+        self.addCleanup(self.tree.unlock)
+        self.repository = self.tree.branch.repository
+
+    def annotate(self, tree):
+        return cached_annotate(self.repository, tree, 'a-id', self.cache)
+
+    def test_revision_tree(self):
+        tree = self.repository.revision_tree('rev-2')
+        expected = list(tree.annotate_iter('a-id'))
+        self.assertEqual(expected, self.annotate(tree))
+        # The second time the annotations come from the cache.
+        tree.annotate_iter = None
+        self.assertEqual(expected, self.annotate(tree))
+
+    def test_from_parent_text(self):
+        self.annotate(self.repository.revision_tree('rev-1'))
+        tree = self.repository.revision_tree('rev-2')
+        expected = list(tree.annotate_iter('a-id'))
+        # Only the changes from rev-1 are annotated.
+        tree.annotate_iter = None
+        self.assertEqual(expected, self.annotate(tree))
+
+    def test_working_tree(self):
+        self.build_tree_contents([('tree/a', 'zero\none\n2\nthree\nfour\n')])
+        self.assertEqual(list(self.tree.annotate_iter('a-id')),
+                         self.annotate(self.tree))
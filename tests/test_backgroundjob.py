@@ -0,0 +1,68 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Test the BackgroundJob functionality."""
+
+from bzrlib import tests
+
+from bzrlib.plugins.gtk.backgroundjob import (
+    BackgroundJob,
+    check_cancelled,
+    current_job,
+    JobCancelled,
+    )
+
+
+class BackgroundJobTestCase(tests.TestCase):
+
+    def make_job(self, function, args=()):
+        self.results = []
+        self.errors = []
+        job = BackgroundJob(function, args, callback=self.results.append,
+                            error_callback=self.errors.append)
+        # Call posted functions right away instead of from the main loop.
+        job.post = lambda function, *args: function(*args)
+        return job
+
+    def test_run_callback(self):
+        job = self.make_job(lambda job, value: (current_job(), value), (3,))
+        job.run()
+        self.assertEqual([(job, 3)], self.results)
+        self.assertEqual([], self.errors)
+        self.assertIs(None, current_job())
+
+    def test_run_error_callback(self):
+        def function(job):
+            raise ValueError('badger')
+        job = self.make_job(function)
+        job.run()
+        self.assertEqual([], self.results)
+        self.assertIs(ValueError, self.errors[0][0])
+
+    def test_cancelled(self):
+        def function(job):
+            job.cancel()
+            check_cancelled()
+            return 'not reached'
+        job = self.make_job(function)
+        job.run()
+        self.assertTrue(job.cancelled)
+        self.assertEqual([], self.results)
+        self.assertEqual([], self.errors)
+
+    def test_check_cancelled_outside_job(self):
+        check_cancelled()
+        job = BackgroundJob(None)
+        job.cancel()
+        self.assertRaises(JobCancelled, job.check_cancelled)
@@ -0,0 +1,70 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Test the branch view benchmarks."""
+
+from bzrlib import tests
+
+from bzrlib.plugins.gtk.branchview import benchmark
+
+
+class TestHistories(tests.TestCase):
+
+    def assertValidHistory(self, history):
+        seen = set()
+        for revid, parent_ids in history:
+            self.assertNotIn(revid, seen)
+            seen.add(revid)
+        revids = [revid for revid, parent_ids in history]
+        # Parents come before their children, or are ghosts.
+        for index, (revid, parent_ids) in enumerate(history):
+            for parent_id in parent_ids:
+                if parent_id in seen:
+                    self.assertTrue(revids.index(parent_id) < index)
+
+    def test_histories(self):
+        for name, make_history in benchmark.HISTORIES:
+            history = make_history(100)
+            self.assertValidHistory(history)
+            self.assertTrue(len(history) >= 90, name)
+
+    def test_octopus_history(self):
+        history = benchmark.octopus_history(50, arms=5)
+        self.assertEqual(6, len(history[-1][1]))
+
+    def test_ghost_heavy_history(self):
+        history = benchmark.ghost_heavy_history(30)
+        revids = set(revid for revid, parent_ids in history)
+        ghosts = set(parent_id for revid, parent_ids in history
+                     for parent_id in parent_ids
+                     if parent_id not in revids)
+        self.assertEqual(9, len(ghosts))
+
+
+class TestRunBenchmarks(tests.TestCaseWithMemoryTransport):
+
+    def test_build_branch(self):
+        history = benchmark.linear_history(20)
+        branch = benchmark.build_branch(history, self.get_url('branch'))
+        self.assertEqual((20, 'linear-19'), branch.last_revision_info())
+
+    def test_run_benchmarks(self):
+        results = benchmark.run_benchmarks(30, ['linear', 'deep'], gui=False,
+                                           url=self.get_url())
+        self.assertEqual(30, results['size'])
+        self.assertEqual(['deep', 'linear'], sorted(results['histories']))
+        linear = results['histories']['linear']
+        self.assertEqual(30, linear['revisions'])
+        self.assertEqual(sorted(benchmark.LINEGRAPH_STAGES + ['total']),
+                         sorted(linear['linegraph']))
@@ -0,0 +1,61 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Test the annotate color maps."""
+
+from bzrlib import tests
+
+from bzrlib.plugins.gtk.annotate.colormap import (
+    AnnotateColorMap,
+    AnnotateColorSaturation,
+    )
+
+
+DAY = 24 * 60 * 60
+
+
+class FakeRevision(object):
+
+    def __init__(self, revision_id, timestamp, committer='Joe <joe@x>'):
+        self.revision_id = revision_id
+        self.timestamp = timestamp
+        self.committer = committer
+        self.properties = {}
+
+
+class TestAnnotateColorMap(tests.TestCase):
+
+    def test_get_color(self):
+        colormap = AnnotateColorMap()
+        now = 1000 * DAY
+        self.assertEqual('#FF0000',
+                         colormap.get_color(FakeRevision('a', now), now))
+        self.assertEqual('#FF0000',
+                         colormap.get_color(FakeRevision('a', now - 20 * DAY),
+                                            now))
+        self.assertEqual('#FF3800',
+                         colormap.get_color(FakeRevision('a', now - 21 * DAY),
+                                            now))
+        self.assertEqual(colormap.really_old_color,
+                         colormap.get_color(FakeRevision('a', 0), now))
+
+    def test_get_colors(self):
+        colormap = AnnotateColorSaturation()
+        now = 1000 * DAY
+        revisions = [FakeRevision('a', now), FakeRevision('b', 0, 'Jane'),
+                     FakeRevision('a', now)]
+        self.assertEqual(
+            {'a': colormap.get_color(revisions[0], now),
+             'b': colormap.get_color(revisions[1], now)},
+            colormap.get_colors(revisions, now))
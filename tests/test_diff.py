@@ -30,6 +30,7 @@ except ImportError: # bzr < 2.5
     from bzrlib.tests import UnicodeFilenameFeature
 from bzrlib.merge_directive import MergeDirective2
 
+from bzrlib.plugins.gtk import diff
 from bzrlib.plugins.gtk.diff import (
     DiffController,
     DiffFileView,
@@ -112,6 +113,31 @@ class TestDiffView(tests.TestCaseWithTransport):
             )
 
 
+    def test_patches_are_cached(self):
+        tree = self.make_branch_and_tree('tree')
+        self.build_tree(['tree/a', 'tree/b'])
+        tree.add(['a', 'b'])
+        view = DiffView()
+        view.set_trees(tree, tree.basis_tree())
+        view.show_diff(['a'])
+        self.assertEqual([('a',)], view._patches.keys())
+        view.add_patch(['b'], 'patch b')
+        view.show_diff(['b'])
+        self.assertEqual('patch b', view.buffer.props.text)
+        # The diffs of other trees are dropped.
+        view.set_trees(tree, tree.basis_tree())
+        self.assertEqual([], view._patches.keys())
+
+    def test_show_patch_in_chunks(self):
+        view = DiffView()
+        view.LOAD_CHUNK_SIZE = 4
+        view.show_patch('+one\n+two\n+three\n')
+        self.assertEqual('+one\n', view.buffer.props.text)
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+        self.assertEqual('+one\n+two\n+three\n', view.buffer.props.text)
+        self.assertIs(None, view._load_id)
+
 
 class FakeDiffWidget(DiffWidget):
 
@@ -137,6 +163,60 @@ class TestDiffWidget(tests.TestCaseWithTransport):
         widget._treeview_cursor_cb(None)
         self.assertFalse(widget.diff_view.show_diff.called)
 
+    def test_set_diff_lazy(self):
+        tree = self.make_branch_and_tree('tree')
+        self.build_tree(['tree/a', 'tree/b'])
+        tree.add(['a', 'b'])
+        widget = FakeDiffWidget()
+        widget.set_diff(tree, tree.basis_tree(), lazy=True)
+        (path, col) = widget.treeview.get_cursor()
+        self.assertEqual('a', widget.model[path][1])
+        text = widget.diff_view.buffer.props.text
+        self.assertContainsRe(text, "=== added file 'a'")
+        self.assertNotContainsRe(text, "=== added file 'b'")
+
+    def test_set_diff_in_background(self):
+        tree = self.make_branch_and_tree('tree')
+        self.build_tree_contents([('tree/a', 'one\n')])
+        tree.add(['a'])
+        parent_id = tree.commit('one')
+        self.build_tree_contents([('tree/a', 'two\n')])
+        revid = tree.commit('two')
+        widget = FakeDiffWidget()
+        widget.set_diff_in_background(tree.branch.repository, revid,
+                                      parent_id)
+        widget._diff_job.join()
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+        self.assertIs(None, widget._diff_job)
+        self.assertEqual(['Complete Diff', 'Modified'],
+                         [row[0] for row in widget.model])
+        self.assertContainsRe(widget.diff_view.buffer.props.text,
+                              '-one\n\+two\n')
+
+    def test_set_diff_in_background_not_cached(self):
+        tree = self.make_branch_and_tree('tree')
+        self.build_tree_contents([('tree/a', 'one\n')])
+        tree.add(['a'])
+        parent_id = tree.commit('one')
+        self.build_tree_contents([('tree/a', 'two\n')])
+        revid = tree.commit('two')
+        # The patch is too large to be cached.
+        self.overrideAttr(DiffView, 'PATCH_CACHE_SIZE', 1)
+        widget = FakeDiffWidget()
+        widget.set_diff_in_background(tree.branch.repository, revid,
+                                      parent_id)
+        widget._diff_job.join()
+        generated = []
+        self.overrideAttr(diff, 'show_diff_trees',
+                          lambda *args, **kwargs: generated.append(args))
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+        # The diff of the job is shown, rather than generated again.
+        self.assertEqual([], generated)
+        self.assertContainsRe(widget.diff_view.buffer.props.text,
+                              '-one\n\+two\n')
+
 
 class FakeDiffWindow(DiffWindow):
 
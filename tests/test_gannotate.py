@@ -0,0 +1,154 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Test the annotate window."""
+
+from gi.repository import Gtk
+
+from bzrlib import tests
+
+from bzrlib.plugins.gtk.annotate import gannotate
+from bzrlib.plugins.gtk.annotate.gannotate import (
+    _get_revisions,
+    COMMITTER_COL,
+    GAnnotateWindow,
+    REVISION_ID_COL,
+    REVNO_COL,
+    RevnoLookup,
+    TEXT_LINE_COL,
+    )
+
+
+class TestGAnnotateWindow(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        super(TestGAnnotateWindow, self).setUp()
+        self.tree = self.make_branch_and_tree('tree')
+        self.build_tree_contents([('tree/a', 'one\ntwo\n')])
+        self.tree.add(['a'], ['a-id'])
+        self.tree.commit('one', rev_id='rev-1', committer='Joe <joe@x>')
+        self.build_tree_contents([('tree/a', 'one\nthree\n')])
+        self.tree.commit('two', rev_id='rev-2', committer='Jane <jane@x>')
+
+    def annotate(self, tree):
+        window = GAnnotateWindow(branch=self.tree.branch)
+        self.addCleanup(window.destroy)
+        self.tree.branch.lock_read()
+        self.addCleanup(self.tree.branch.unlock)
+        window.annotate(tree, self.tree.branch, 'a-id')
+        return window
+
+    def wait_for_annotations(self, window):
+        window._annotate_job.join()
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+        self.assertIs(None, window._annotate_job)
+
+    def test_annotate(self):
+        window = self.annotate(
+            self.tree.branch.repository.revision_tree('rev-2'))
+        # The text is shown before the annotations are known.
+        self.assertEqual(['one', 'three'],
+                         [row[TEXT_LINE_COL] for row in window.annomodel])
+        self.wait_for_annotations(window)
+        self.assertEqual(
+            [('rev-1', 'Joe <joe@x>', '1'), ('rev-2', 'Jane <jane@x>', '2')],
+            [(row[REVISION_ID_COL], row[COMMITTER_COL], row[REVNO_COL])
+             for row in window.annomodel])
+        self.assertEqual('a (2) - gannotate', window.get_title())
+
+    def test_annotate_shorter_text(self):
+        window = self.annotate(
+            self.tree.branch.repository.revision_tree('rev-2'))
+        self.wait_for_annotations(window)
+        # The text annotated has fewer lines than the one shown first.
+        window._annotations_computed((1, {}))
+        self.assertEqual(['one'],
+                         [row[TEXT_LINE_COL] for row in window.annomodel])
+
+    def test_annotate_again(self):
+        tree = self.tree.branch.repository.revision_tree('rev-2')
+        window = self.annotate(tree)
+        self.wait_for_annotations(window)
+        fetched = []
+        def get_revisions(repository, revision_ids):
+            fetched.extend(revision_ids)
+            return {}
+        self.overrideAttr(gannotate, '_get_revisions', get_revisions)
+        # The revisions that were shown before are not fetched again.
+        window.annotate(tree, self.tree.branch, 'a-id')
+        self.wait_for_annotations(window)
+        self.assertEqual([], fetched)
+        self.assertEqual(['rev-1', 'rev-2'],
+                         [row[REVISION_ID_COL] for row in window.annomodel])
+
+    def test_back_before_annotated(self):
+        window = self.annotate(
+            self.tree.branch.repository.revision_tree('rev-2'))
+        window.annoview.set_cursor(Gtk.TreePath(path=1), None, False)
+        # The selected line has no revision yet, there is nothing to go
+        # back to.
+        self.assertFalse(window.back_button.get_sensitive())
+        window.go_back()
+        self.assertEqual([], window.history)
+        self.wait_for_annotations(window)
+
+    def test_get_revisions(self):
+        repository = self.tree.branch.repository
+        revisions = _get_revisions(repository, ['rev-1', 'rev-2'])
+        self.assertEqual(['rev-1', 'rev-2'], sorted(revisions))
+        self.assertEqual('Joe <joe@x>', revisions['rev-1'].committer)
+        # Missing revisions are left out.
+        self.assertEqual(['rev-1'],
+                         sorted(_get_revisions(repository, ['rev-1', 'ghost'])))
+
+
+class TestRevnoLookup(tests.TestCaseWithMemoryTransport):
+
+    def setUp(self):
+        super(TestRevnoLookup, self).setUp()
+        builder = self.make_branch_builder('branch')
+        builder.start_series()
+        builder.build_snapshot('A', None,
+            [('add', ('', 'root-id', 'directory', None))])
+        builder.build_snapshot('B', ['A'], [])
+        builder.build_snapshot('C', ['A'], [])
+        builder.build_snapshot('D', ['B', 'C'], [])
+        builder.finish_series()
+        self.branch = builder.get_branch()
+        self.branch.lock_read()
+        self.addCleanup(self.branch.unlock)
+
+    def test_mainline(self):
+        lookup = RevnoLookup()
+        self.assertEqual({'D': '3', 'A': '1'},
+                         lookup.lookup(self.branch, ['D', 'A', 'ghost']))
+        # The revno map is only loaded for merged revisions.
+        self.assertIs(None, lookup._revno_map)
+
+    def test_merged(self):
+        lookup = RevnoLookup()
+        self.assertEqual({'B': '2', 'C': '1.1.1'},
+                         lookup.lookup(self.branch, ['B', 'C']))
+        self.assertIsNot(None, lookup._revno_map)
+
+    def test_walk_limit(self):
+        self.overrideAttr(RevnoLookup, 'MAINLINE_WALK_LIMIT', 1)
+        lookup = RevnoLookup()
+        self.assertEqual({'A': '1'}, lookup.lookup(self.branch, ['A']))
+        self.assertEqual(['D'], lookup._mainline.keys())
+        self.assertIsNot(None, lookup._revno_map)
+        # Once loaded, the revno map is used for mainline revisions too.
+        self.assertEqual({'B': '2'}, lookup.lookup(self.branch, ['B']))
+        self.assertEqual(['D'], lookup._mainline.keys())
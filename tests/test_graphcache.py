@@ -0,0 +1,123 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Test the line graph cache."""
+
+import os
+
+from bzrlib import (
+    graph,
+    tests,
+    )
+
+from bzrlib.plugins.gtk.branchview import graphcache
+from bzrlib.plugins.gtk.branchview.graphcache import (
+    cached_linegraph,
+    LineGraphCache,
+    load_linegraph,
+    store_linegraph,
+    )
+from bzrlib.plugins.gtk.branchview.linegraph import (
+    linegraph,
+    update_linegraph,
+    )
+
+
+class FakeRepository(object):
+
+    user_url = 'file:///repo/'
+
+    def __init__(self, parent_map):
+        self.parent_map = parent_map
+
+    def get_graph(self):
+        return graph.Graph(graph.DictParentsProvider(self.parent_map))
+
+
+class TestLineGraphCache(tests.TestCaseInTempDir):
+
+    def setUp(self):
+        super(TestLineGraphCache, self).setUp()
+        self.cache = LineGraphCache('cache')
+        self.repository = FakeRepository(
+            {'A': ('B', 'C'), 'B': ('D', 'E'), 'C': ('D',), 'D': (),
+             'E': ('ghost',)})
+        self.key = ('file:///repo/', ('A',), None, None, True, False)
+
+    def assertSameLineGraph(self, expected, state):
+        # Parents are always returned as tuples from the cache.
+        def normalize(result):
+            rows = [row[:3] + [tuple(row[3])] + row[4:] for row in result[0]]
+            return (rows,) + result[1:]
+        self.assertEqual(normalize(expected), normalize(state.get_result()))
+
+    def test_cached_linegraph(self):
+        expected = linegraph(self.repository.get_graph(), ['A'])
+        state = cached_linegraph(self.repository, ['A'], cache=self.cache)
+        self.assertSameLineGraph(expected, state)
+        cached = self.cache.get(self.key, self.repository.get_graph())
+        self.assertSameLineGraph(expected, cached)
+        self.assertEqual(set(['ghost']), cached.ghosts)
+
+    def test_cached_linegraph_fills_state(self):
+        cached_linegraph(self.repository, ['A'], cache=self.cache)
+        state = cached_linegraph(self.repository, ['A'], cache=self.cache)
+        self.assertEqual(['A'], state.start_revs)
+        self.assertEqual(set(['ghost']), state.ghosts)
+        # Rows only keep their lines in the compact graph.
+        self.assertEqual([None] * 5, [row[2] for row in state.line_graph])
+
+    def test_load_linegraph(self):
+        self.assertIs(None,
+            load_linegraph(self.repository, ['A'], cache=self.cache))
+        expected = linegraph(self.repository.get_graph(), ['A'])
+        cached_linegraph(self.repository, ['A'], cache=self.cache)
+        state = load_linegraph(self.repository, ['A'], cache=self.cache)
+        self.assertSameLineGraph(expected, state)
+
+    def test_store_linegraph(self):
+        state = cached_linegraph(self.repository, ['C'], cache=self.cache)
+        self.repository.parent_map['F'] = ('C',)
+        update_linegraph(self.repository.get_graph(), state, ['F'])
+        store_linegraph(self.repository, state, cache=self.cache)
+        expected = linegraph(self.repository.get_graph(), ['F'])
+        key = ('file:///repo/', ('F',), None, None, True, False)
+        cached = self.cache.get(key, self.repository.get_graph())
+        self.assertSameLineGraph(expected, cached)
+
+    def test_get_missing(self):
+        self.assertIs(None,
+            self.cache.get(self.key, self.repository.get_graph()))
+
+    def test_get_stale(self):
+        cached_linegraph(self.repository, ['A'], cache=self.cache)
+        self.repository.parent_map['ghost'] = ()
+        self.assertIs(None,
+            self.cache.get(self.key, self.repository.get_graph()))
+        self.assertEqual([], os.listdir('cache'))
+
+    def test_get_corrupt(self):
+        os.mkdir('cache')
+        self.build_tree_contents(
+            [(self.cache._path(self.key), graphcache.FORMAT + 'junk')])
+        self.assertIs(None,
+            self.cache.get(self.key, self.repository.get_graph()))
+        self.assertEqual([], os.listdir('cache'))
+
+    def test_prune(self):
+        self.overrideAttr(graphcache, 'MAX_ENTRIES', 2)
+        for maxnum in range(1, 4):
+            cached_linegraph(self.repository, ['A'], maxnum=maxnum,
+                             cache=self.cache)
+        self.assertEqual(2, len(os.listdir('cache')))
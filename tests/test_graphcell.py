@@ -16,6 +16,9 @@
 
 """Test the CellRendererGraph functionality."""
 
+import cairo
+
+from gi.repository import Gdk
 from gi.repository import Gtk
 
 from bzrlib import (
@@ -33,6 +36,70 @@ class CellRendererGraphTestCase(tests.TestCase):
         cell.columns_len = 1
         self.assertEqual(1, cell.columns_len)
 
+    def test_graph(self):
+        # Without a graph, the node and lines come from the properties.
+        cell = CellRendererGraph()
+        self.assertIs(None, cell.graph)
+        self.assertEqual(0, cell.row)
+
+    def test_clear_cache(self):
+        cell = CellRendererGraph()
+        cell._box_size = 21
+        cell._surfaces['key'] = 'surface'
+        cell.clear_cache()
+        self.assertFalse(hasattr(cell, '_box_size'))
+        self.assertIs(None, cell._surfaces.get('key'))
+
+    def make_cell(self):
+        cell = CellRendererGraph()
+        cell.columns_len = 1
+        cell._box_size = 21
+        cell.node = (0, 0)
+        cell.in_lines = [(0, 0, 0)]
+        cell.out_lines = [(0, 0, 0)]
+        cell.tags = []
+        render_cell = cell.render_cell
+        cell.rendered = []
+        def counting_render_cell(*args):
+            cell.rendered.append(args)
+            return render_cell(*args)
+        cell.render_cell = counting_render_cell
+        return cell
+
+    def render(self, cell):
+        """Render cell to a new surface, and return its pixels."""
+        widget = Gtk.TreeView()
+        (x, y, width, height) = cell.do_get_size(widget, None)
+        area = Gdk.Rectangle()
+        area.x = area.y = 0
+        area.width = width
+        area.height = height
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        cell.do_render(cairo.Context(surface), widget, area, area, 0)
+        surface.flush()
+        return str(surface.get_data())
+
+    def test_render_is_cached(self):
+        cell = self.make_cell()
+        pixels = self.render(cell)
+        self.assertNotEqual('\0' * len(pixels), pixels)
+        self.assertEqual(1, len(cell.rendered))
+        # The same cell is painted from the cache.
+        self.assertEqual(pixels, self.render(cell))
+        self.assertEqual(1, len(cell.rendered))
+        # Other contents are drawn.
+        cell.out_lines = []
+        self.assertNotEqual(pixels, self.render(cell))
+        self.assertEqual(2, len(cell.rendered))
+
+    def test_render_after_clear_cache(self):
+        cell = self.make_cell()
+        pixels = self.render(cell)
+        cell.clear_cache()
+        cell._box_size = 21
+        self.assertEqual(pixels, self.render(cell))
+        self.assertEqual(2, len(cell.rendered))
+
     def test_props_writeonly(self):
         # Props can be set, but not read, though they can be accessed
         # as attributes
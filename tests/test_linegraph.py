@@ -21,7 +21,17 @@ from bzrlib import (
     tests,
     )
 
-from bzrlib.plugins.gtk.branchview.linegraph import linegraph
+from bzrlib.plugins.gtk.branchview import linegraph as linegraph_module
+from bzrlib.plugins.gtk.branchview.linegraph import (
+    _add_line_segments,
+    _branch_line_range,
+    _Column,
+    CompactLineGraph,
+    linegraph,
+    LineGraphState,
+    PagedLineGraph,
+    update_linegraph,
+    )
 
 
 class TestLinegraph(tests.TestCase):
@@ -39,3 +49,221 @@ class TestLinegraph(tests.TestCase):
              {'A': 0, 'B': 1},
              1))
 
+    def test_ghosts(self):
+        state = LineGraphState()
+        lg = linegraph(self.get_graph({"A": ("B", "G1", "G2"), "B": ("G1",),
+                                       "C": ("G2",)}),
+                       ["A", "C"], state=state)
+        self.assertEqual({'A': ['B'], 'B': [], 'C': []},
+                         dict((row[0], list(row[3])) for row in lg[0]))
+        self.assertEqual(set(["G1", "G2"]), state.ghosts)
+
+    def test_processes(self):
+        self.overrideAttr(linegraph_module, 'PARALLEL_MIN_ROWS', 0)
+        parent_map = {"A": ("B", "C"), "B": ("D",), "C": ("E",), "D": ("F",),
+                      "E": ("F",), "F": ("G", "H"), "G": (), "H": ()}
+        for broken_line_length in (None, 2):
+            self.assertEqual(
+                linegraph(self.get_graph(parent_map), ["A"],
+                          broken_line_length=broken_line_length),
+                linegraph(self.get_graph(parent_map), ["A"],
+                          broken_line_length=broken_line_length, processes=2))
+
+    def test_mainline_only(self):
+        lg = linegraph(self.get_graph({"A": (), "B": ("A",), "M": ("A",),
+                                       "C": ("G", "B"), "D": ("C", "M")}),
+                       ["D"], mainline_only=True)
+        self.assertEquals(lg,
+            ([
+               ['D', (0, 0), [(0, 0, 0)], ('C', 'M'), [], (4,)],
+               ['C', (0, 0), [(0, 0, 0)], ['B'], ['D'], (3,)],
+               ['B', (0, 0), [(0, 0, 0)], ('A',), ['C'], (2,)],
+               ['A', (0, 0), [], (), ['B'], (1,)]
+             ],
+             {'A': 3, 'B': 2, 'C': 1, 'D': 0},
+             1))
+
+
+class TestUpdateLinegraph(tests.TestCase):
+
+    def setUp(self):
+        super(TestUpdateLinegraph, self).setUp()
+        self.parent_map = {"A": ("B", "C"), "B": ("D",), "C": ("D",),
+                           "D": ()}
+        self.state = LineGraphState()
+        linegraph(self.get_graph(), ["A"], state=self.state)
+
+    def get_graph(self):
+        return graph.Graph(graph.DictParentsProvider(self.parent_map))
+
+    def test_unchanged(self):
+        result = self.state.get_result()
+        self.assertEqual((0, []),
+            update_linegraph(self.get_graph(), self.state, ["A"]))
+        self.assertEqual(result, self.state.get_result())
+
+    def test_new_revisions(self):
+        self.parent_map["E"] = ("A", "F")
+        self.parent_map["F"] = ("C",)
+        self.assertEqual((2, [2, 3]),
+            update_linegraph(self.get_graph(), self.state, ["E"]))
+        # F carries on the branch of C, in the same column.
+        self.assertEqual(linegraph(self.get_graph(), ["E"]),
+                         self.state.get_result())
+
+    def test_old_tip_not_on_mainline(self):
+        self.parent_map["E"] = ("B", "A")
+        result = self.state.get_result()
+        self.assertIs(None,
+            update_linegraph(self.get_graph(), self.state, ["E"]))
+        self.assertEqual(result, self.state.get_result())
+
+    def test_different_arguments(self):
+        self.parent_map["E"] = ("A",)
+        self.assertIs(None,
+            update_linegraph(self.get_graph(), self.state, ["E"],
+                             broken_line_length=32))
+
+
+class TestPagedLineGraph(tests.TestCase):
+
+    def setUp(self):
+        super(TestPagedLineGraph, self).setUp()
+        self.parent_map = {"A": ("B", "F"), "B": ("C", "E"), "C": ("D",),
+                           "D": (), "E": ("D",), "F": ("E",)}
+
+    def get_graph(self):
+        return graph.Graph(graph.DictParentsProvider(self.parent_map))
+
+    def get_rows(self, paged):
+        return [(paged.graph.node(i), paged.graph.lines(i))
+                for i in range(paged.laid_out)]
+
+    def test_single_page(self):
+        paged = PagedLineGraph(self.get_graph(), ["A"])
+        paged.extend(10)
+        self.assertTrue(paged.is_complete())
+        self.assertEqual(linegraph(self.get_graph(), ["A"]),
+                         paged.get_state().get_result())
+
+    def test_pages_keep_rows(self):
+        paged = PagedLineGraph(self.get_graph(), ["A"])
+        self.assertEqual(6, len(paged.line_graph))
+        pages = []
+        while not paged.is_complete():
+            paged.extend(2)
+            pages.append(self.get_rows(paged))
+        self.assertEqual([2, 4, 6], [len(rows) for rows in pages])
+        for rows in pages:
+            self.assertEqual(rows, pages[-1][:len(rows)])
+        # Once laid out, the lines are only kept in graph.
+        self.assertEqual([None] * 6, [row[2] for row in paged.line_graph])
+
+    def test_get_state(self):
+        paged = PagedLineGraph(self.get_graph(), ["A"], 32)
+        paged.extend(3)
+        paged.extend(3)
+        state = paged.get_state()
+        self.parent_map["G"] = ("A",)
+        self.assertEqual((1, [1]),
+            update_linegraph(self.get_graph(), state, ["G"], 32))
+
+
+class TestCompactLineGraph(tests.TestCase):
+
+    def test_rows(self):
+        line_graph = [
+            ['A', (0, 1), [(0, None, 2), (1, 0, 0)], (), [], (2,)],
+            ['B', None, [], (), [], (1,)],
+            ['C', (1, 0), [(None, 1, 0)], (), [], (1, 1, 1)]]
+        graph = CompactLineGraph(line_graph)
+        self.assertEqual(3, len(graph))
+        self.assertEqual([(0, 1), None, (1, 0)],
+                         [graph.node(i) for i in range(3)])
+        self.assertEqual([row[2] for row in line_graph],
+                         [graph.lines(i) for i in range(3)])
+
+    def test_extended(self):
+        graph = CompactLineGraph([
+            ['A', (0, 0), [(0, 0, 0)], (), [], (2,)],
+            ['B', (0, 0), [], (), [], (1,)]])
+        line_graph = [
+            ['C', (1, 1), [(1, 0, 0)], (), [], (3,)],
+            ['A', (0, 0), [(0, 0, 0), (1, 1, 1)], (), [], (2,)],
+            ['B', (0, 0), [], (), [], (1,)]]
+        extended = graph.extended(line_graph, 1, [1])
+        self.assertEqual([(1, 1), (0, 0), (0, 0)],
+                         [extended.node(i) for i in range(3)])
+        self.assertEqual([row[2] for row in line_graph],
+                         [extended.lines(i) for i in range(3)])
+        # The graph that was extended is left alone.
+        self.assertEqual([(0, 0, 0)], graph.lines(0))
+
+    def get_line_graph(self, row_count):
+        return [['R%d' % i, (i % 2, i), [], (), [], (i,)]
+                for i in range(row_count)]
+
+    def test_add_lines(self):
+        line_graph = self.get_line_graph(40)
+        lines = [(0, 1, [0]), (1, 30, [2]), (2, 38, [3, 4]), (3, 6, [5, 6])]
+        graph = CompactLineGraph(line_graph)
+        graph.add_lines(line_graph, lines)
+        for child_index, parent_index, line_col_indexes in lines:
+            _add_line_segments(line_graph, child_index, parent_index,
+                               line_col_indexes)
+        self.assertEqual([row[2] for row in line_graph],
+                         [graph.lines(i) for i in range(40)])
+        # Only one entry is kept for each line.
+        self.assertEqual(4, len(graph.line_children))
+        self.assertEqual(0, len(graph.segments))
+
+    def test_extended_lines(self):
+        line_graph = self.get_line_graph(40)
+        graph = CompactLineGraph(line_graph[2:])
+        graph.add_lines(line_graph[2:], [(0, 20, [2])])
+        graph = graph.extended(line_graph, 2, [], [(0, 10, [3]),
+                                                   (1, 30, [4, 5])])
+        for child_index, parent_index, line_col_indexes in [
+            (2, 22, [2]), (0, 10, [3]), (1, 30, [4, 5])]:
+            _add_line_segments(line_graph, child_index, parent_index,
+                               line_col_indexes)
+        self.assertEqual([row[2] for row in line_graph],
+                         [graph.lines(i) for i in range(40)])
+
+
+class TestColumn(tests.TestCase):
+
+    def test_use_merges_runs(self):
+        column = _Column()
+        column.use(5, 6)
+        column.use(1, 2)
+        self.assertEqual([(1, 2), (5, 6)], column.runs())
+        column.use(3, 3)
+        self.assertEqual([(1, 3), (5, 6)], column.runs())
+        column.use(4, 8)
+        self.assertEqual([(1, 8)], column.runs())
+
+    def test_is_free(self):
+        column = _Column()
+        self.assertTrue(column.is_free([(0, 100)]))
+        column.use(5, 6)
+        column.use(10, 10)
+        self.assertTrue(column.is_free([(0, 4), (7, 9)]))
+        self.assertFalse(column.is_free([(0, 5)]))
+        self.assertFalse(column.is_free([(7, 12)]))
+        self.assertFalse(column.is_free([(0, 1), (10, 10)]))
+
+    def test_shifted(self):
+        column = _Column()
+        column.use(0, 1)
+        shifted = column.shifted(3)
+        shifted.use(0, 0)
+        self.assertEqual([(0, 0), (3, 4)], shifted.runs())
+        self.assertFalse(shifted.is_free([(4, 4)]))
+        # The original is left alone.
+        self.assertEqual([(0, 1)], column.runs())
+
+    def test_branch_line_range(self):
+        self.assertEqual([(1, 8)], _branch_line_range([1, 5], 9, None))
+        # Long lines are broken, only their ends need free rows.
+        self.assertEqual([(1, 2), (4, 6)], _branch_line_range([1, 5], 9, 2))
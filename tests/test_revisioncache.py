@@ -0,0 +1,108 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Test the RevisionCache functionality."""
+
+from bzrlib import (
+    errors,
+    tests,
+    )
+
+from bzrlib.plugins.gtk.revisioncache import (
+    get_revision_cache,
+    RevisionCache,
+    )
+from bzrlib.plugins.gtk.tests import MockMethod
+
+
+class RevisionCacheTestCase(tests.TestCaseWithMemoryTransport):
+
+    def make_test_branch(self):
+        builder = self.make_branch_builder('test')
+        builder.start_series()
+        builder.build_snapshot(
+            'A', None, [('add', ('', 'root-id', 'directory', None))])
+        builder.build_snapshot('B', ['A'], [])
+        builder.build_snapshot('C', ['B'], [])
+        builder.finish_series()
+        return builder.get_branch()
+
+    def test_get_revisions(self):
+        branch = self.make_test_branch()
+        cache = RevisionCache(branch.repository)
+        revisions = cache.get_revisions(['C', 'A'])
+        self.assertEqual(['C', 'A'], [r.revision_id for r in revisions])
+        self.assertEqual(0, cache.hits)
+        self.assertEqual(2, cache.misses)
+        self.assertEqual('A', cache.get_revision('A').revision_id)
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(2, cache.misses)
+
+    def test_get_revisions_batches(self):
+        branch = self.make_test_branch()
+        cache = RevisionCache(branch.repository, batch_size=2)
+        get_revisions = branch.repository.get_revisions
+        calls = []
+        def counting_get_revisions(revision_ids):
+            calls.append(list(revision_ids))
+            return get_revisions(revision_ids)
+        branch.repository.get_revisions = counting_get_revisions
+        cache.get_revisions(['A', 'B', 'C', 'A'])
+        self.assertEqual([['A', 'B'], ['C']], calls)
+
+    def test_get_revisions_uncached(self):
+        branch = self.make_test_branch()
+        cache = RevisionCache(branch.repository)
+        cache.get_revision('A')
+        revisions = cache.get_revisions_uncached(['A', 'B'])
+        self.assertEqual(['A', 'B'], [r.revision_id for r in revisions])
+        self.assertIn('A', cache)
+        self.assertNotIn('B', cache)
+        self.assertEqual(1, cache.misses)
+
+    def test_get_revision_missing(self):
+        branch = self.make_test_branch()
+        cache = RevisionCache(branch.repository)
+        self.assertRaises(errors.NoSuchRevision, cache.get_revision, 'D')
+
+    def test_prefetch(self):
+        branch = self.make_test_branch()
+        cache = RevisionCache(branch.repository)
+        cache.prefetch(['A', 'B'])
+        self.assertIn('A', cache)
+        self.assertNotIn('C', cache)
+        self.assertEqual(0, cache.misses)
+        MockMethod.bind(self, branch.repository, 'get_revisions')
+        cache.get_revision('A')
+        self.assertFalse(branch.repository.get_revisions.called)
+
+    def test_max_size(self):
+        branch = self.make_test_branch()
+        cache = RevisionCache(branch.repository, max_size=1)
+        cache.get_revision('A')
+        self.assertNotIn('A', cache)
+
+    def test_clear(self):
+        branch = self.make_test_branch()
+        cache = RevisionCache(branch.repository)
+        cache.get_revision('A')
+        cache.clear()
+        self.assertNotIn('A', cache)
+
+    def test_get_revision_cache_is_shared(self):
+        branch = self.make_test_branch()
+        cache = get_revision_cache(branch.repository)
+        self.assertIs(cache, get_revision_cache(branch.repository))
+        self.assertIsNot(
+            cache, get_revision_cache(self.make_repository('other')))
@@ -0,0 +1,75 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Test the quick search index of the branch view."""
+
+from bzrlib import tests
+from bzrlib.revision import Revision
+
+from bzrlib.plugins.gtk.branchview.searchindex import (
+    SearchIndex,
+    split_words,
+    )
+
+
+class TestSearchIndex(tests.TestCase):
+
+    def setUp(self):
+        super(TestSearchIndex, self).setUp()
+        self.index = SearchIndex()
+        self.index.add_revnos([('a', (1,)), ('b', (2,)), ('c', (1, 1, 1)),
+                               ('d', (12,))])
+
+    def get_revision(self, revid, message, author):
+        return Revision(revid, message=message, committer=author)
+
+    def test_split_words(self):
+        self.assertEqual(set([u'fix', u'the', u'bug', u'42']),
+                         split_words('Fix the bug #42, the bug.'))
+
+    def test_revnos(self):
+        self.assertEqual(set(['a', 'c', 'd']), self.index.search('1'))
+        self.assertEqual(set(['c']), self.index.search('1.1'))
+        self.assertEqual(set(['d']), self.index.search('12'))
+
+    def test_revnos_added_later(self):
+        self.assertEqual(set(['d']), self.index.search('12'))
+        self.index.add_revnos([('e', (11,)), ('f', (120,))])
+        self.assertEqual(set(['a', 'c', 'd', 'e', 'f']),
+                         self.index.search('1'))
+        self.assertEqual(set(['d', 'f']), self.index.search('12'))
+
+    def test_words(self):
+        self.index.add_revisions([
+            self.get_revision('a', 'Fix the search', 'Joe <joe@example.com>'),
+            self.get_revision('b', 'Search faster', 'Jane <jane@example.com>')])
+        self.assertEqual(set(['a', 'b']), self.index.search('sear'))
+        self.assertEqual(set(['b']), self.index.search('SEARCH fast'))
+        self.assertEqual(set(['a']), self.index.search('joe'))
+        self.assertEqual(set(), self.index.search('slower'))
+
+    def test_message_substring(self):
+        self.index.add_revisions([
+            self.get_revision('a', 'Rename foo_bar', 'Joe')])
+        self.assertEqual(set(), self.index.search('o_B'))
+        self.assertTrue(self.index.message_contains('a', 'o_B'))
+        self.assertTrue(self.index.message_contains('a', 'me foo'))
+        self.assertFalse(self.index.message_contains('a', 'foo bar'))
+
+    def test_is_indexed(self):
+        version = self.index.version
+        self.index.add_revisions([self.get_revision('a', 'Foo', 'Joe')])
+        self.assertTrue(self.index.is_indexed('a'))
+        self.assertFalse(self.index.is_indexed('b'))
+        self.assertNotEqual(version, self.index.version)
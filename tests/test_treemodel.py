@@ -21,11 +21,28 @@ from time import (
     localtime,
     )
 
+from gi.repository import Gtk
+
 from bzrlib import (
     tests,
     )
 
-from bzrlib.plugins.gtk.branchview.treemodel import BranchTreeModel
+from bzrlib.plugins.gtk.branchview.linegraph import CompactLineGraph
+from bzrlib.plugins.gtk.branchview.treemodel import (
+    AUTHORS,
+    BranchTreeModel,
+    CHILDREN,
+    COMMITTER,
+    MESSAGE,
+    PARENTS,
+    REVID,
+    REVISION,
+    REVNO,
+    SUMMARY,
+    TAGS,
+    TIMESTAMP,
+    )
+from bzrlib.plugins.gtk.revisioncache import get_revision_cache
 
 
 class BranchTreeModelTestCase(tests.TestCaseWithMemoryTransport):
@@ -45,7 +62,8 @@ class BranchTreeModelTestCase(tests.TestCaseWithMemoryTransport):
         self.assertEqual(branch, model.branch)
         self.assertEqual(branch.repository, model.repository)
         self.assertEqual({'A': [u'2.0']}, model.tags)
-        self.assertEqual({}, model.revisions)
+        self.assertIs(
+            get_revision_cache(branch.repository), model.revision_cache)
         self.assertEqual([], model.line_graph_data)
 
     def test_add_tag_create(self):
@@ -63,39 +81,193 @@ class BranchTreeModelTestCase(tests.TestCaseWithMemoryTransport):
         model.add_tag('2.1', revision.revision_id)
         self.assertEqual({'A': ['2.0', '2.1']}, model.tags)
 
-    def test_line_graph_item_to_model_row(self):
+    def test_get_value(self):
         branch = self.make_test_branch(
             'A', message='badger', committer='fnord')
         revision = branch.repository.get_revision('A')
         branch.tags.set_tag('2.0', revision.revision_id)
         model = BranchTreeModel(branch, [])
-        data_item = (
-            revision.revision_id, (1, 0), (5, 6, 0.5), ('B'), ('C'), [12, 34])
-        row = model._line_graph_item_to_model_row(0, data_item)
-        self.assertEqual(revision.revision_id, row[0], 'Wrong revid.')
-        self.assertEqual((1, 0), row[1], 'Wrong node.')
-        self.assertEqual((5, 6, 0.5), row[2], 'Wrong lines.')
-        self.assertEqual([], row[3], 'Wrong last_lines.')
-        self.assertEqual('12.34', row[4], 'Wrong revno.')
-        self.assertEqual('badger', row[5], 'Wrong summary.')
-        self.assertEqual('badger', row[6], 'Wrong message.')
-        self.assertEqual('fnord', row[7], 'wrong committer.')
+        model.set_line_graph_data([
+            (revision.revision_id, (0, 0), [], ('B'), ('C'), [12, 34])])
+        model.load_rows(0, 0)
+        tree_iter = model.get_iter_first()
+        self.assertEqual(revision.revision_id,
+                         model.get_value(tree_iter, REVID), 'Wrong revid.')
+        self.assertEqual('12.34', model.get_value(tree_iter, REVNO),
+                         'Wrong revno.')
+        self.assertEqual('badger', model.get_value(tree_iter, SUMMARY),
+                         'Wrong summary.')
+        self.assertEqual('badger', model.get_value(tree_iter, MESSAGE),
+                         'Wrong message.')
+        self.assertEqual('fnord', model.get_value(tree_iter, COMMITTER),
+                         'wrong committer.')
         self.assertEqual(
             strftime("%Y-%m-%d %H:%M", localtime(revision.timestamp)),
-            row[8], 'Wrong timestamp.')
-        self.assertEqual(revision, row[9], 'Wrong revision.')
-        self.assertEqual(('B'), row[10], 'Wrong parents.')
-        self.assertEqual(('C'), row[11], 'Wrong children.')
-        self.assertEqual(['2.0'], row[12], 'Wrong tags.')
-        self.assertEqual('fnord', row[13], 'Wrong authors.')
+            model.get_value(tree_iter, TIMESTAMP), 'Wrong timestamp.')
+        self.assertEqual(revision, model.get_value(tree_iter, REVISION),
+                         'Wrong revision.')
+        self.assertEqual(('B'), model.get_value(tree_iter, PARENTS),
+                         'Wrong parents.')
+        self.assertEqual(('C'), model.get_value(tree_iter, CHILDREN),
+                         'Wrong children.')
+        self.assertEqual(['2.0'], model.get_value(tree_iter, TAGS),
+                         'Wrong tags.')
+        self.assertEqual('fnord', model.get_value(tree_iter, AUTHORS),
+                         'Wrong authors.')
 
     def test_set_line_graph_data(self):
         branch = self.make_test_branch(
             'A', message='badger', committer='fnord')
         rev_id = branch.repository.get_revision('A').revision_id
         model = BranchTreeModel(branch, [])
-        data = [(rev_id, (2, 0), (3, 4, 0.5), None, None, [1, 2])]
+        data = [(rev_id, (2, 0), [(3, 4, 0)], None, None, [1, 2])]
         model.set_line_graph_data(data)
         self.assertEqual(data, model.line_graph_data)
         tree_iter = model.get_iter_first()
         self.assertEqual(rev_id, model.get_value(tree_iter, 0))
+        self.assertEqual((2, 0), model.graph.node(0))
+        self.assertEqual([(3, 4, 0)], model.graph.lines(0))
+
+    def test_set_line_graph_data_is_lazy(self):
+        branch = self.make_test_branch(
+            'A', message='badger', committer='fnord')
+        model = BranchTreeModel(branch, [])
+        data = [('A', (0, 0), [], (), [], [1])]
+        model.set_line_graph_data(data)
+        self.assertNotIn('A', model.revision_cache)
+        tree_iter = model.get_iter_first()
+        self.assertIs(None, model.get_value(tree_iter, REVISION))
+        self.assertEqual('', model.get_value(tree_iter, SUMMARY))
+
+    def test_load_rows(self):
+        branch = self.make_test_branch(
+            'A', message='badger', committer='fnord')
+        model = BranchTreeModel(branch, [])
+        model.set_line_graph_data([('A', (0, 0), [], (), [], [1])])
+        # Rows outside of the model are ignored.
+        model.load_rows(-10, 10)
+        self.assertIn('A', model.revision_cache)
+        tree_iter = model.get_iter_first()
+        self.assertEqual('badger', model.get_value(tree_iter, SUMMARY))
+
+    def test_get_revision(self):
+        branch = self.make_test_branch('A')
+        model = BranchTreeModel(branch, [])
+        model.set_line_graph_data([('A', (0, 0), [], (), [], [1])])
+        revision = model.get_revision(0)
+        self.assertEqual('A', revision.revision_id)
+
+    def test_set_line_graph_data_initial_rows(self):
+        branch = self.make_test_branch('A')
+        model = BranchTreeModel(branch, [])
+        data = [('A', (0, 0), [], (), [], [1])] * 5
+        model.set_line_graph_data(data, 2)
+        self.assertEqual(2, len(model))
+        self.assertTrue(model.add_more_rows(2))
+        self.assertEqual(4, len(model))
+        self.assertFalse(model.add_more_rows(2))
+        self.assertEqual(5, len(model))
+
+    def test_add_more_rows_laid_out(self):
+        branch = self.make_test_branch('A')
+        model = BranchTreeModel(branch, [])
+        data = [['A', (0, 0), [], (), [], [1]] for i in range(5)]
+        graph = CompactLineGraph(data[:3])
+        model.set_line_graph_data(data, 2, graph)
+        # Only the rows in graph have been laid out.
+        self.assertFalse(model.add_more_rows(2))
+        self.assertEqual(3, len(model))
+        graph._append_rows(data[3:])
+        self.assertFalse(model.add_more_rows(2))
+        self.assertEqual(5, len(model))
+
+    def test_fill_to(self):
+        branch = self.make_test_branch('A')
+        model = BranchTreeModel(branch, [])
+        model.set_line_graph_data([('A', (0, 0), [], (), [], [1])] * 5, 0)
+        model.fill_to(2)
+        self.assertEqual(3, len(model))
+        model.fill_to(1)
+        self.assertEqual(3, len(model))
+
+    def test_insert_line_graph_rows(self):
+        branch = self.make_test_branch('A', message='badger')
+        model = BranchTreeModel(branch, [])
+        model.set_line_graph_data([('A', (0, 0), [], (), [], [1])])
+        model.load_rows(0, 0)
+        data = [['B', (0, 0), [(0, 0, 0)], ('A',), [], (2,)],
+                ['A', (0, 0), [], (), ['B'], (1,)]]
+        graph = CompactLineGraph(data)
+        model.insert_line_graph_rows(data, graph, 1, [1])
+        self.assertEqual(data, model.line_graph_data)
+        self.assertIs(graph, model.graph)
+        self.assertEqual(['B', 'A'], [row[0] for row in model])
+        self.assertEqual(['B'], model[1][CHILDREN])
+        # Rows that were loaded stay loaded.
+        self.assertEqual('badger', model[1][SUMMARY])
+
+    def make_three_rows(self):
+        return [['C', (0, 0), [(0, 0, 0)], ('B',), [], (3,)],
+                ['B', (0, 0), [(0, 0, 0)], ('A',), ['C'], (2,)],
+                ['A', (0, 0), [], (), ['B'], (1,)]]
+
+    def test_get_iter(self):
+        branch = self.make_test_branch('A')
+        model = BranchTreeModel(branch, self.make_three_rows())
+        for rowref in range(3):
+            tree_iter = model.get_iter(Gtk.TreePath(path=rowref))
+            self.assertEqual([rowref],
+                             model.get_path(tree_iter).get_indices())
+            self.assertEqual(str(3 - rowref),
+                             model.get_value(tree_iter, REVNO))
+        self.assertRaises(ValueError, model.get_iter, Gtk.TreePath(path=3))
+
+    def test_iter_next(self):
+        branch = self.make_test_branch('A')
+        model = BranchTreeModel(branch, self.make_three_rows())
+        tree_iter = model.get_iter_first()
+        next_iter = model.iter_next(tree_iter)
+        self.assertEqual([1], model.get_path(next_iter).get_indices())
+        self.assertEqual([0], model.get_path(
+            model.iter_previous(next_iter)).get_indices())
+        self.assertIs(None, model.iter_previous(tree_iter))
+        self.assertIs(None,
+                      model.iter_next(model.get_iter(Gtk.TreePath(path=2))))
+        self.assertEqual(['3', '2', '1'], [row[REVNO] for row in model])
+
+    def test_insert_line_graph_rows_in_view(self):
+        branch = self.make_test_branch('A')
+        model = BranchTreeModel(branch, [])
+        model.set_line_graph_data([('A', (0, 0), [], (), [], (1,))])
+        view = Gtk.TreeView(model=model)
+        view.append_column(Gtk.TreeViewColumn(
+            'Revno', Gtk.CellRendererText(), text=REVNO))
+        window = Gtk.OffscreenWindow()
+        self.addCleanup(window.destroy)
+        window.add(view)
+        window.show_all()
+        view.set_cursor(Gtk.TreePath(path=0), None, False)
+        data = self.make_three_rows()
+        model.insert_line_graph_rows(data, CompactLineGraph(data), 2, [2])
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+        self.assertEqual(['3', '2', '1'],
+                         [row[REVNO] for row in view.get_model()])
+        # The cursor stays on the same row, which has moved down.
+        (path, column) = view.get_cursor()
+        self.assertEqual([2], path.get_indices())
+
+    def test_values_are_cached(self):
+        branch = self.make_test_branch(
+            'A', message='badger', committer='fnord')
+        model = BranchTreeModel(branch, [])
+        model.set_line_graph_data([('A', (0, 0), [], (), [], [1])])
+        model.load_rows(0, 0)
+        self.assertIn('A', model._values)
+        model.revision_cache.clear()
+        # The display values outlive the revision.
+        self.assertEqual('fnord', model[0][COMMITTER])
+        self.assertEqual('1', model[0][REVNO])
+        model.set_line_graph_data([('A', (0, 0), [], (), [], [2])])
+        self.assertNotIn('A', model._values)
+        self.assertEqual('', model[0][SUMMARY])
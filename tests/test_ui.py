@@ -16,6 +16,9 @@
 
 """Test the ui functionality."""
 
+import threading
+
+from gi.repository import GObject
 from gi.repository import Gtk
 
 from bzrlib import (
@@ -52,6 +55,19 @@ class MainIterationTestCase(tests.TestCase):
         self.assertIs(False, Gtk.events_pending())
         self.assertEqual('after', button.props.label)
 
+    def test_without_main_iteration(self):
+        # Pending events are left to the main loop.
+        def test_func(self):
+            GObject.idle_add(lambda: False)
+            return True
+
+        decorated_func = ui.main_iteration(test_func)
+        result = ui.without_main_iteration(decorated_func, object())
+        self.assertIs(True, result)
+        self.assertIs(True, Gtk.events_pending())
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+
 
 class PromptDialogTestCase(tests.TestCase):
 
@@ -356,6 +372,27 @@ class GtkUIFactoryTestCase(tests.TestCase):
         self.assertEqual(
             ('test', 1, 2), ui_factory._progress_bar_widget.update.args)
 
+    def test_progress_updated_in_thread(self):
+        ui_factory = ui.GtkUIFactory()
+        progress_widget = ui.ProgressPanel()
+        updates = []
+        progress_widget.update = lambda *args: updates.append(args)
+        ui_factory.set_progress_bar_widget(progress_widget)
+        def report():
+            for current_cnt in range(3):
+                task = ProgressTask()
+                task.msg = 'test'
+                task.current_cnt = current_cnt
+                task.total_cnt = 3
+                ui_factory._progress_updated(task)
+        thread = threading.Thread(target=report)
+        thread.start()
+        thread.join()
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+        # Only the latest update is shown.
+        self.assertEqual([('test', 2, 3)], updates)
+
     def test_report_transport_activity_with_widget(self):
         ui_factory = ui.GtkUIFactory()
         progress_widget = ui.ProgressPanel()
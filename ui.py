@@ -19,20 +19,46 @@
 """GTK UI
 """
 
+import threading
+
+from gi.repository import GObject
 from gi.repository import Gtk
 
 from bzrlib.ui import UIFactory
 
+from bzrlib.plugins.gtk.backgroundjob import check_cancelled
+
+
+# Whether main_iteration iterates over the pending events. It does not while
+# the main loop calls progress updates that were reported by other threads.
+_iterate_main_loop = True
+
 
 def main_iteration(function):
     def with_main_iteration(self, *args, **kwargs):
         result = function(self, *args, **kwargs)
-        while Gtk.events_pending():
-            Gtk.main_iteration_do(False)
+        if _iterate_main_loop:
+            while Gtk.events_pending():
+                Gtk.main_iteration_do(False)
         return result
     return with_main_iteration
 
 
+def without_main_iteration(function, *args):
+    """Call function without main_iteration iterating over the events.
+
+    For callbacks of the main loop, which dispatches the pending events
+    itself. Iterating over them there would run the other callbacks out of
+    order, nested in this one.
+    """
+    global _iterate_main_loop
+    _iterate_main_loop = False
+    try:
+        return function(*args)
+    finally:
+        _iterate_main_loop = True
+
+
 class PromptDialog(Gtk.MessageDialog):
     """Prompt the user for a yes/no answer."""
 
@@ -181,6 +207,9 @@ class GtkUIFactory(UIFactory):
     def __init__(self):
         """Create a GtkUIFactory"""
         super(GtkUIFactory, self).__init__()
+        self._main_thread = threading.current_thread()
+        self._pending_lock = threading.Lock()
+        self._pending_call = None
         self.set_progress_bar_widget(None)
 
     def set_progress_bar_widget(self, widget):
@@ -236,8 +265,41 @@ class GtkUIFactory(UIFactory):
         else:
             return None
 
+    def _call_in_main_thread(self, function, *args):
+        """Call function, from the main loop if this is another thread.
+
+        Progress may be reported by background jobs, but GTK widgets must
+        only be used from the thread running the main loop. Only the latest
+        call of other threads is made, when the main loop gets to it, so
+        that frequent progress reports do not pile up.
+        """
+        if threading.current_thread() is self._main_thread:
+            function(*args)
+            return
+        self._pending_lock.acquire()
+        try:
+            scheduled = self._pending_call is not None
+            self._pending_call = (function, args)
+        finally:
+            self._pending_lock.release()
+        if not scheduled:
+            GObject.idle_add(self._make_pending_call)
+
+    def _make_pending_call(self):
+        self._pending_lock.acquire()
+        try:
+            (function, args) = self._pending_call
+            self._pending_call = None
+        finally:
+            self._pending_lock.release()
+        without_main_iteration(function, *args)
+        return False
+
     def _progress_all_finished(self):
         """See UIFactory._progress_all_finished."""
+        self._call_in_main_thread(self._finish_progress_widget)
+
+    def _finish_progress_widget(self):
         pbw = self._progress_bar_widget
         if pbw:
             pbw.finished()
@@ -250,11 +312,20 @@ class GtkUIFactory(UIFactory):
 
     def _progress_updated(self, task):
         """See UIFactory._progress_updated."""
+        # Reporting progress is where cancelled background jobs stop.
+        check_cancelled()
+        self._call_in_main_thread(self._update_progress_widget,
+            task.msg, task.current_cnt, task.total_cnt)
+
+    def _update_progress_widget(self, msg, current_cnt, total_cnt):
         self._ensure_progress_widget()
-        self._progress_bar_widget.update(task.msg,
-                                         task.current_cnt, task.total_cnt)
+        self._progress_bar_widget.update(msg, current_cnt, total_cnt)
 
     def report_transport_activity(self, transport, byte_count, direction):
         """See UIFactory.report_transport_activity."""
+        check_cancelled()
+        self._call_in_main_thread(self._tick_progress_widget)
+
+    def _tick_progress_widget(self):
         self._ensure_progress_widget()
         self._progress_bar_widget.tick()
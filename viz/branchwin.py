@@ -9,11 +9,13 @@ __author__    = "Scott James Remnant <scott@ubuntu.com>"
 
 
 from gi.repository import Gdk
+from gi.repository import GObject
 from gi.repository import Gtk
 
 from bzrlib.plugins.gtk import icon_path
 from bzrlib.plugins.gtk.branchview import TreeView
 from bzrlib.plugins.gtk.preferences import PreferencesWindow
+from bzrlib.plugins.gtk.revisioncache import get_revision_cache
 from bzrlib.plugins.gtk.revisionmenu import RevisionMenu
 from bzrlib.plugins.gtk.window import Window
 
@@ -29,6 +31,10 @@ class BranchWindow(Window):
     for a particular branch.
     """
 
+    # Milliseconds the selection has to stay on a revision before its
+    # details and diff are shown.
+    SELECTION_DELAY = 100
+
     def __init__(self, branch, start_revs, maxnum, parent=None):
         """Create a new BranchWindow.
 
@@ -45,6 +51,8 @@ class BranchWindow(Window):
         self.start_revs  = start_revs
         self.maxnum      = maxnum
         self.config      = GlobalConfig()
+        self.revision_cache = get_revision_cache(branch.repository)
+        self._show_selected_id = None
 
         if self.config.get_user_option('viz-compact-view') == 'yes':
             self.compact_view = True
@@ -97,6 +105,7 @@ class BranchWindow(Window):
         self.refresh_action.connect_accelerator()
 
         self.vbox = self.construct()
+        self.connect('destroy', self._on_destroy)
 
     def _save_size_on_destroy(self, widget, config_name):
         """Creates a hook that saves the size of widget to config option 
@@ -358,6 +367,13 @@ class BranchWindow(Window):
         self.next_button = self.next_rev_action.create_tool_item()
         self.toolbar.insert(self.next_button, -1)
 
+        # The parent and child menus are filled when they are opened.
+        for button, callback in ((self.prev_button, self._show_prev_menu_cb),
+                                 (self.next_button, self._show_next_menu_cb)):
+            if getattr(button, 'set_menu', None) is not None:
+                button.set_menu(Gtk.Menu())
+                button.connect('show-menu', callback)
+
         self.toolbar.insert(Gtk.SeparatorToolItem(), -1)
 
         refresh_button = Gtk.ToolButton.new_from_stock(Gtk.STOCK_REFRESH)
@@ -413,59 +429,59 @@ class BranchWindow(Window):
     def _treeselection_changed_cb(self, selection, *args):
         """callback for when the treeview changes."""
         revision = self.treeview.get_revision()
-        parents  = self.treeview.get_parents()
-        children = self.treeview.get_children()
-
         if revision and revision.revision_id != NULL_REVISION:
             self.revision_menu.set_revision_ids([revision.revision_id])
-            prev_menu = Gtk.Menu()
-            if len(parents) > 0:
-                self.prev_rev_action.set_sensitive(True)
-                for parent_id in parents:
-                    if parent_id and parent_id != NULL_REVISION:
-                        parent = self.branch.repository.get_revision(parent_id)
-                        try:
-                            str = ' (%s)' % parent.properties['branch-nick']
-                        except KeyError:
-                            str = ""
-
-                        item = Gtk.MenuItem(
-                            label=parent.message.split("\n")[0] + str)
-                        item.connect('activate', self._set_revision_cb, parent_id)
-                        prev_menu.add(item)
-                prev_menu.show_all()
-            else:
-                self.prev_rev_action.set_sensitive(False)
-                prev_menu.hide()
-
-            if getattr(self.prev_button, 'set_menu', None) is not None:
-                self.prev_button.set_menu(prev_menu)
-
-            next_menu = Gtk.Menu()
-            if len(children) > 0:
-                self.next_rev_action.set_sensitive(True)
-                for child_id in children:
-                    child = self.branch.repository.get_revision(child_id)
-                    try:
-                        str = ' (%s)' % child.properties['branch-nick']
-                    except KeyError:
-                        str = ""
-
-                    item = Gtk.MenuItem(
-                        label=child.message.split("\n")[0] + str)
-                    item.connect('activate', self._set_revision_cb, child_id)
-                    next_menu.add(item)
-                next_menu.show_all()
-            else:
-                self.next_rev_action.set_sensitive(False)
-                next_menu.hide()
-
-            if getattr(self.next_button, 'set_menu', None) is not None:
-                self.next_button.set_menu(next_menu)
-
+            self.prev_rev_action.set_sensitive(
+                len(self.treeview.get_parents()) > 0)
+            self.next_rev_action.set_sensitive(
+                len(self.treeview.get_children()) > 0)
+            # The details are only shown once the selection stops moving.
+            if self._show_selected_id is not None:
+                GObject.source_remove(self._show_selected_id)
+            self._show_selected_id = GObject.timeout_add(
+                self.SELECTION_DELAY, self._show_selected_revision)
+
+    def _show_selected_revision(self):
+        """Show the details and diff of the selected revision."""
+        self._show_selected_id = None
+        revision = self.treeview.get_revision()
+        if revision and revision.revision_id != NULL_REVISION:
+            parents = self.treeview.get_parents()
             self.revisionview.set_revision(revision)
-            self.revisionview.set_children(children)
+            self.revisionview.set_children(self.treeview.get_children())
             self.update_diff_panel(revision, parents)
+        return False
+
+    def _on_destroy(self, *ignored):
+        if self._show_selected_id is not None:
+            GObject.source_remove(self._show_selected_id)
+            self._show_selected_id = None
+
+    def _show_prev_menu_cb(self, button):
+        self._fill_revision_menu(button.get_menu(),
+                                 self.treeview.get_parents())
+
+    def _show_next_menu_cb(self, button):
+        self._fill_revision_menu(button.get_menu(),
+                                 self.treeview.get_children())
+
+    def _fill_revision_menu(self, menu, revids):
+        """Replace the items of menu with one for each of revids."""
+        for item in menu.get_children():
+            menu.remove(item)
+        revids = [revid for revid in revids
+                  if revid and revid != NULL_REVISION]
+        # Fetch the revisions with a single call
+        for revid, revision in zip(revids,
+                                   self.revision_cache.get_revisions(revids)):
+            try:
+                nick = ' (%s)' % revision.properties['branch-nick']
+            except KeyError:
+                nick = ""
+            item = Gtk.MenuItem(label=revision.message.split("\n")[0] + nick)
+            item.connect('activate', self._set_revision_cb, revid)
+            menu.add(item)
+        menu.show_all()
 
     def _tree_revision_activated(self, widget, path, col):
         # TODO: more than one parent
@@ -686,10 +702,8 @@ class BranchWindow(Window):
         else:
             parent_id = parents[0]
 
-        rev_tree    = self.branch.repository.revision_tree(revision.revision_id)
-        parent_tree = self.branch.repository.revision_tree(parent_id)
-
-        self.diff.set_diff(rev_tree, parent_tree)
+        self.diff.set_diff_in_background(self.branch.repository,
+                                         revision.revision_id, parent_id)
         if self.config.get_user_option('viz-wrap-diffs') == 'True':
             self.diff._on_wraplines_toggled(wrap=True)
         self.diff.show_all()